@@ -0,0 +1,173 @@
+# activity_aggregates.py - Per-learning-objective activity totals, updated as questions and notebook log events arrive
+import logging
+import os
+import re
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import db
+from db import Database
+from metrics import ACTIVITY_EVENTS, ACTIVITY_TABLE_CHARS
+
+# Use .env variables or fall back to defaults
+# Gaps between log events longer than this count as a break, not as time on task
+ACTIVITY_IDLE_SECONDS = float(os.getenv("activity_idle_seconds", "300"))
+
+# Objective for activity before the first question of a session (same label as the TA's LO selection fallback)
+UNASSIGNED_OBJECTIVE = "No specific LO"
+# 'time' of processed log events (see user-notebook/utils.py)
+EVENT_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Processed log event -> the counter it increments
+EVENT_METRICS = {
+    "Executed cells": "executions",
+    "Executed cells with error": "executions",
+    "Edited cell": "edits",
+    "Pasted content": "pastes",
+    "Inserted code from assistant": "assistant_inserts",
+}
+ERROR_EVENT = "Executed cells with error"
+ERROR_TYPE_PATTERN = re.compile(r"\s*([A-Za-z_][\w.]*)\s*(?::|$)")
+# Most frequent error and question types listed per objective in the report table
+TABLE_TOP_TYPES = 3
+
+
+def error_type(error: Optional[str]) -> str:
+    """'NameError: name 'x' is not defined' -> 'NameError'."""
+    match = ERROR_TYPE_PATTERN.match(error or "")
+    return match.group(1) if match else "UnknownError"
+
+
+def count_new_events(events: Iterable[dict], last_event_time: str, events_at_last_time: int,
+                     last_event_at: Optional[float], idle_seconds: float = ACTIVITY_IDLE_SECONDS) -> tuple:
+    """Totals for the events after the cursor, and the cursor after them.
+
+    The cursor is the newest event time counted and how many events with that
+    time were counted, so a client may resend overlapping events (from the
+    cursor time on, or the whole session) without anything counted twice.
+    Time on task adds up the gaps between consecutive events up to
+    `idle_seconds`. Returns (totals, (last_event_time, events_at_last_time,
+    last_event_at), counted, duplicates, invalid).
+    """
+    valid, invalid = [], 0
+    for event in events:
+        try:
+            valid.append((event["time"], datetime.strptime(event["time"], EVENT_TIME_FORMAT).timestamp(), event))
+        except (KeyError, TypeError, ValueError):
+            invalid += 1
+    valid.sort(key=lambda item: item[0])
+
+    totals = Counter()
+    counted = duplicates = skipped_at_cursor = 0
+    cursor_time, already_at_cursor = last_event_time, events_at_last_time
+    for event_time, event_at, event in valid:
+        if event_time < cursor_time or (event_time == cursor_time and skipped_at_cursor < already_at_cursor):
+            skipped_at_cursor += event_time == cursor_time
+            duplicates += 1
+            continue
+        if last_event_at is not None and 0 <= event_at - last_event_at <= idle_seconds:
+            totals["active_seconds"] += event_at - last_event_at
+        last_event_at = event_at
+        if event_time == last_event_time:
+            events_at_last_time += 1
+        else:
+            last_event_time, events_at_last_time = event_time, 1
+        name = event.get("event")
+        if name in EVENT_METRICS:
+            totals[EVENT_METRICS[name]] += 1
+        if name == ERROR_EVENT:
+            totals["errors"] += 1
+            totals[f"error:{error_type(event.get('error'))}"] += 1
+        counted += 1
+    return totals, (last_event_time, events_at_last_time, last_event_at), counted, duplicates, invalid
+
+
+def record_activity(conn, student_id: str, file_name: str, assignment_id: str, events: Sequence[dict],
+                    learning_objective: Optional[str], classification: Optional[str], now: float,
+                    idle_seconds: float) -> Tuple[int, int, int]:
+    """Adds new log events (and a classified question) to the session's objective totals; runs on the database thread.
+
+    Events count towards `learning_objective` if given (the objective of the
+    question they were sent with), else towards the objective of the
+    session's latest question.
+    """
+    # Take the write lock first, so workers handling the same session at once do not both count its events
+    conn.execute("BEGIN IMMEDIATE")
+    cursor = db.fetch_activity_cursor(conn, student_id, file_name)
+    last_event_time, events_at_last_time, last_event_at, current_objective = (
+        tuple(cursor) if cursor is not None else ("", 0, None, None))
+    objective = learning_objective or current_objective or UNASSIGNED_OBJECTIVE
+    totals, new_cursor, counted, duplicates, invalid = count_new_events(
+        events, last_event_time, events_at_last_time, last_event_at, idle_seconds)
+    if classification:
+        totals["questions"] += 1
+        totals[f"question:{classification}"] += 1
+    db.add_lo_activity(conn, [(student_id, assignment_id, objective, metric, value, now)
+                              for metric, value in totals.items() if value])
+    if counted or objective != current_objective:
+        db.upsert_activity_cursor(conn, student_id, file_name, *new_cursor, objective, now)
+    return counted, duplicates, invalid
+
+
+def _with_types(totals: Counter, metric: str, prefix: str) -> str:
+    total = int(totals[metric])
+    types = sorted(((key[len(prefix):], int(value)) for key, value in totals.items() if key.startswith(prefix)),
+                   key=lambda item: (-item[1], item[0]))
+    if not types:
+        return str(total)
+    return f"{total} ({', '.join(f'{name} {count}' for name, count in types[:TABLE_TOP_TYPES])})"
+
+
+def activity_table(rows: Iterable, learning_objectives: Sequence[str] = ()) -> str:
+    """Compact text table of (learning_objective, metric, value) rows, one line per objective.
+
+    Rows of several students are summed. `learning_objectives` come first in
+    their order, listed even without activity; others follow alphabetically.
+    """
+    totals: Dict[str, Counter] = {}
+    for learning_objective, metric, value in rows:
+        totals.setdefault(learning_objective, Counter())[metric] += value
+    objectives = list(learning_objectives) + sorted(set(totals) - set(learning_objectives))
+    lines = ["Learning objective | Minutes on task | Cell runs | Errors (by type) | Questions (by type) | Edits | Pastes | Assistant inserts"]
+    for objective in objectives:
+        counts = totals.get(objective, Counter())
+        lines.append(" | ".join([
+            objective, f"{counts['active_seconds'] / 60:.0f}", str(int(counts["executions"])),
+            _with_types(counts, "errors", "error:"), _with_types(counts, "questions", "question:"),
+            str(int(counts["edits"])), str(int(counts["pastes"])), str(int(counts["assistant_inserts"])),
+        ]))
+    return "\n".join(lines)
+
+
+class ActivityAggregates:
+    """Running activity totals per (student, assignment, learning objective).
+
+    Each question adds its notebook log events (cell runs, errors by
+    exception type, edits, pastes, assistant inserts, time on task) and its
+    classification to the `lo_activity` table, counted once however often a
+    client resends them. Reports read the totals as a compact table instead of
+    the raw activity log, and analytics_cli.py can query them directly.
+    """
+
+    def __init__(self, database: Database, idle_seconds: float = ACTIVITY_IDLE_SECONDS):
+        self.database = database
+        self.idle_seconds = idle_seconds
+
+    async def record(self, student_id: str, file_name: str, assignment_id: str, events: Optional[List[dict]] = None,
+                     learning_objective: Optional[str] = None, classification: Optional[str] = None):
+        counted, duplicates, invalid = await self.database.run(
+            record_activity, student_id, file_name, assignment_id, events or [], learning_objective, classification,
+            time.time(), self.idle_seconds)
+        for outcome, count in (("counted", counted), ("duplicate", duplicates), ("invalid", invalid)):
+            if count:
+                ACTIVITY_EVENTS.labels(outcome=outcome).inc(count)
+        if counted or invalid:
+            logging.info(f"Activity for {student_id} ({file_name}): counted {counted} log events, "
+                         f"skipped {duplicates} already counted and {invalid} invalid.")
+
+    async def table(self, student_id: str, assignment_id: str, learning_objectives: Sequence[str]) -> str:
+        rows = await self.database.run(db.fetch_lo_activity, student_id, assignment_id)
+        table = activity_table(rows, learning_objectives)
+        ACTIVITY_TABLE_CHARS.observe(len(table))
+        return table
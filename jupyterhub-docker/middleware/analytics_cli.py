@@ -1,11 +1,14 @@
+import argparse
 import sqlite3
 from collections import Counter
 from datetime import datetime
 
+from activity_aggregates import activity_table
+
 DB_PATH = "/app/chat_histories/chat_history.db"
+EXPORT_DIR = "/app/chat_histories/parquet"
 
-def main():
-    conn = sqlite3.connect(DB_PATH)
+def summary(conn):
     c = conn.cursor()
 
     # Total number of questions
@@ -61,7 +64,59 @@ def main():
     else:
         print("  No experiment group assignments found.")
 
-    conn.close()
+def activity(conn, student_id=None, assignment_id=None):
+    # Per-learning-objective totals kept by the TA (see activity_aggregates.py), summed over the selected students
+    conditions, params = [], []
+    if student_id:
+        conditions.append("student_id = ?")
+        params.append(student_id)
+    if assignment_id:
+        conditions.append("assignment_id = ?")
+        params.append(assignment_id)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    students = dict(conn.execute(f"SELECT assignment_id, COUNT(DISTINCT student_id) FROM lo_activity{where} GROUP BY assignment_id", params))
+    if not students:
+        print("No activity recorded.")
+        return
+    rows = conn.execute(f"""
+        SELECT assignment_id, learning_objective, metric, SUM(value) FROM lo_activity{where}
+        GROUP BY assignment_id, learning_objective, metric
+    """, params).fetchall()
+    for assignment in sorted(students):
+        print(f"\nAssignment: {assignment} | Students: {students[assignment]}")
+        print(activity_table(row[1:] for row in rows if row[0] == assignment))
+
+def main():
+    parser = argparse.ArgumentParser(description="Usage statistics from the middleware database.")
+    parser.add_argument("--db", default=DB_PATH, help="Path to chat_history.db")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("summary", help="Questions, students, classifications and experiment groups (default)")
+    activity_parser = commands.add_parser("activity", help="Activity per learning objective, by assignment")
+    activity_parser.add_argument("--student", help="Only this student")
+    activity_parser.add_argument("--assignment", help="Only this assignment (notebook name without extension)")
+    export_parser = commands.add_parser("export", help="Append new chat history, profiles and experiment assignments to partitioned Parquet")
+    export_parser.add_argument("--out", default=EXPORT_DIR, help="Export directory; reruns only add rows newer than the last export")
+    export_parser.add_argument("--chunk-rows", type=int, help="Rows read from the database per batch (default 50000)")
+    export_parser.add_argument("--settle-seconds", type=float, help="Leave rows newer than this for the next run (default 300)")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        # pyarrow is only needed here
+        from parquet_export import export
+        options = {"chunk_rows": args.chunk_rows, "settle_seconds": args.settle_seconds}
+        for table, rows in export(args.db, args.out, **{k: v for k, v in options.items() if v is not None}).items():
+            print(f"{table}: {rows} new rows")
+        print(f"Written to {args.out}")
+        return
+
+    conn = sqlite3.connect(args.db)
+    try:
+        if args.command == "activity":
+            activity(conn, args.student, args.assignment)
+        else:
+            summary(conn)
+    finally:
+        conn.close()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
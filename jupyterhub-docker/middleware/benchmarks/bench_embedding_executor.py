@@ -0,0 +1,142 @@
+"""Throughput of question embedding at 1/10/100 concurrent requests.
+
+Each simulated request awaits one question embedding, as the TA does for
+every message. Three strategies are compared:
+
+* inline  - `model.encode()` called directly in the coroutine, which is how
+            the TA worked before embedding_executor.py. It blocks the event loop.
+* thread  - EmbeddingExecutor with max batch size 1. Off the event loop, but
+            one text per model call.
+* batched - EmbeddingExecutor with the configured batch size and wait.
+
+For each strategy the script reports throughput, p50/p95/max request latency, the
+mean batch size and the worst event-loop stall seen by a 1 ms ticker task.
+
+Usage (from the middleware directory):
+    python benchmarks/bench_embedding_executor.py --requests 400 --max-batch-size 32 --max-wait-ms 5
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedding_executor import EmbeddingExecutor  # noqa: E402
+
+QUESTIONS = [
+    "How do I read a CSV file with pandas?", "Why does my for loop never stop?",
+    "What is the difference between a list and a tuple?", "Can you just give me the answer for task 3?",
+    "How do I plot two lines on the same chart?", "What does this KeyError mean?",
+    "How can I filter rows where the value is above 10?", "Is my function supposed to return or print?",
+]
+
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class InlineEncoder:
+    def __init__(self, model):
+        self.model = model
+
+    async def encode(self, text: str):
+        return self.model.encode(text, convert_to_numpy=True, normalize_embeddings=True)
+
+
+async def measure(encoder, concurrency: int, total: int) -> dict:
+    """Runs `total` requests from `concurrency` clients that each keep one request in flight."""
+    stalls = []
+    stop = asyncio.Event()
+
+    async def ticker():
+        last = time.perf_counter()
+        while not stop.is_set():
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            stalls.append(now - last - 0.001)
+            last = now
+
+    latencies = []
+    remaining = iter(range(total))
+    rng = random.Random(concurrency)
+
+    async def client(started: float):
+        # Each client sends its next question as soon as the previous one is answered, so the
+        # time a blocked event loop keeps a client from even starting counts towards latency
+        issued = started
+        for i in remaining:
+            await encoder.encode(f"{rng.choice(QUESTIONS)} ({i})")
+            done = time.perf_counter()
+            latencies.append(done - issued)
+            issued = done
+
+    tick_task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    started = time.perf_counter()
+    await asyncio.gather(*(client(started) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await tick_task
+    return {
+        "throughput": total / elapsed,
+        "p50": percentile(latencies, 50) * 1000,
+        "p95": percentile(latencies, 95) * 1000,
+        "max": max(latencies) * 1000,
+        "stall": max(stalls, default=0) * 1000,
+    }
+
+
+async def run_strategy(name: str, model, concurrency: int, total: int, max_batch_size: int, max_wait_ms: float) -> dict:
+    if name == "inline":
+        encoder = InlineEncoder(model)
+        result = await measure(encoder, concurrency, total)
+        result["batch"] = 1.0
+        return result
+    executor = EmbeddingExecutor(model, max_batch_size=1 if name == "thread" else max_batch_size, max_wait_ms=max_wait_ms)
+    batch_sizes = []
+    encode_batch = executor._encode_batch
+
+    def counting_encode_batch(texts):
+        batch_sizes.append(len(texts))
+        return encode_batch(texts)
+
+    executor._encode_batch = counting_encode_batch
+    executor.start()
+    try:
+        result = await measure(executor, concurrency, total)
+    finally:
+        await executor.stop()
+    result["batch"] = statistics.mean(batch_sizes)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="all-MiniLM-L6-v2", help="Sentence Transformer model name or path")
+    parser.add_argument("--requests", type=int, default=400, help="Requests per run")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(args.model, device="cpu")
+    model.encode(QUESTIONS, convert_to_numpy=True)  # Warm up
+
+    print(f"{args.requests} requests per run, max batch {args.max_batch_size}, max wait {args.max_wait_ms} ms\n")
+    print(f"{'conc':>5} {'strategy':<8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'batch':>6} {'max stall ms':>13}")
+    for concurrency in args.concurrency:
+        for name in ("inline", "thread", "batched"):
+            r = asyncio.run(run_strategy(name, model, concurrency, args.requests, args.max_batch_size, args.max_wait_ms))
+            print(f"{concurrency:>5} {name:<8} {r['throughput']:>8.1f} {r['p50']:>8.1f} {r['p95']:>8.1f} {r['max']:>8.1f} "
+                  f"{r['batch']:>6.1f} {r['stall']:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
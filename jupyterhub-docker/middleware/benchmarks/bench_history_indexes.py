@@ -0,0 +1,157 @@
+"""Before/after latency of the chat_history queries around the schema v3 indexes.
+
+Builds a history database (1M rows by default) at schema version 2, which
+has no secondary indexes on chat_history, and times the queries the TA runs
+on every message:
+
+* recent history  - `db.fetch_recent_messages` (get_history)
+* session stats   - the old /qualtrics-finish aggregate over the session's
+                    messages; on the final schema also `db.fetch_session_summary`,
+                    the primary-key lookup that replaced it (schema v7)
+* update by text  - the old classification update, which found the latest
+                    question by matching message_text
+* update by rowid - `db.update_message_classification`
+
+It then applies the remaining migrations with `db.create_schema` and runs the
+same queries again. Each query is sampled for random students.
+
+Usage:
+    python benchmarks/bench_history_indexes.py --rows 1000000 --samples 200
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+# How ta-handler found the row to classify before questions were addressed by rowid
+LEGACY_UPDATE_SQL = """
+    UPDATE chat_history
+    SET message_classification = ?
+    WHERE id = (
+        SELECT id FROM chat_history
+        WHERE student_id = ? AND file_name = ? AND message_type = 'question' AND message_text = ?
+        ORDER BY timestamp DESC
+        LIMIT 1
+    )
+"""
+# How /qualtrics-finish read the session's first interaction and question count before session_summary
+LEGACY_SESSION_STATS_SQL = """
+    SELECT MIN(timestamp) as first_interaction,
+           COUNT(CASE WHEN message_type = 'question' THEN 1 END) as question_count
+    FROM chat_history
+    WHERE student_id = ? AND file_name = ?
+"""
+
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def populate(conn: sqlite3.Connection, rows: int, students: int, files: int, seed: int):
+    rng = random.Random(seed)
+    started = time.time() - rows
+    batch = []
+    for i in range(rows):
+        message_type = "question" if i % 2 == 0 else "response"
+        batch.append((
+            f"student{rng.randrange(students)}", started + i, message_type,
+            f"{message_type} {i} about loops and functions",
+            rng.choice(("instrumental", "executive", "other")) if message_type == "question" else None,
+            f"assignment{rng.randrange(files)}.ipynb",
+        ))
+        if len(batch) == 50_000:
+            conn.executemany("INSERT INTO chat_history (student_id, timestamp, message_type, message_text, message_classification, file_name) VALUES (?, ?, ?, ?, ?, ?)", batch)
+            batch.clear()
+    if batch:
+        conn.executemany("INSERT INTO chat_history (student_id, timestamp, message_type, message_text, message_classification, file_name) VALUES (?, ?, ?, ?, ?, ?)", batch)
+    conn.commit()
+
+
+def pick_targets(conn: sqlite3.Connection, samples: int, seed: int) -> list:
+    """(student_id, file_name, question id, question text) of random stored questions."""
+    max_id = conn.execute("SELECT MAX(id) FROM chat_history").fetchone()[0]
+    rng = random.Random(seed)
+    targets = []
+    while len(targets) < samples:
+        row = conn.execute("SELECT id, student_id, file_name, message_text FROM chat_history WHERE id = ? AND message_type = 'question'",
+                           (rng.randint(1, max_id),)).fetchone()
+        if row:
+            targets.append((row[1], row[2], row[0], row[3]))
+    return targets
+
+
+def time_queries(conn: sqlite3.Connection, targets: list) -> dict:
+    timings = {"recent history": [], "session stats": [], "update by text": [], "update by rowid": []}
+    has_summary = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'session_summary'").fetchone()
+    if has_summary:
+        timings["session summary"] = []
+
+    def timed(name, fn):
+        started = time.perf_counter()
+        fn()
+        timings[name].append((time.perf_counter() - started) * 1000)
+
+    for student_id, file_name, question_id, text in targets:
+        timed("recent history", lambda: db.fetch_recent_messages(conn, student_id, file_name, 6))
+        timed("session stats", lambda: conn.execute(LEGACY_SESSION_STATS_SQL, (student_id, file_name)).fetchone())
+        if has_summary:
+            timed("session summary", lambda: db.fetch_session_summary(conn, student_id, file_name))
+        timed("update by text", lambda: conn.execute(LEGACY_UPDATE_SQL, ("executive", student_id, file_name, text)))
+        timed("update by rowid", lambda: db.update_message_classification(conn, question_id, "instrumental"))
+        conn.commit()
+    return timings
+
+
+def report(label: str, timings: dict):
+    print(f"\n{label}")
+    print(f"{'query':<16} {'p50 ms':>9} {'p95 ms':>9}")
+    for name, values in timings.items():
+        print(f"{name:<16} {percentile(values, 50):>9.3f} {percentile(values, 95):>9.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000, help="chat_history rows to generate")
+    parser.add_argument("--students", type=int, default=2000)
+    parser.add_argument("--files", type=int, default=10, help="Distinct assignment files")
+    parser.add_argument("--samples", type=int, default=200, help="Queries timed per kind")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "bench.db"), isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        db.create_schema(conn, target_version=2)
+        conn.execute("COMMIT")
+        conn.isolation_level = ""  # Back to implicit transactions for the timed statements
+
+        started = time.perf_counter()
+        populate(conn, args.rows, args.students, args.files, args.seed)
+        print(f"Generated {args.rows} rows in {time.perf_counter() - started:.1f}s "
+              f"({args.students} students, {args.files} files).")
+        targets = pick_targets(conn, args.samples, args.seed)
+
+        report(f"Schema v2 (no chat_history indexes), {len(targets)} samples per query:", time_queries(conn, targets))
+
+        conn.isolation_level = None
+        started = time.perf_counter()
+        db.create_schema(conn)
+        conn.execute("COMMIT")
+        conn.isolation_level = ""
+        print(f"\nMigrated to schema v{db.SCHEMA_VERSION} in {time.perf_counter() - started:.1f}s.")
+
+        report(f"Schema v{db.SCHEMA_VERSION} (indexed):", time_queries(conn, targets))
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Latency and errors of LLM calls spread over several backends, with and without llm_backends.py.
+
+Three instances of benchmarks/stub_llm.py stand in for the backends:
+
+* fast  - answers normally.
+* flaky - stalls for --slow-ms before a --slow-fraction of its answers.
+* dying - stops answering (connections hang) a third of the way into the run.
+
+The same seeded Poisson load of student answers goes to them three ways:
+
+* random - each call picks a backend at random, with no failover, like a
+           plain load balancer in front of the servers.
+* pool   - BackendPool: least outstanding requests, health probes, circuit
+           breaker and failover to a second backend.
+* hedged - BackendPool with hedging for interactive calls.
+
+The stubs are restarted for every strategy. The script reports p50/p95/max
+latency of the calls that got an answer, failed calls, and hedges sent/won.
+
+Usage (from the middleware directory):
+    python benchmarks/bench_llm_backends.py --duration 60 --rate 1.5
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+
+import httpx
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from llm_backends import Backend, BackendPool  # noqa: E402
+from metrics import LLM_HEDGES  # noqa: E402
+
+STRATEGIES = ("random", "pool", "hedged")
+
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def start_stubs(args) -> list:
+    options = {
+        "fast": [],
+        "flaky": ["--slow-fraction", str(args.slow_fraction), "--slow-ms", str(args.slow_ms)],
+        "dying": ["--hang-after", str(args.duration / 3)],
+    }
+    stubs = []
+    for i, (name, extra) in enumerate(options.items()):
+        port = args.base_port + i
+        process = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, "stub_llm.py"), "--port", str(port),
+                                    "--ms-per-token", str(args.ms_per_token)] + extra,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        stubs.append((Backend(name=name, base_url=f"http://127.0.0.1:{port}"), process))
+    for backend, _ in stubs:
+        for _ in range(100):
+            try:
+                httpx.get(f"{backend.base_url}/stats", timeout=1)
+                break
+            except httpx.HTTPError:
+                time.sleep(0.1)
+    return stubs
+
+
+def stop_stubs(stubs: list):
+    for _, process in stubs:
+        process.kill()  # A graceful shutdown would wait for the hung requests
+        process.wait()
+
+
+def hedge_count(outcome: str) -> float:
+    return LLM_HEDGES.labels(service="bench", outcome=outcome)._value.get()
+
+
+async def run_strategy(strategy: str, backends: list, args) -> list:
+    body = {"model": "stub", "messages": [{"role": "user", "content": "x" * args.prompt_chars}],
+            "stream": False, "max_tokens": args.response_tokens}
+    pool = BackendPool("bench", backends, health_interval=args.health_interval, max_attempts=2,
+                       hedge_priorities=("interactive",) if strategy == "hedged" else (),
+                       hedge_min_delay_ms=args.hedge_min_delay_ms)
+    rng = random.Random(0)
+    arrivals, at = [], 0.0
+    while True:
+        at += rng.expovariate(args.rate)
+        if at >= args.duration:
+            break
+        arrivals.append(at)
+    results = []
+
+    async with httpx.AsyncClient(timeout=args.timeout) as client:
+        async def send(backend: Backend):
+            response = await client.post(backend.chat_url, json=body)
+            response.raise_for_status()
+            return response.json()
+
+        async def call(offset: float, started: float, pick: Backend):
+            await asyncio.sleep(max(0.0, started + offset - time.perf_counter()))
+            issued = time.perf_counter()
+            try:
+                if strategy == "random":
+                    await send(pick)
+                else:
+                    await pool.call("stub", send, "interactive")
+                results.append((time.perf_counter() - issued, None))
+            except Exception as e:
+                results.append((time.perf_counter() - issued, type(e).__name__))
+
+        if strategy != "random":
+            pool.start(client)
+        started = time.perf_counter()
+        picks = random.Random(1)
+        try:
+            await asyncio.gather(*(call(offset, started, picks.choice(backends)) for offset in arrivals))
+        finally:
+            await pool.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=60, help="Seconds of arrivals per strategy")
+    parser.add_argument("--rate", type=float, default=1.5, help="Calls per second")
+    parser.add_argument("--response-tokens", type=int, default=40)
+    parser.add_argument("--prompt-chars", type=int, default=2000)
+    parser.add_argument("--ms-per-token", type=float, default=10)
+    parser.add_argument("--slow-fraction", type=float, default=0.2, help="Share of the flaky backend's answers that stall")
+    parser.add_argument("--slow-ms", type=float, default=3000)
+    parser.add_argument("--timeout", type=float, default=20, help="HTTP timeout of one request (seconds)")
+    parser.add_argument("--health-interval", type=float, default=2, help="Seconds between health probes")
+    parser.add_argument("--hedge-min-delay-ms", type=float, default=500)
+    parser.add_argument("--base-port", type=int, default=18441)
+    args = parser.parse_args()
+
+    print(f"{args.duration:.0f} s at {args.rate} calls/s over fast, flaky ({args.slow_fraction:.0%} stall "
+          f"{args.slow_ms:.0f} ms) and dying (hangs after {args.duration / 3:.0f} s) backends, "
+          f"{args.timeout:.0f} s request timeout\n")
+    print(f"{'strategy':<9} {'calls':>6} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'failed':>7} {'hedges':>7} {'won':>5}")
+    for strategy in STRATEGIES:
+        stubs = start_stubs(args)
+        sent, won = hedge_count("sent"), hedge_count("won")
+        try:
+            results = asyncio.run(run_strategy(strategy, [backend for backend, _ in stubs], args))
+        finally:
+            stop_stubs(stubs)
+        latencies = [seconds for seconds, error in results if error is None]
+        failed = sum(1 for _, error in results if error)
+        print(f"{strategy:<9} {len(results):>6} {percentile(latencies, 50) * 1000:>8.0f} "
+              f"{percentile(latencies, 95) * 1000:>8.0f} {max(latencies) * 1000:>8.0f} {failed:>7} "
+              f"{hedge_count('sent') - sent:>7.0f} {hedge_count('won') - won:>5.0f}")
+
+
+if __name__ == "__main__":
+    main()
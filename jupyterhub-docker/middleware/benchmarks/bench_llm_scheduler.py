@@ -0,0 +1,162 @@
+"""Latency per priority class of LLM calls, with and without llm_scheduler.py.
+
+Several worker processes (like the TA and EA workers) send a mixed load to
+benchmarks/stub_llm.py, which processes one request at a time like a
+CPU-only Ollama: student answers (interactive), EA answers (ea), long
+`/report` generations (report) and background classifications (background).
+Arrival times come from a seeded Poisson process, so both runs see the same
+load.
+
+* direct    - every call goes straight to the LLM, which serves them in
+              arrival order, as before llm_scheduler.py.
+* scheduled - every call takes a slot from an LLMScheduler first; the
+              workers share the slots through lock files.
+
+The script reports p50/p95/max latency per class and the calls the
+scheduler rejected.
+
+Usage (from the middleware directory):
+    python benchmarks/bench_llm_scheduler.py --workers 2 --duration 180 --limit 1
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from llm_scheduler import LLMScheduler, SchedulerRejected  # noqa: E402
+
+CLASSES = ("interactive", "ea", "report", "background")
+
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def request_body(priority: str, args) -> dict:
+    if priority == "background":
+        messages = [{"role": "system", "content": "Classify the question."}, {"role": "user", "content": "Classify: how?"}]
+        return {"model": "stub", "messages": messages, "stream": False}
+    tokens = {"interactive": args.response_tokens, "ea": args.ea_tokens, "report": args.report_tokens}[priority]
+    prompt = "x" * (args.report_prompt_chars if priority == "report" else args.prompt_chars)
+    return {"model": "stub", "messages": [{"role": "user", "content": prompt}], "stream": False, "max_tokens": tokens}
+
+
+def schedule(worker: int, args) -> list:
+    """(start offset in seconds, priority) of every call this worker sends."""
+    rng = random.Random(worker)
+    rates = {"interactive": args.interactive_per_min, "ea": args.interactive_per_min,
+             "report": args.reports_per_min, "background": args.background_per_min}
+    calls = []
+    for priority, per_minute in rates.items():
+        at = 0.0
+        while per_minute > 0:
+            at += rng.expovariate(per_minute / 60)
+            if at >= args.duration:
+                break
+            calls.append((at, priority))
+    return sorted(calls)
+
+
+async def run_worker(worker: int, mode: str, args, slot_dir: str) -> list:
+    url = f"http://127.0.0.1:{args.llm_port}/v1/chat/completions"
+    scheduler = LLMScheduler(f"bench{worker}", default_limit=args.limit, backend_limits={}, slot_dir=slot_dir,
+                             max_queue_size=args.queue_size, queue_timeout=args.queue_timeout)
+    results = []
+
+    async with httpx.AsyncClient(timeout=600) as client:
+        async def call(at: float, priority: str, started: float):
+            await asyncio.sleep(max(0.0, started + at - time.perf_counter()))
+            issued = time.perf_counter()
+            try:
+                if mode == "scheduled":
+                    async with scheduler.slot(url, priority):
+                        (await client.post(url, json=request_body(priority, args))).raise_for_status()
+                else:
+                    (await client.post(url, json=request_body(priority, args))).raise_for_status()
+                results.append((priority, time.perf_counter() - issued, None))
+            except SchedulerRejected as e:
+                results.append((priority, time.perf_counter() - issued, e.reason))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(call(at, priority, started) for at, priority in schedule(worker, args)))
+    return results
+
+
+def worker_main(worker: int, mode: str, args, slot_dir: str, queue):
+    queue.put(asyncio.run(run_worker(worker, mode, args, slot_dir)))
+
+
+def run_mode(mode: str, args) -> list:
+    slot_dir = tempfile.mkdtemp(prefix="bench_llm_slots_")
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker_main, args=(w, mode, args, slot_dir, queue))
+                 for w in range(args.workers)]
+    for process in processes:
+        process.start()
+    results = [item for _ in processes for item in queue.get()]
+    for process in processes:
+        process.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=2, help="Worker processes sharing the backend")
+    parser.add_argument("--duration", type=float, default=180, help="Seconds of arrivals per run")
+    parser.add_argument("--limit", type=int, default=1, help="Scheduler slots for the backend")
+    parser.add_argument("--queue-size", type=int, default=100)
+    parser.add_argument("--queue-timeout", type=float, default=120)
+    parser.add_argument("--interactive-per-min", type=float, default=10, help="Student answers (and as many EA calls) per worker")
+    parser.add_argument("--reports-per-min", type=float, default=3, help="/report generations per worker")
+    parser.add_argument("--background-per-min", type=float, default=12, help="Background classifications per worker")
+    parser.add_argument("--response-tokens", type=int, default=60)
+    parser.add_argument("--ea-tokens", type=int, default=40)
+    parser.add_argument("--report-tokens", type=int, default=300)
+    parser.add_argument("--prompt-chars", type=int, default=3000)
+    parser.add_argument("--report-prompt-chars", type=int, default=8000)
+    parser.add_argument("--ms-per-token", type=float, default=10)
+    parser.add_argument("--prefill-ms-per-1k-chars", type=float, default=100)
+    parser.add_argument("--llm-port", type=int, default=18435)
+    args = parser.parse_args()
+
+    stub = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, "stub_llm.py"), "--port", str(args.llm_port),
+                             "--ms-per-token", str(args.ms_per_token),
+                             "--prefill-ms-per-1k-chars", str(args.prefill_ms_per_1k_chars)])
+    try:
+        for _ in range(100):
+            try:
+                httpx.get(f"http://127.0.0.1:{args.llm_port}/stats", timeout=1)
+                break
+            except httpx.HTTPError:
+                time.sleep(0.1)
+
+        print(f"{args.workers} workers, {args.duration:.0f} s of arrivals, {args.limit} slot(s), stub serves one request at a time\n")
+        print(f"{'mode':<10} {'class':<12} {'calls':>6} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'rejected':>9}")
+        for mode in ("direct", "scheduled"):
+            results = run_mode(mode, args)
+            for priority in CLASSES:
+                latencies = [seconds for p, seconds, rejected in results if p == priority and not rejected]
+                rejected = sum(1 for p, _, reason in results if p == priority and reason)
+                if not latencies:
+                    continue
+                print(f"{mode:<10} {priority:<12} {len(latencies):>6} {percentile(latencies, 50) * 1000:>8.0f} "
+                      f"{percentile(latencies, 95) * 1000:>8.0f} {max(latencies) * 1000:>8.0f} {rejected:>9}")
+    finally:
+        stub.terminate()
+        stub.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Accuracy/latency report for the local question classifier.
+
+Takes the labeled questions in chat_history, holds out a share of them,
+trains the kNN model from local_classifier.py on the rest and classifies the
+held-out questions. Stored labels come from the LLM, so accuracy here means
+agreement with the LLM. For each confidence threshold it reports:
+
+* coverage - share of questions the local model answers without the LLM
+* accuracy - agreement with the stored label on those questions
+
+Local latency covers the per-question embedding plus the kNN lookup. The TA
+already computes the embedding for LO selection, so only the lookup is new
+work on the hot path. With --llm-samples N, the same held-out questions are
+also sent to the configured classification LLM to compare latency and
+agreement.
+
+Usage (from the middleware directory, pointing --db at a copy of the database):
+    python benchmarks/bench_local_classifier.py --db ./chat_history.db --llm-samples 50
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+import httpx
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+load_dotenv()
+
+import db  # noqa: E402
+import local_classifier  # noqa: E402
+from local_classifier import LocalClassifier  # noqa: E402
+
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def llm_classify(client: httpx.Client, system_prompt: str, question: str) -> str:
+    webui_key = os.getenv("webui_api_key", "")
+    if webui_key:
+        url = f"{os.getenv('webui_url', 'http://localhost:3000')}/api/chat/completions"
+        headers = {"Authorization": f"Bearer {webui_key}"}
+    else:
+        url = f"{os.getenv('ollama_url', 'http://localhost:11434')}/v1/chat/completions"
+        headers = {}
+    response = client.post(url, headers=headers, timeout=90, json={
+        "model": os.getenv("ollama_classification_model", "gemma3:4b"),
+        "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": f"Classify: {question}"}],
+        "stream": False,
+    })
+    response.raise_for_status()
+    return response.json()["choices"][0]["message"]["content"].strip().lower()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=local_classifier.DATABASE_FILE, help="Path to chat_history.db")
+    parser.add_argument("--options", default=local_classifier.POSSIBLE_CLASSIFICATIONS_FILE)
+    parser.add_argument("--prompt", default="./inputs/classification_prompt.txt", help="Classification prompt for --llm-samples")
+    parser.add_argument("--holdout", type=float, default=0.2, help="Share of labeled questions held out for evaluation")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.6, 0.7, 0.8, 0.9])
+    parser.add_argument("--llm-samples", type=int, default=0, help="Held-out questions to also classify with the LLM")
+    parser.add_argument("--seed", type=int, default=13)
+    args = parser.parse_args()
+
+    from sentence_transformers import SentenceTransformer
+
+    options = local_classifier.load_options(args.options)
+    database = db.Database(args.db)
+    try:
+        questions, labels = local_classifier.load_training_examples(database, options)
+    finally:
+        database.close()
+    if len(questions) < 20:
+        raise SystemExit(f"Only {len(questions)} labeled questions in {args.db}; not enough to evaluate.")
+
+    examples = list(zip(questions, labels))
+    random.Random(args.seed).shuffle(examples)
+    split = max(1, int(len(examples) * args.holdout))
+    held_out, train_set = examples[:split], examples[split:]
+
+    model = SentenceTransformer(local_classifier.EMBEDDING_MODEL_NAME)
+    classifier = LocalClassifier().fit(local_classifier.encode(model, [q for q, _ in train_set]), [l for _, l in train_set], options)
+
+    predictions, encode_ms, lookup_ms = [], [], []
+    for question, label in held_out:
+        started = time.perf_counter()
+        embedding = model.encode(question, convert_to_numpy=True, normalize_embeddings=True)
+        encoded = time.perf_counter()
+        predicted, confidence = classifier.predict(embedding)
+        lookup_ms.append((time.perf_counter() - encoded) * 1000)
+        encode_ms.append((encoded - started) * 1000)
+        predictions.append((predicted, confidence, label))
+
+    print(f"{len(train_set)} training / {len(held_out)} held-out questions, labels: {options}\n")
+    overall = sum(p == l for p, _, l in predictions) / len(predictions)
+    print(f"Accuracy with no threshold: {overall:.1%}\n")
+    print(f"{'threshold':>9} {'coverage':>9} {'accuracy':>9} {'to LLM':>7}")
+    for threshold in args.thresholds:
+        covered = [(p, l) for p, c, l in predictions if p is not None and c >= threshold]
+        coverage = len(covered) / len(predictions)
+        accuracy = sum(p == l for p, l in covered) / len(covered) if covered else 0.0
+        print(f"{threshold:>9.2f} {coverage:>9.1%} {accuracy:>9.1%} {len(predictions) - len(covered):>7}")
+
+    print(f"\nLocal latency: embed p50 {percentile(encode_ms, 50):.2f} ms / p95 {percentile(encode_ms, 95):.2f} ms, "
+          f"kNN lookup p50 {percentile(lookup_ms, 50):.3f} ms / p95 {percentile(lookup_ms, 95):.3f} ms")
+
+    if args.llm_samples > 0:
+        with open(args.prompt, 'r') as f:
+            system_prompt = f.read()
+        llm_ms, agree = [], 0
+        sample = held_out[:args.llm_samples]
+        with httpx.Client() as client:
+            for question, label in sample:
+                started = time.perf_counter()
+                agree += llm_classify(client, system_prompt, question) == label
+                llm_ms.append((time.perf_counter() - started) * 1000)
+        print(f"LLM latency ({len(sample)} calls): p50 {percentile(llm_ms, 50):.0f} ms / p95 {percentile(llm_ms, 95):.0f} ms / "
+              f"mean {statistics.mean(llm_ms):.0f} ms, agreement with stored label {agree / len(sample):.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""End-to-end latency of the standard and fused response pipelines against a stub LLM.
+
+For each pipeline mode the script starts benchmarks/stub_llm.py, the EA on
+port 8003 (the TA's fixed EA_URL) and the TA, on a copy of ./inputs whose
+only A/B group sets `pipeline_mode` (and `fused_classification`), then
+sends student questions from `--concurrency` clients and reports p50/p95
+latency of the full reply (or of the first streamed delta with --stream),
+together with the LLM work the stub did per message.
+
+The stub serializes requests like a CPU-only Ollama, so with several clients
+the latency also shows how much each mode makes other students wait.
+
+Usage (from a directory with a complete inputs/ folder, e.g. the middleware directory):
+    python benchmarks/bench_pipeline_modes.py --requests 20 --concurrency 1 4
+    python benchmarks/bench_pipeline_modes.py --stream --fused-classification
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+MIDDLEWARE_DIR = os.path.dirname(BENCHMARK_DIR)
+EA_PORT = 8003
+
+QUESTIONS = [
+    "How do I compute the mean of a column grouped by condition?",
+    "Why does my t-test give a different p-value than the paper?",
+    "What is the difference between a paired and an independent t-test?",
+    "Can you just write the code for the plot in task 3?",
+    "How do I check whether my data is normally distributed?",
+    "What does this KeyError on 'reaction_time' mean?",
+]
+
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def wait_for(url: str, process: subprocess.Popen, timeout: float):
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process for {url} exited with code {process.returncode}")
+        try:
+            if httpx.get(url, timeout=2).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout:.0f}s")
+
+
+def start(command: list, workdir: str, env: dict, log_file) -> subprocess.Popen:
+    return subprocess.Popen(command, cwd=workdir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+
+def stop(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def send(client: httpx.AsyncClient, ta_url: str, student_id: str, question: str, stream: bool) -> float:
+    """Returns seconds until the full reply (or, when streaming, the first delta) arrived."""
+    payload = {"student_id": student_id, "message_text": question, "file_name": f"bench_{student_id}.ipynb",
+               "processed_logs": "Ran cell 4: df.groupby('condition').mean() -> KeyError"}
+    started = time.perf_counter()
+    if not stream:
+        response = await client.post(f"{ta_url}/receive_student_message", json=payload)
+        response.raise_for_status()
+        return time.perf_counter() - started
+    first_delta = None
+    async with client.stream("POST", f"{ta_url}/receive_student_message_stream", json=payload) as response:
+        response.raise_for_status()
+        # Read to the end so the whole generation is done, and counted, before the next question
+        async for line in response.aiter_lines():
+            if first_delta is None and line.startswith("data: ") and "delta" in json.loads(line[6:]):
+                first_delta = time.perf_counter() - started
+    return first_delta if first_delta is not None else time.perf_counter() - started
+
+
+async def run_load(ta_url: str, mode: str, concurrency: int, total: int, stream: bool) -> list:
+    latencies = []
+    remaining = iter(range(total))
+
+    async def student(client_id: int):
+        async with httpx.AsyncClient(timeout=300) as client:
+            for i in remaining:
+                # A new student per question, so no classification cache hits or history growth
+                latencies.append(await send(client, ta_url, f"bench-{mode}-{concurrency}-{i}",
+                                            f"{QUESTIONS[i % len(QUESTIONS)]} (case {i})", stream))
+
+    await asyncio.gather(*(student(c) for c in range(concurrency)))
+    return latencies
+
+
+def run_mode(mode: str, args) -> list:
+    """Starts stub, EA and TA for one pipeline mode and returns one result row per concurrency level."""
+    # A copy of inputs/ whose only A/B group selects the mode, since that is where it is configured per student
+    workdir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    shutil.copytree("./inputs", os.path.join(workdir, "inputs"))
+    experiments = {"active_experiment_id": "bench", "experiments": {"bench": {"groups": [{
+        "group_id": mode, "params": {"pipeline_mode": mode, "fused_classification": args.fused_classification,
+                                     "profile_hint_strategy": "enhanced_guidance"}}]}}}
+    with open(os.path.join(workdir, "inputs", "ab_experiments.json"), "w") as f:
+        json.dump(experiments, f)
+
+    llm_url = f"http://127.0.0.1:{args.llm_port}"
+    env = {**os.environ, "ollama_url": llm_url, "webui_api_key": "", "inputs_dir": "./inputs"}
+    log_file = open(os.path.join(workdir, "servers.log"), "w")
+    stub_command = [sys.executable, os.path.join(BENCHMARK_DIR, "stub_llm.py"), "--port", str(args.llm_port),
+                    "--prefill-ms-per-1k-chars", str(args.prefill_ms_per_1k_chars), "--ms-per-token", str(args.ms_per_token),
+                    "--ea-tokens", str(args.ea_tokens), "--response-tokens", str(args.response_tokens)]
+    processes = [start(stub_command, workdir, env, log_file)]
+    try:
+        wait_for(f"{llm_url}/stats", processes[0], 30)
+        if mode == "standard":
+            ea_command = [sys.executable, "-m", "uvicorn", "--app-dir", MIDDLEWARE_DIR, "ea-handler:app",
+                          "--host", "127.0.0.1", "--port", str(EA_PORT)]
+            processes.append(start(ea_command, workdir, env, log_file))
+            wait_for(f"http://127.0.0.1:{EA_PORT}/verify_ea", processes[-1], 120)
+        ta_command = [sys.executable, "-m", "uvicorn", "--app-dir", MIDDLEWARE_DIR, "ta-handler:app",
+                      "--host", "127.0.0.1", "--port", str(args.ta_port)]
+        processes.append(start(ta_command, workdir, env, log_file))
+        ta_url = f"http://127.0.0.1:{args.ta_port}"
+        wait_for(f"{ta_url}/verify_ta", processes[-1], 300)
+
+        rows = []
+        for concurrency in args.concurrency:
+            asyncio.run(run_load(ta_url, f"warmup-{mode}", 1, 1, args.stream))
+            httpx.post(f"{llm_url}/stats/reset").raise_for_status()
+            started = time.perf_counter()
+            latencies = asyncio.run(run_load(ta_url, mode, concurrency, args.requests, args.stream))
+            elapsed = time.perf_counter() - started
+            # Let background classification and profile updates finish before reading the stub's counters
+            time.sleep(1)
+            stats = httpx.get(f"{llm_url}/stats").json()
+            rows.append({
+                "mode": mode, "concurrency": concurrency,
+                "p50": percentile(latencies, 50) * 1000, "p95": percentile(latencies, 95) * 1000,
+                "throughput": len(latencies) / elapsed,
+                "calls": sum(s["requests"] for s in stats.values()) / len(latencies),
+                "prompt_chars": sum(s["prompt_chars"] for s in stats.values()) / len(latencies),
+                "tokens": sum(s["tokens"] for s in stats.values()) / len(latencies),
+                "busy": sum(s["busy_seconds"] for s in stats.values()) / len(latencies) * 1000,
+            })
+        return rows
+    finally:
+        for process in reversed(processes):
+            stop(process)
+        log_file.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20, help="Questions per mode and concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--modes", nargs="+", default=["standard", "fused"], choices=["standard", "fused"])
+    parser.add_argument("--stream", action="store_true", help="Measure time to the first streamed delta")
+    parser.add_argument("--fused-classification", action="store_true", help="Let the fused call classify too")
+    parser.add_argument("--llm-port", type=int, default=18434)
+    parser.add_argument("--ta-port", type=int, default=18004)
+    parser.add_argument("--prefill-ms-per-1k-chars", type=float, default=60)
+    parser.add_argument("--ms-per-token", type=float, default=25)
+    parser.add_argument("--ea-tokens", type=int, default=120)
+    parser.add_argument("--response-tokens", type=int, default=80)
+    args = parser.parse_args()
+
+    if not os.path.isdir("./inputs"):
+        sys.exit("Run from a directory with an inputs/ folder (the handlers read ./inputs).")
+
+    metric = "first delta" if args.stream else "full reply"
+    print(f"{args.requests} questions per run, latency to {metric}; stub: {args.prefill_ms_per_1k_chars} ms/1k prompt chars, "
+          f"{args.ms_per_token} ms/token, EA {args.ea_tokens} tokens, reply {args.response_tokens} tokens\n")
+    print(f"{'mode':<9} {'conc':>4} {'p50 ms':>8} {'p95 ms':>8} {'msg/s':>6} {'LLM calls':>9} {'prompt chars':>12} "
+          f"{'tokens':>7} {'LLM busy ms':>11}")
+    for mode in args.modes:
+        for r in run_mode(mode, args):
+            print(f"{r['mode']:<9} {r['concurrency']:>4} {r['p50']:>8.0f} {r['p95']:>8.0f} {r['throughput']:>6.2f} "
+                  f"{r['calls']:>9.1f} {r['prompt_chars']:>12.0f} {r['tokens']:>7.0f} {r['busy']:>11.0f}")
+
+
+if __name__ == "__main__":
+    main()
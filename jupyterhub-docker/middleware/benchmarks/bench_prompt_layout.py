@@ -0,0 +1,238 @@
+"""Prompt prefill with the previous prompt layout and with prompt_builder.py's static prefix.
+
+benchmarks/stub_llm.py runs with a prompt cache (`--cache-slots`, like the
+KV cache slots of llama.cpp or Ollama with OLLAMA_NUM_PARALLEL): a request
+only pays prefill for the characters after the longest prefix it shares
+with a cached prompt.
+
+Students of several assignments and A/B groups take turns in a seeded,
+interleaved order. Each turn sends the EA prompt and then the TA response
+prompt, built two ways:
+
+* legacy - the layout before prompt_builder.py: the student's profile hint
+           appended to the TA system prompt, the assignment inside the
+           per-turn user message (EA: system prompt, then everything else).
+* prefix - prompt_builder.py: system prompt, assignment and learning
+           objectives as a static prefix per assignment and group, followed
+           by history and a user message with everything that varies.
+
+The script reports prompt characters per call, the share served from the
+cache, the prefill time the stub spent and the p50/p95 latency per call.
+
+Usage (from the middleware directory):
+    python benchmarks/bench_prompt_layout.py --students 24 --rounds 3 --cache-slots 4
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import time
+
+import httpx
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+MIDDLEWARE_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, MIDDLEWARE_DIR)
+
+from prompt_builder import bullet_list, build_messages, static_prefix  # noqa: E402
+
+LAYOUTS = ("legacy", "prefix")
+QUESTIONS = [
+    "How do I compute the mean of a column grouped by condition?",
+    "Why does my t-test give a different p-value than the paper?",
+    "What is the difference between a paired and an independent t-test?",
+    "Can you just write the code for the plot in task 3?",
+    "How do I check whether my data is normally distributed?",
+    "What does this KeyError on 'reaction_time' mean?",
+]
+HINTS = [
+    "",
+    "\n**Profile Hint (Standard Support):** Continue providing JIT support with a positive and encouraging tone.",
+    "\n**Profile Hint (First Executive):** Gently guide the student towards reflection, without requiring direct rephrasing.",
+    "\n**Profile Hint (Positive Reinforcement):** Provide explicit positive reinforcement for asking an instrumental question.",
+]
+
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def read_sample(name: str, fallback: str) -> str:
+    for path in (os.path.join(MIDDLEWARE_DIR, "inputs", name), os.path.join(MIDDLEWARE_DIR, "inputs", name + ".sample")):
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                return f.read()
+    return fallback
+
+
+def course(args) -> dict:
+    """Assignment descriptions, learning objectives and per-group system prompts."""
+    ta_prompt = read_sample("ta_system_prompt.txt", "You are Juno, a programming tutor in JupyterLab.\n" * 20)
+    assignments = {}
+    for a in range(args.assignments):
+        sentence = f"In assignment {a + 1} students clean and analyse a reaction time dataset with pandas and scipy. "
+        assignments[f"assignment_{a + 1}"] = {
+            "description": (sentence * (args.assignment_chars // len(sentence) + 1))[:args.assignment_chars],
+            "learning_objectives": tuple(f"Objective {a + 1}.{i + 1}: apply step {i + 1} of the analysis correctly"
+                                         for i in range(args.learning_objectives)),
+        }
+    groups = {f"group_{g}": ta_prompt + ("" if g == 0 else f"\nVariant {g}: keep replies under 120 words.")
+              for g in range(args.groups)}
+    return {"assignments": assignments, "groups": groups,
+            "ea_prompt": read_sample("ea_system_prompt.txt", "You are an Expert Agent (EA).\n" * 10)}
+
+
+def legacy_prompts(ctx: dict, student: dict, question: str, logs: str) -> tuple:
+    assignment = ctx["assignments"][student["assignment"]]
+    lo = assignment["learning_objectives"][0]
+    ea = [
+        {"role": "system", "content": ctx["ea_prompt"]},
+        {"role": "user", "content": f"""[INTERNAL CONTEXT]
+    Assignment: {assignment["description"]}
+    Task Objective: {lo}
+    Recent Logs:
+    {logs}
+
+    Conversation History:
+    {student["history_text"]}
+    [END INTERNAL CONTEXT]
+
+    Student Question: {question}
+
+    ---
+    Based *only* on the 'Student Question' above and using the other information strictly as context, provide the concise technical information needed."""},
+    ]
+    ta = [{"role": "system", "content": ctx["groups"][student["group"]] + student["hint"] + "\n"}]
+    ta.extend(student["history"])
+    ta.append({"role": "user", "content": f"""
+            [INTERNAL CONTEXT: DO NOT REVEAL SOURCES]
+            Assignment: {assignment["description"]}
+            Recent Activity Logs:
+            {logs}
+            Technical Information: "(EA answer)"
+            Question Classification: instrumental
+            [END INTERNAL CONTEXT]
+
+            ---
+            Student Question: "{question}"
+            ---
+
+            Based on the context above (including profile hints and history), formulate your response as Juno."""})
+    return ea, ta
+
+
+def prefix_prompts(ctx: dict, student: dict, question: str, logs: str) -> tuple:
+    assignment = ctx["assignments"][student["assignment"]]
+    lo = assignment["learning_objectives"][0]
+    ea_prefix = static_prefix("bench", ctx["ea_prompt"], ("Assignment", assignment["description"]))
+    ea = build_messages("bench", "expert", ea_prefix, f"""[INTERNAL CONTEXT]
+    Task Objective: {lo}
+    Recent Logs:
+    {logs}
+
+    Conversation History:
+    {student["history_text"]}
+    [END INTERNAL CONTEXT]
+
+    Student Question: {question}
+
+    ---
+    Based *only* on the 'Student Question' above and using the other information strictly as context, provide the concise technical information needed.""")
+    ta_prefix = static_prefix("bench", ctx["groups"][student["group"]], ("Assignment", assignment["description"]),
+                              ("Learning Objectives", bullet_list(assignment["learning_objectives"])))
+    hint = f"\n            {student['hint'].strip()}" if student["hint"].strip() else ""
+    ta = build_messages("bench", "response", ta_prefix, f"""
+            [INTERNAL CONTEXT: DO NOT REVEAL SOURCES]
+            Recent Activity Logs:
+            {logs}
+            Technical Information: "(EA answer)"
+            Question Classification: instrumental{hint}
+            [END INTERNAL CONTEXT]
+
+            ---
+            Student Question: "{question}"
+            ---
+
+            Based on the context above (including profile hints and history), formulate your response as Juno.""",
+                        student["history"])
+    return ea, ta
+
+
+def run_layout(layout: str, ctx: dict, base_url: str, args) -> dict:
+    rng = random.Random(0)
+    assignments, groups = list(ctx["assignments"]), list(ctx["groups"])
+    students = [{"assignment": assignments[i % len(assignments)], "group": groups[(i // len(assignments)) % len(groups)],
+                 "history": [], "history_text": "", "hint": ""} for i in range(args.students)]
+    build = legacy_prompts if layout == "legacy" else prefix_prompts
+    latencies = {"ea": [], "response": []}
+    httpx.post(f"{base_url}/stats/reset")
+    with httpx.Client(timeout=120) as client:
+        for turn in range(args.rounds):
+            order = list(range(len(students)))
+            rng.shuffle(order)
+            for i in order:
+                student = students[i]
+                student["hint"] = rng.choice(HINTS)
+                question = rng.choice(QUESTIONS)
+                logs = f"[turn {turn}] executed cell {rng.randint(1, 40)}: df.groupby('condition').mean()\n" * 3
+                for kind, messages in zip(("ea", "response"), build(ctx, student, question, logs)):
+                    started = time.perf_counter()
+                    response = client.post(f"{base_url}/v1/chat/completions",
+                                           json={"model": "stub", "messages": messages, "stream": False, "max_tokens": args.response_tokens})
+                    response.raise_for_status()
+                    latencies[kind].append(time.perf_counter() - started)
+                student["history"] = (student["history"] + [{"role": "user", "content": question},
+                                                            {"role": "assistant", "content": "Try grouping first."}])[-6:]
+                student["history_text"] = "\n".join(f"{m['role']}: {m['content']}" for m in student["history"])
+    return {"latencies": latencies, "stats": httpx.get(f"{base_url}/stats").json()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=24)
+    parser.add_argument("--rounds", type=int, default=3, help="Turns per student")
+    parser.add_argument("--assignments", type=int, default=3)
+    parser.add_argument("--groups", type=int, default=2, help="A/B groups, each with its own TA system prompt")
+    parser.add_argument("--assignment-chars", type=int, default=3000, help="Length of each assignment description")
+    parser.add_argument("--learning-objectives", type=int, default=5)
+    parser.add_argument("--cache-slots", type=int, default=4, help="Prompts the stub keeps for prefix reuse")
+    parser.add_argument("--prefill-ms-per-1k-chars", type=float, default=60)
+    parser.add_argument("--ms-per-token", type=float, default=5)
+    parser.add_argument("--response-tokens", type=int, default=10)
+    parser.add_argument("--port", type=int, default=18451)
+    args = parser.parse_args()
+
+    process = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, "stub_llm.py"), "--port", str(args.port),
+                                "--cache-slots", str(args.cache_slots), "--ms-per-token", str(args.ms_per_token),
+                                "--prefill-ms-per-1k-chars", str(args.prefill_ms_per_1k_chars)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        for _ in range(100):
+            try:
+                httpx.get(f"{base_url}/stats", timeout=1)
+                break
+            except httpx.HTTPError:
+                time.sleep(0.1)
+        ctx = course(args)
+        print(f"{args.students} students x {args.rounds} turns over {args.assignments} assignments and {args.groups} groups, "
+              f"{args.cache_slots} cache slots, {args.prefill_ms_per_1k_chars:.0f} ms prefill per 1k chars\n")
+        print(f"{'layout':<7} {'call':<9} {'calls':>6} {'chars/call':>11} {'cached':>7} {'prefill s':>10} {'p50 ms':>7} {'p95 ms':>7}")
+        for layout in LAYOUTS:
+            result = run_layout(layout, ctx, base_url, args)
+            for kind, entry in sorted(result["stats"].items()):
+                latencies = result["latencies"][kind]
+                prefill = (entry["prompt_chars"] - entry["cached_chars"]) / 1000 * args.prefill_ms_per_1k_chars / 1000
+                print(f"{layout:<7} {kind:<9} {entry['requests']:>6} {entry['prompt_chars'] / entry['requests']:>11.0f} "
+                      f"{entry['cached_chars'] / entry['prompt_chars']:>7.0%} {prefill:>10.1f} "
+                      f"{percentile(latencies, 50) * 1000:>7.0f} {percentile(latencies, 95) * 1000:>7.0f}")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == "__main__":
+    main()
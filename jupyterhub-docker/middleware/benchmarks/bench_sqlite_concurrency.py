@@ -0,0 +1,149 @@
+"""Concurrency benchmark for the middleware's SQLite access layer.
+
+Simulates N students sending a message at the same time. Each simulated
+request performs the same database work as `receive_student_message`
+(profile read, history read, question insert, response insert,
+classification update) and the benchmark reports the p50/p95/p99 request
+latency plus the worst event-loop stall observed while the requests ran.
+
+Two modes are compared:
+
+* legacy - a fresh `sqlite3.connect()` per helper, executed synchronously
+  inside the coroutine (how ta-handler worked before db.py).
+* pooled - the `db.Database` layer: one long-lived WAL connection per worker,
+  driven from a dedicated thread.
+
+Usage:
+    python benchmarks/bench_sqlite_concurrency.py --students 200 --workers 4
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+from db import Database  # noqa: E402
+
+
+def legacy_request(path: str, student_id: str, file_name: str):
+    with sqlite3.connect(path) as conn:
+        conn.execute("SELECT * FROM student_profiles WHERE student_id = ? AND file_name = ?", (student_id, file_name)).fetchone()
+    with sqlite3.connect(path) as conn:
+        conn.execute("SELECT message_type, message_text FROM chat_history WHERE student_id = ? AND file_name = ? ORDER BY timestamp DESC LIMIT 6", (student_id, file_name)).fetchall()
+    for message_type in ("question", "response"):
+        with sqlite3.connect(path) as conn:
+            row_id = db.insert_message(conn, student_id, time.time(), message_type, f"{message_type} text", None, file_name)
+            conn.commit()
+        if message_type == "question":
+            question_id = row_id
+    with sqlite3.connect(path) as conn:
+        db.update_message_classification(conn, question_id, "instrumental")
+        conn.commit()
+
+
+async def pooled_request(database: Database, student_id: str, file_name: str):
+    await database.run(db.fetch_profile, student_id, file_name)
+    await database.run(db.fetch_recent_messages, student_id, file_name, 6)
+    question_id = await database.run(db.insert_message, student_id, time.time(), "question", "question text", None, file_name)
+    await database.run(db.insert_message, student_id, time.time(), "response", "response text", None, file_name)
+    await database.run(db.update_message_classification, question_id, "instrumental")
+
+
+async def watch_loop_lag(stop: asyncio.Event, interval: float = 0.005) -> float:
+    """Returns the longest delay between scheduled ticks of the event loop."""
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - started - interval)
+    return worst
+
+
+async def run_worker(mode: str, path: str, student_ids: list, start_at: float):
+    database = Database(path) if mode == "pooled" else None
+    latencies = []
+
+    async def one_student(student_id: str):
+        try:
+            if mode == "pooled":
+                await pooled_request(database, student_id, "Task.chat")
+            else:
+                legacy_request(path, student_id, "Task.chat")
+        except sqlite3.Error as e:
+            print(f"[{mode}] {student_id} failed: {e}", file=sys.stderr)
+            return
+        # Latency is measured from the moment every student "sent" the message
+        latencies.append(time.perf_counter() - arrived)
+
+    # Line all workers up so the writes really do land at the same time
+    await asyncio.sleep(max(0.0, start_at - time.time()))
+    arrived = time.perf_counter()
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(watch_loop_lag(stop))
+    await asyncio.gather(*(one_student(s) for s in student_ids))
+    stop.set()
+    worst_lag = await lag_task
+    if database:
+        database.close()
+    return latencies, worst_lag
+
+
+def worker_entry(args):
+    mode, path, student_ids, start_at = args
+    return asyncio.run(run_worker(mode, path, student_ids, start_at))
+
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def run_mode(mode: str, students: int, workers: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "chat_history.db")
+        setup = Database(path)
+        setup.run_sync(db.create_schema)
+        setup.close()
+
+        student_ids = [f"student_{i:04d}" for i in range(students)]
+        shards = [student_ids[i::workers] for i in range(workers)]
+        start_at = time.time() + 1.0
+        with multiprocessing.get_context("spawn").Pool(workers) as pool:
+            results = pool.map(worker_entry, [(mode, path, shard, start_at) for shard in shards])
+
+    latencies = [lat for shard_latencies, _ in results for lat in shard_latencies]
+    return {
+        "mode": mode,
+        "ok": len(latencies),
+        "p50": percentile(latencies, 50) * 1000,
+        "p95": percentile(latencies, 95) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+        "mean": statistics.mean(latencies) * 1000,
+        "loop_stall": max(lag for _, lag in results) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=200, help="Number of simulated students writing at once")
+    parser.add_argument("--workers", type=int, default=4, help="Number of worker processes (uvicorn --workers)")
+    parser.add_argument("--modes", nargs="+", default=["legacy", "pooled"], choices=["legacy", "pooled"])
+    args = parser.parse_args()
+
+    print(f"{args.students} students across {args.workers} workers\n")
+    print(f"{'mode':<8} {'ok':>5} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max loop stall ms':>18}")
+    for mode in args.modes:
+        r = run_mode(mode, args.students, args.workers)
+        print(f"{r['mode']:<8} {r['ok']:>5} {r['mean']:>9.1f} {r['p50']:>9.1f} {r['p95']:>9.1f} {r['p99']:>9.1f} {r['loop_stall']:>18.1f}")
+
+
+if __name__ == "__main__":
+    main()
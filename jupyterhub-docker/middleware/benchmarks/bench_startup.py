@@ -0,0 +1,143 @@
+"""Startup cost of the TA handler: import time, time-to-ready and per-worker memory.
+
+1. Import time: each heavy dependency is imported in a fresh interpreter.
+2. Server startup, once per mode:
+   * uvicorn - `uvicorn ta-handler:app --workers N`. Every worker imports
+     torch and loads the model itself.
+   * preload - `gunicorn ta-handler:app -c gunicorn.conf.py`. The parent loads
+     everything once and forks the workers afterwards.
+
+   Time-to-ready is the time from launch until all N workers have logged
+   "Application startup complete" and /verify_ta answers. Memory is read from
+   /proc for every server process (Linux only):
+   * RSS counts shared pages in full in every process.
+   * PSS splits shared pages between the processes that map them. The PSS
+     total is the real memory cost of the server.
+   * Private is memory only that process uses.
+
+Usage (from the middleware directory, where ta-handler.py and inputs/ live):
+    python benchmarks/bench_startup.py --workers 4
+"""
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+MIDDLEWARE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["torch", "sentence_transformers", "thefuzz.process", "numpy", "fastapi", "prometheus_client"]
+
+
+def import_seconds(module: str) -> float:
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=MIDDLEWARE_DIR)
+    if result.returncode != 0:
+        return float("nan")
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def read_memory_kb(pid: int) -> dict:
+    """RSS, PSS and private memory of a process in kB, from /proc/<pid>/smaps_rollup."""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                values[parts[0][:-1]] = int(parts[1])
+    return {
+        "rss": values.get("Rss", 0),
+        "pss": values.get("Pss", 0),
+        "private": values.get("Private_Clean", 0) + values.get("Private_Dirty", 0),
+    }
+
+
+def child_pids(parent: int) -> list:
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name can contain spaces; fields after ")" are fixed
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            with open(f"/proc/{entry}/cmdline", "rb") as f:
+                cmdline = f.read().replace(b"\0", b" ").decode(errors="replace")
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == parent and "resource_tracker" not in cmdline:
+            children.append(int(entry))
+    return sorted(children)
+
+
+def run_server(mode: str, workers: int, port: int, timeout: float) -> dict:
+    if mode == "uvicorn":
+        command = [sys.executable, "-m", "uvicorn", "ta-handler:app", "--workers", str(workers),
+                   "--host", "127.0.0.1", "--port", str(port)]
+    else:
+        command = [sys.executable, "-m", "gunicorn", "ta-handler:app", "-c", "gunicorn.conf.py"]
+    env = {**os.environ, "ta_bind": f"127.0.0.1:{port}", "ta_workers": str(workers), "ta_preload_app": "true"}
+
+    started = time.perf_counter()
+    server = subprocess.Popen(command, cwd=MIDDLEWARE_DIR, env=env, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, text=True)
+    ready_workers = []
+
+    def watch_output():
+        for line in server.stdout:
+            if "Application startup complete" in line:
+                ready_workers.append(time.perf_counter() - started)
+
+    threading.Thread(target=watch_output, daemon=True).start()
+    try:
+        while len(ready_workers) < workers:
+            if server.poll() is not None:
+                raise RuntimeError(f"{mode} server exited with code {server.returncode} during startup")
+            if time.perf_counter() - started > timeout:
+                raise RuntimeError(f"{mode} server: only {len(ready_workers)}/{workers} workers ready after {timeout:.0f}s")
+            time.sleep(0.05)
+        httpx.get(f"http://127.0.0.1:{port}/verify_ta", timeout=10).raise_for_status()
+        ready = time.perf_counter() - started
+        time.sleep(1)  # Let post-startup allocations settle
+        parent = read_memory_kb(server.pid)
+        worker_memory = [read_memory_kb(pid) for pid in child_pids(server.pid)]
+        return {"first_worker": ready_workers[0], "ready": ready, "parent": parent, "workers": worker_memory}
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def mb(kb: int) -> str:
+    return f"{kb / 1024:8.1f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=18004)
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for all workers")
+    parser.add_argument("--modes", nargs="+", default=["uvicorn", "preload"], choices=["uvicorn", "preload"])
+    args = parser.parse_args()
+
+    print("Import time (fresh interpreter):")
+    for module in HEAVY_MODULES:
+        print(f"  {module:<24} {import_seconds(module):6.2f} s")
+
+    for mode in args.modes:
+        result = run_server(mode, args.workers, args.port, args.timeout)
+        print(f"\n{mode}: first worker ready {result['first_worker']:.1f}s, all {args.workers} ready {result['ready']:.1f}s")
+        print(f"  {'process':<10} {'RSS MB':>8} {'PSS MB':>8} {'priv MB':>8}")
+        rows = [("parent", result["parent"])] + [(f"worker {i}", m) for i, m in enumerate(result["workers"], 1)]
+        for name, memory in rows:
+            print(f"  {name:<10} {mb(memory['rss'])} {mb(memory['pss'])} {mb(memory['private'])}")
+        total_pss = sum(memory["pss"] for _, memory in rows)
+        print(f"  {'total':<10} {'':>8} {mb(total_pss)}")
+
+
+if __name__ == "__main__":
+    main()
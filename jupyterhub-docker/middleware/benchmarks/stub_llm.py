@@ -0,0 +1,184 @@
+"""OpenAI-compatible stub LLM with a CPU-bound Ollama cost model.
+
+Each request first "prefills" its prompt (`--prefill-ms-per-1k-chars`) and then
+"decodes" its answer (`--ms-per-token`). Like Ollama with OLLAMA_NUM_PARALLEL=1
+on a CPU-only box, only one request is processed at a time; others queue.
+
+The answer depends on what is being asked:
+
+* classification prompts get a single label,
+* EA requests get `--ea-tokens` words of technical notes,
+* requests with `response_format` get a fused JSON object with the
+  technical notes, a label and `--response-tokens` words of reply,
+* anything else gets `--response-tokens` words of reply.
+
+A `max_tokens` field in the request overrides the length of EA and reply answers.
+
+To act as a misbehaving backend, `--slow-fraction` of requests stall for
+`--slow-ms` first, and after `--hang-after` seconds every request, including
+the `GET /v1/models` health check, hangs without an answer.
+
+With `--cache-slots N` the stub keeps the last N prompts like llama.cpp's
+(and Ollama's) per-slot KV cache: a request reuses the slot whose prompt
+shares the longest prefix with it, if that prefix covers more than half
+of the slot's prompt (llama.cpp's default --slot-prompt-similarity), and
+only prefills the characters after it. Otherwise it takes over the least
+recently used slot and prefills everything. Without it every prompt is
+prefilled in full.
+
+`GET /stats` reports requests, prompt characters (and how many of them came
+from the cache), generated tokens and busy seconds per kind;
+`POST /stats/reset` clears them and the cache.
+
+Usage (from the middleware directory):
+    python benchmarks/stub_llm.py --port 11434 --ms-per-token 25
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from collections import defaultdict
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+LABEL = "instrumental"
+# Sentence of the EA handler's user prompt
+EA_MARKER = "provide the concise technical information needed"
+# Share of a cached prompt a new one must start with to reuse its slot
+SLOT_PROMPT_SIMILARITY = 0.5
+WORDS = ("the", "dataframe", "column", "mean", "group", "function", "returns", "value", "so", "you", "can", "check", "each")
+
+
+def words(count: int) -> list:
+    return [WORDS[i % len(WORDS)] for i in range(count)]
+
+
+def prompt_text(messages: list) -> str:
+    """The prompt as the backend sees it after applying a chat template."""
+    return "".join(f"<|{m.get('role')}|>{m.get('content') or ''}<|end|>" for m in messages)
+
+
+def common_prefix_length(a: str, b: str) -> int:
+    return len(os.path.commonprefix([a, b]))
+
+
+def create_app(prefill_ms_per_1k_chars: float, ms_per_token: float, ea_tokens: int, response_tokens: int,
+               slow_fraction: float = 0, slow_ms: float = 0, hang_after: float = None, cache_slots: int = 0) -> FastAPI:
+    app = FastAPI()
+    gpu = asyncio.Lock()  # One request at a time, like a single Ollama runner
+    stats = defaultdict(lambda: {"requests": 0, "prompt_chars": 0, "cached_chars": 0, "tokens": 0, "busy_seconds": 0.0})
+    slots = []  # Cached prompts, least recently used first
+    started_at = time.monotonic()
+
+    def reuse_cache(prompt: str) -> int:
+        """Returns how many leading characters of `prompt` are already cached, and caches the prompt."""
+        if cache_slots <= 0:
+            return 0
+        best, cached = None, 0
+        for i, slot in enumerate(slots):
+            length = common_prefix_length(slot, prompt)
+            if length > cached and length > len(slot) * SLOT_PROMPT_SIMILARITY:
+                best, cached = i, length
+        if best is not None:
+            del slots[best]
+        elif len(slots) >= cache_slots:
+            del slots[0]
+        slots.append(prompt)
+        return cached
+
+    async def misbehave():
+        if hang_after is not None and time.monotonic() - started_at >= hang_after:
+            await asyncio.Event().wait()  # Never answers
+        if random.random() < slow_fraction:
+            await asyncio.sleep(slow_ms / 1000)
+
+    def answer(body: dict) -> tuple:
+        """Returns (kind, list of output tokens) for a chat completions request."""
+        messages = body.get("messages", [])
+        length = body.get("max_tokens")
+        if body.get("response_format"):
+            content = json.dumps({
+                "technical_answer": " ".join(words(ea_tokens)),
+                "classification": LABEL,
+                "response": " ".join(words(response_tokens)),
+            })
+            # Roughly one token per JSON word or punctuation run
+            return "fused", [piece + " " for piece in content.split(" ")]
+        if messages and "classif" in str(messages[0].get("content", "")).lower():
+            return "classification", [LABEL]
+        if messages and EA_MARKER in str(messages[-1].get("content", "")):
+            return "ea", [w + " " for w in words(length or ea_tokens)]
+        return "response", [w + " " for w in words(length or response_tokens)]
+
+    async def generate(body: dict, kind: str, tokens: list):
+        prompt_chars = sum(len(str(m.get("content", ""))) for m in body.get("messages", []))
+        async with gpu:
+            await misbehave()
+            started = time.perf_counter()
+            cached_chars = min(prompt_chars, reuse_cache(prompt_text(body.get("messages", []))))
+            await asyncio.sleep((prompt_chars - cached_chars) / 1000 * prefill_ms_per_1k_chars / 1000)
+            for token in tokens:
+                await asyncio.sleep(ms_per_token / 1000)
+                yield token
+            entry = stats[kind]
+            entry["requests"] += 1
+            entry["prompt_chars"] += prompt_chars
+            entry["cached_chars"] += cached_chars
+            entry["tokens"] += len(tokens)
+            entry["busy_seconds"] += time.perf_counter() - started
+
+    @app.post("/v1/chat/completions")
+    @app.post("/api/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        kind, tokens = answer(body)
+        if body.get("stream"):
+            async def events():
+                async for token in generate(body, kind, tokens):
+                    yield "data: " + json.dumps({"choices": [{"delta": {"content": token}}]}) + "\n\n"
+                yield "data: [DONE]\n\n"
+            return StreamingResponse(events(), media_type="text/event-stream")
+        content = "".join([token async for token in generate(body, kind, tokens)]).strip()
+        return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+    @app.get("/v1/models")
+    async def models():
+        await misbehave()
+        return {"object": "list", "data": [{"id": "stub", "object": "model"}]}
+
+    @app.get("/stats")
+    def get_stats():
+        return dict(stats)
+
+    @app.post("/stats/reset")
+    def reset_stats():
+        stats.clear()
+        slots.clear()
+        return {"status": "ok"}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--prefill-ms-per-1k-chars", type=float, default=60)
+    parser.add_argument("--ms-per-token", type=float, default=25)
+    parser.add_argument("--ea-tokens", type=int, default=120, help="Length of the EA's technical notes")
+    parser.add_argument("--response-tokens", type=int, default=80, help="Length of the reply to the student")
+    parser.add_argument("--slow-fraction", type=float, default=0, help="Share of requests that stall first")
+    parser.add_argument("--slow-ms", type=float, default=0)
+    parser.add_argument("--hang-after", type=float, default=None, help="Seconds after which the server stops answering")
+    parser.add_argument("--cache-slots", type=int, default=0, help="Prompts kept for prefix reuse (0 disables the prompt cache)")
+    args = parser.parse_args()
+    app = create_app(args.prefill_ms_per_1k_chars, args.ms_per_token, args.ea_tokens, args.response_tokens,
+                     args.slow_fraction, args.slow_ms, args.hang_after, args.cache_slots)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# classification_cache.py - Exact and near-duplicate cache for question classification
+import hashlib
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+from metrics import CLASSIFICATION_CACHE_ENTRIES, CLASSIFICATION_CACHE_INVALIDATIONS, CLASSIFICATION_CACHE_LOOKUPS
+
+# Use .env variables or fall back to defaults
+CLASSIFICATION_CACHE_ENABLED = os.getenv("classification_cache_enabled", "true").strip().lower() in ("1", "true", "yes")
+CLASSIFICATION_CACHE_SIZE = int(os.getenv("classification_cache_size", "2048"))
+CLASSIFICATION_CACHE_TTL_SECONDS = float(os.getenv("classification_cache_ttl_seconds", "86400"))
+# Cosine similarity above which a previously classified question counts as the same question
+CLASSIFICATION_CACHE_SIMILARITY = float(os.getenv("classification_cache_similarity", "0.92"))
+
+
+def classification_fingerprint(prompt: str, options: List[str]) -> str:
+    """Hash of the classification prompt and options; any edit to either changes it."""
+    return hashlib.sha256((prompt + "\x00" + "\n".join(options)).encode("utf-8")).hexdigest()
+
+
+def normalize_question(text: str) -> str:
+    """Lowercases, drops punctuation and collapses whitespace so trivial variants share a key."""
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class ClassificationCache:
+    """Two-tier LRU/TTL cache of classification labels for one worker.
+
+    Tier 1 is an exact match on the normalized question text. Tier 2 compares
+    the question's sentence embedding (the model already loaded for LO
+    selection) against every cached question and reuses the label of the
+    closest one if it is similar enough. All entries belong to one prompt
+    fingerprint; when the classification prompt or options change, the cache
+    is cleared instead of serving labels produced under the old prompt.
+    """
+
+    def __init__(self, max_entries: int = CLASSIFICATION_CACHE_SIZE, ttl_seconds: float = CLASSIFICATION_CACHE_TTL_SECONDS,
+                 similarity_threshold: float = CLASSIFICATION_CACHE_SIMILARITY):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._fingerprint: Optional[str] = None
+        # normalized question -> (label, stored_at, unit-length embedding or None)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._matrix: Optional[np.ndarray] = None
+        self._matrix_keys: List[str] = []
+
+    def _check_fingerprint(self, fingerprint: str):
+        if fingerprint != self._fingerprint:
+            if self._fingerprint is not None:
+                logging.info(f"Classification prompt or options changed. Clearing {len(self._entries)} cached classifications.")
+                CLASSIFICATION_CACHE_INVALIDATIONS.inc()
+            self._fingerprint = fingerprint
+            self._entries.clear()
+            self._matrix = None
+            CLASSIFICATION_CACHE_ENTRIES.set(0)
+
+    def _evict(self, key: str):
+        self._entries.pop(key, None)
+        self._matrix = None
+
+    def _semantic_index(self):
+        if self._matrix is None:
+            self._matrix_keys = [k for k, (_, _, emb) in self._entries.items() if emb is not None]
+            self._matrix = np.stack([self._entries[k][2] for k in self._matrix_keys]) if self._matrix_keys else None
+        return self._matrix, self._matrix_keys
+
+    def get(self, question: str, fingerprint: str, embedding: Optional[np.ndarray] = None) -> Optional[str]:
+        if not CLASSIFICATION_CACHE_ENABLED:
+            return None
+        self._check_fingerprint(fingerprint)
+        now = time.time()
+        key = normalize_question(question)
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            if now - entry[1] <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                CLASSIFICATION_CACHE_LOOKUPS.labels(result="exact_hit").inc()
+                return entry[0]
+            self._evict(key)
+
+        if embedding is not None:
+            matrix, keys = self._semantic_index()
+            if matrix is not None:
+                scores = matrix @ embedding
+                best = int(np.argmax(scores))
+                best_key = keys[best]
+                best_entry = self._entries.get(best_key)
+                if scores[best] >= self.similarity_threshold and best_entry is not None:
+                    if now - best_entry[1] <= self.ttl_seconds:
+                        self._entries.move_to_end(best_key)
+                        CLASSIFICATION_CACHE_LOOKUPS.labels(result="semantic_hit").inc()
+                        logging.info(f"Classification cache: near-duplicate match (similarity {scores[best]:.3f}) for '{question[:50]}'")
+                        return best_entry[0]
+                    self._evict(best_key)
+
+        CLASSIFICATION_CACHE_LOOKUPS.labels(result="miss").inc()
+        return None
+
+    def put(self, question: str, fingerprint: str, label: str, embedding: Optional[np.ndarray] = None):
+        if not CLASSIFICATION_CACHE_ENABLED:
+            return
+        self._check_fingerprint(fingerprint)
+        key = normalize_question(question)
+        self._entries[key] = (label, time.time(), embedding)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._matrix = None
+        CLASSIFICATION_CACHE_ENTRIES.set(len(self._entries))
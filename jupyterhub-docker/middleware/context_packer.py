@@ -0,0 +1,202 @@
+# context_packer.py - Fits the variable sections of a prompt into a per-model token budget
+import logging
+import math
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Union
+
+from metrics import CONTEXT_PROMPT_TOKENS, CONTEXT_TOKENS_SAVED
+
+# Use .env variables or fall back to defaults
+# Prompt tokens per LLM call (0 disables packing); leave room for the reply within the model's context window
+CONTEXT_TOKEN_BUDGET = int(os.getenv("context_token_budget", "3500"))
+# Per-model overrides, e.g. "gemma3:4b=3500,llama3.1:8b=12000"
+CONTEXT_TOKEN_BUDGETS = os.getenv("context_token_budgets", "")
+# Characters per token used to estimate prompt size (about 4 for English text with Gemma/Llama tokenizers)
+CONTEXT_CHARS_PER_TOKEN = float(os.getenv("context_chars_per_token", "4"))
+
+TRUNCATED_HEAD_MARKER = "\n[... truncated]"
+TRUNCATED_TAIL_MARKER = "[... earlier content omitted]\n"
+# Capped static texts remembered per worker (a few per assignment, model and prompt)
+CAP_CACHE_SIZE = 256
+
+Content = Union[str, List[dict]]
+
+
+@dataclass
+class Section:
+    """One part of a prompt competing for the budget.
+
+    `content` is text or a list of chat messages. Lower `priority` values get
+    spare budget first. `min_share` of the budget is kept for the section
+    before spare budget is handed out, and `fixed` sections are never cut.
+    When a section is cut, `keep="head"` keeps its beginning and
+    `keep="tail"` its end; for messages, "tail" keeps the most recent ones.
+    """
+    name: str
+    content: Content
+    priority: int
+    min_share: float = 0.0
+    keep: str = "head"
+    fixed: bool = False
+
+
+def parse_budgets(spec: str) -> Dict[str, int]:
+    budgets = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        model_name, _, budget = item.rpartition("=")
+        try:
+            budgets[model_name.strip()] = int(budget)
+        except ValueError:
+            logging.error(f"Ignoring invalid context_token_budgets entry '{item.strip()}'.")
+    return budgets
+
+
+def estimate_tokens(content: Content, chars_per_token: float = CONTEXT_CHARS_PER_TOKEN) -> int:
+    if isinstance(content, list):
+        # Chat templates add a few tokens of role markup per message
+        return sum(estimate_tokens(message.get("content") or "", chars_per_token) + 4 for message in content)
+    return math.ceil(len(content) / chars_per_token)
+
+
+def _cut_text(text: str, max_chars: int, keep: str) -> str:
+    """Shortens text to at most `max_chars`, preferring a line boundary, with a marker where content was removed."""
+    if len(text) <= max_chars:
+        return text
+    marker = TRUNCATED_TAIL_MARKER if keep == "tail" else TRUNCATED_HEAD_MARKER
+    room = max_chars - len(marker)
+    if room <= 0:
+        return ""
+    if keep == "tail":
+        kept = text[-room:]
+        newline = kept.find("\n")
+        # Start at a full line unless that would throw away most of what fits
+        if 0 <= newline < room // 5:
+            kept = kept[newline + 1:]
+        return marker + kept
+    kept = text[:room]
+    newline = kept.rfind("\n")
+    if newline > room * 4 // 5:
+        kept = kept[:newline]
+    return kept + marker
+
+
+class ContextPacker:
+    """Cuts prompt sections deterministically so a prompt stays within the model's token budget.
+
+    Tokens are estimated from the character count. If the sections fit, they
+    are returned unchanged. Otherwise every section first gets its fixed size
+    or its minimum share (the lowest-priority minimums shrink if those alone
+    overflow), then the rest of the budget goes to sections in priority
+    order. Sections are cut to what they were given: text keeps its head or
+    tail, message lists drop their oldest messages. Tokens removed are
+    counted per prompt and section.
+    """
+
+    def __init__(self, service: str, default_budget: int = CONTEXT_TOKEN_BUDGET, budgets: Dict[str, int] = None,
+                 chars_per_token: float = CONTEXT_CHARS_PER_TOKEN):
+        self.service = service
+        self.default_budget = default_budget
+        self.budgets = parse_budgets(CONTEXT_TOKEN_BUDGETS) if budgets is None else budgets
+        self.chars_per_token = max(1.0, chars_per_token)
+        self._capped: Dict[tuple, tuple] = {}  # (prompt, model, name, text, share, keep) -> (text, tokens saved)
+
+    def budget(self, model_name: str) -> int:
+        return self.budgets.get(model_name, self.default_budget)
+
+    def _allocate(self, sections: List[Section], sizes: Dict[str, int], budget: int) -> Dict[str, int]:
+        allocation = {}
+        available = budget
+        for section in sections:
+            size = sizes[section.name]
+            allocation[section.name] = size if section.fixed else min(size, int(section.min_share * budget))
+            available -= allocation[section.name]
+        by_priority = sorted((s for s in sections if not s.fixed), key=lambda s: s.priority)
+        # Minimum shares that do not fit come out of the lowest-priority sections first
+        for section in reversed(by_priority):
+            if available >= 0:
+                break
+            cut = min(allocation[section.name], -available)
+            allocation[section.name] -= cut
+            available += cut
+        for section in by_priority:
+            extra = min(sizes[section.name] - allocation[section.name], max(0, available))
+            allocation[section.name] += extra
+            available -= extra
+        return allocation
+
+    def _cut(self, section: Section, tokens: int) -> Content:
+        if isinstance(section.content, str):
+            return _cut_text(section.content, int(tokens * self.chars_per_token), section.keep)
+        messages = section.content if section.keep == "tail" else section.content[::-1]
+        kept, used = [], 0
+        for message in reversed(messages):
+            cost = estimate_tokens([message], self.chars_per_token)
+            if used + cost > tokens:
+                if not kept and tokens - used > 4:
+                    # Not even the newest message fits whole; keep its beginning
+                    content = _cut_text(message.get("content") or "", int((tokens - used - 4) * self.chars_per_token), "head")
+                    kept.append({**message, "content": content})
+                break
+            kept.append(message)
+            used += cost
+        return kept[::-1] if section.keep == "tail" else kept
+
+    def cap(self, prompt: str, model_name: str, name: str, text: str, share: float, keep: str = "head") -> str:
+        """Cuts `text` to `share` of the model's budget on its own, whatever the rest of the prompt holds.
+
+        Used for the static prompt prefix (see prompt_builder.py), which must
+        come out the same for every student; the result only depends on `text`,
+        so it is computed once per text and model. Shares are set so that only
+        unusually long input files are cut, and each cut is logged once.
+        """
+        key = (prompt, model_name, name, text, share, keep)
+        cached = self._capped.get(key)
+        if cached is None:
+            budget = self.budget(model_name)
+            tokens = estimate_tokens(text, self.chars_per_token)
+            limit = int(share * budget)
+            if budget <= 0 or tokens <= limit:
+                cached = (text, 0)
+            else:
+                cut = _cut_text(text, int(limit * self.chars_per_token), keep)
+                cached = (cut, tokens - estimate_tokens(cut, self.chars_per_token))
+                logging.warning(f"The {name} text of the {prompt} prompt has ~{tokens} tokens, over {share:.0%} of the "
+                                f"{budget}-token budget for {model_name}. Sending its {'beginning' if keep == 'head' else 'end'} "
+                                f"(~{limit} tokens); shorten the input file or raise the budget to send it whole.")
+            if len(self._capped) >= CAP_CACHE_SIZE:
+                self._capped.clear()
+            self._capped[key] = cached
+        capped, saved = cached
+        if saved:
+            CONTEXT_TOKENS_SAVED.labels(service=self.service, prompt=prompt, section=name).inc(saved)
+        return capped
+
+    def pack(self, prompt: str, model_name: str, sections: List[Section], template_tokens: int = 0) -> Dict[str, Content]:
+        """Returns each section's content by name, cut to fit `model_name`'s budget minus `template_tokens`.
+
+        `template_tokens` covers the fixed prompt text around the sections.
+        """
+        sizes = {section.name: estimate_tokens(section.content, self.chars_per_token) for section in sections}
+        total = sum(sizes.values()) + template_tokens
+        budget = self.budget(model_name)
+        if budget <= 0 or total <= budget:
+            CONTEXT_PROMPT_TOKENS.labels(service=self.service, prompt=prompt).observe(total)
+            return {section.name: section.content for section in sections}
+
+        allocation = self._allocate(sections, sizes, budget - template_tokens)
+        packed, saved = {}, {}
+        for section in sections:
+            content = section.content
+            if allocation[section.name] < sizes[section.name]:
+                content = self._cut(section, allocation[section.name])
+                saved[section.name] = sizes[section.name] - estimate_tokens(content, self.chars_per_token)
+                CONTEXT_TOKENS_SAVED.labels(service=self.service, prompt=prompt, section=section.name).inc(saved[section.name])
+            packed[section.name] = content
+        packed_total = sum(estimate_tokens(content, self.chars_per_token) for content in packed.values()) + template_tokens
+        CONTEXT_PROMPT_TOKENS.labels(service=self.service, prompt=prompt).observe(packed_total)
+        logging.info(f"Packed {prompt} prompt from ~{total} to ~{packed_total} tokens (budget {budget} for {model_name}); "
+                     f"cut {', '.join(f'{name} -{tokens}' for name, tokens in saved.items())}.")
+        return packed
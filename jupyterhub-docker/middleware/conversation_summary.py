@@ -0,0 +1,138 @@
+# conversation_summary.py - Rolling per-session conversation summaries, updated in the background
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+
+import db
+from db import Database
+from metrics import SUMMARY_UPDATE_SECONDS, SUMMARY_UPDATES
+
+# Use .env variables or fall back to defaults
+CONVERSATION_SUMMARY_ENABLED = os.getenv("conversation_summary_enabled", "true").strip().lower() in ("1", "true", "yes")
+# Messages always sent verbatim after the summary
+CONVERSATION_SUMMARY_RECENT_MESSAGES = int(os.getenv("conversation_summary_recent_messages", "6"))
+# Turns (question and response) that must fall out of the recent window before the summary is updated
+CONVERSATION_SUMMARY_EVERY_TURNS = int(os.getenv("conversation_summary_every_turns", "3"))
+CONVERSATION_SUMMARY_MAX_CHARS = int(os.getenv("conversation_summary_max_chars", "2000"))
+# Most older messages folded into a summary at once (the first summary of a long existing session starts here)
+CONVERSATION_SUMMARY_MAX_BATCH = 40
+
+SUMMARY_SYSTEM_PROMPT = """You maintain a running summary of a tutoring conversation between a student and Juno, a programming tutor in JupyterLab.
+Update the summary with the new messages. Keep what the student is working on, what they struggled with or misunderstood, what Juno explained or suggested, and any open questions.
+Write plain prose in the third person, at most 150 words. Reply with the updated summary only."""
+
+SessionKey = Tuple[str, str]  # (student_id, file_name)
+
+
+def build_summary_messages(previous_summary: Optional[str], messages: List[dict]) -> List[dict]:
+    """Prompt asking the model to fold `messages` ({"role", "content"}) into `previous_summary`."""
+    transcript = "\n".join(f"{'Student' if m['role'] == 'user' else 'Juno'}: {m['content']}" for m in messages)
+    return [
+        {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+        {"role": "user", "content": f"Summary so far:\n{previous_summary or '(none yet)'}\n\nNew messages:\n{transcript}"},
+    ]
+
+
+class ConversationSummarizer:
+    """Keeps a rolling summary of each (student, file) session in `conversation_summaries`.
+
+    Prompts get the summary plus the messages it does not cover yet, instead
+    of raw history. After each turn `request()` queues the session; a
+    background task checks whether at least `conversation_summary_every_turns`
+    turns have fallen out of the last `conversation_summary_recent_messages`
+    messages and, if so, asks `complete_fn` (the classification model, at
+    background priority) to fold them into the summary. Unsummarized messages
+    therefore never exceed `window` and the prompt stays bounded however long
+    the session runs.
+
+    The summary row records the last message it covers; a write only lands
+    if it covers more than the stored one, so workers summarizing the same
+    session at once cannot move it backwards.
+    """
+
+    def __init__(self, database: Database, complete_fn: Callable[[List[dict]], Awaitable[str]],
+                 enabled: bool = CONVERSATION_SUMMARY_ENABLED, recent_messages: int = CONVERSATION_SUMMARY_RECENT_MESSAGES,
+                 every_turns: int = CONVERSATION_SUMMARY_EVERY_TURNS, max_chars: int = CONVERSATION_SUMMARY_MAX_CHARS):
+        self.database = database
+        self.complete_fn = complete_fn
+        self.enabled = enabled
+        self.recent_messages = max(0, recent_messages)
+        self.fold_messages = 2 * max(1, every_turns)
+        self.max_chars = max_chars
+        self._pending: Set[SessionKey] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def window(self) -> int:
+        """Most messages sent verbatim with a summary."""
+        return self.recent_messages + self.fold_messages
+
+    async def get(self, student_id: str, file_name: str) -> Tuple[Optional[str], int]:
+        """Returns (summary or None, id of the last message it covers)."""
+        if not self.enabled:
+            return None, 0
+        row = await self.database.run(db.fetch_conversation_summary, student_id, file_name)
+        return (row["summary"], row["last_message_id"]) if row else (None, 0)
+
+    def request(self, student_id: str, file_name: str):
+        """Queues a check of the session after a turn; cheap, the work happens in the background."""
+        if self.enabled and self._wakeup is not None:
+            self._pending.add((student_id, file_name))
+            self._wakeup.set()
+
+    async def update(self, student_id: str, file_name: str) -> bool:
+        """Folds the messages that left the recent window into the summary; returns whether it changed."""
+        summary, last_message_id = await self.get(student_id, file_name)
+        rows = await self.database.run(db.fetch_recent_messages, student_id, file_name,
+                                       self.recent_messages + CONVERSATION_SUMMARY_MAX_BATCH, last_message_id)
+        rows = list(reversed(rows))[:max(0, len(rows) - self.recent_messages)]  # Chronological, without the recent window
+        if len(rows) < self.fold_messages:
+            return False
+        messages = [{"role": "user" if row["message_type"] == "question" else "assistant", "content": row["message_text"]}
+                    for row in rows]
+        started = time.perf_counter()
+        try:
+            new_summary = (await self.complete_fn(build_summary_messages(summary, messages))).strip()
+        except Exception as e:
+            SUMMARY_UPDATES.labels(outcome="failed").inc()
+            logging.warning(f"Could not update the conversation summary for {student_id} ({file_name}): {e}")
+            return False
+        if not new_summary:
+            SUMMARY_UPDATES.labels(outcome="failed").inc()
+            return False
+        await self.database.run(db.upsert_conversation_summary, student_id, file_name,
+                                new_summary[:self.max_chars], rows[-1]["id"], time.time())
+        SUMMARY_UPDATES.labels(outcome="updated").inc()
+        SUMMARY_UPDATE_SECONDS.observe(time.perf_counter() - started)
+        logging.info(f"Updated conversation summary for {student_id} ({file_name}) with {len(rows)} messages.")
+        return True
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # One session at a time, so summaries never compete with each other for the LLM
+            while self._pending:
+                student_id, file_name = self._pending.pop()
+                try:
+                    await self.update(student_id, file_name)
+                except Exception as e:
+                    logging.error(f"Conversation summary update failed for {student_id} ({file_name}): {e}")
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stops the background task; sessions still queued are summarized after their next turn."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
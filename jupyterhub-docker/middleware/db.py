@@ -0,0 +1,615 @@
+# db.py - Shared SQLite access layer for the middleware handlers
+import sqlite3
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Tuple
+
+# Use .env variables or fall back to defaults
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("sqlite_busy_timeout_ms", "5000"))
+SQLITE_LOCK_RETRIES = int(os.getenv("sqlite_lock_retries", "3"))
+SQLITE_STATEMENT_CACHE_SIZE = int(os.getenv("sqlite_statement_cache_size", "256"))
+
+
+class Database:
+    """Long-lived SQLite connection owned by a single dedicated thread.
+
+    Each worker process gets one connection (WAL mode, busy timeout, prepared
+    statement cache) that is only ever touched from one executor thread. Async
+    code awaits `run()`, which hands a unit of work to that thread so the event
+    loop never blocks on disk I/O or lock waits. Every unit of work runs in its
+    own transaction and is retried with backoff if SQLite reports the database
+    as locked after the busy timeout expires.
+
+    The executor and connection are created lazily and re-created after a
+    fork, so an instance built at import time is safe to share with workers.
+    """
+
+    def __init__(self, path: str, busy_timeout_ms: int = SQLITE_BUSY_TIMEOUT_MS,
+                 lock_retries: int = SQLITE_LOCK_RETRIES):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.lock_retries = lock_retries
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # Threads and connections do not survive a fork; start fresh in the child
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+                self._conn = None
+                self._pid = os.getpid()
+            return self._executor
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns the thread-confined connection, opening it on first use."""
+        if self._conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=self.busy_timeout_ms / 1000,
+                check_same_thread=False,
+                cached_statements=SQLITE_STATEMENT_CACHE_SIZE,
+            )
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+            self._conn = conn
+            logging.info(f"Opened SQLite connection to {self.path} (pid {os.getpid()}, WAL mode).")
+        return self._conn
+
+    def _run_unit(self, fn: Callable[..., Any], args: Tuple[Any, ...]) -> Any:
+        conn = self._connection()
+        attempt = 0
+        while True:
+            try:
+                with conn:  # Commits on success, rolls back on error
+                    return fn(conn, *args)
+            except sqlite3.OperationalError as e:
+                message = str(e).lower()
+                if ("locked" not in message and "busy" not in message) or attempt >= self.lock_retries:
+                    raise
+                attempt += 1
+                delay = 0.05 * (2 ** attempt)
+                logging.warning(f"SQLite busy during {getattr(fn, '__name__', 'query')} (attempt {attempt}/{self.lock_retries}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Runs `fn(conn, *args)` on the database thread without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), self._run_unit, fn, args)
+
+    def run_sync(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Runs `fn(conn, *args)` on the database thread and waits for the result.
+
+        Intended for startup code and synchronous background tasks; do not call
+        it from a coroutine.
+        """
+        return self._get_executor().submit(self._run_unit, fn, args).result()
+
+    def close(self):
+        """Closes the connection and stops the database thread."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is None:
+            return
+
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+        executor.submit(_close).result()
+        executor.shutdown(wait=True)
+
+
+# --- Schema ---
+# One column per profile field, so counters can be incremented in place and queried directly
+PROFILE_TABLE_DDL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        student_id TEXT NOT NULL,
+        file_name TEXT NOT NULL,
+        total_questions INTEGER NOT NULL DEFAULT 0,
+        instrumental_count INTEGER NOT NULL DEFAULT 0,
+        executive_count INTEGER NOT NULL DEFAULT 0,
+        other_count INTEGER NOT NULL DEFAULT 0,
+        last_interaction_timestamp REAL NOT NULL DEFAULT 0,
+        needs_guidance_flag INTEGER NOT NULL DEFAULT 0, -- 0/1
+        consecutive_executive_count INTEGER NOT NULL DEFAULT 0,
+        last_question_classification TEXT,
+        last_instrumental_example TEXT,
+        last_executive_example TEXT,
+        PRIMARY KEY (student_id, file_name)
+    )
+"""
+
+
+def migrate_json_profiles(conn: sqlite3.Connection):
+    """Converts a student_profiles table that still stores JSON blobs into the columnar layout.
+
+    Runs inside the caller's transaction and is a no-op once the table has
+    been converted, so concurrent workers starting at once are safe.
+    """
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(student_profiles)")]
+    if "profile_data" not in columns:
+        return
+    logging.info("Migrating student_profiles from JSON blobs to columns...")
+    conn.execute("DROP TABLE IF EXISTS student_profiles_columnar")
+    conn.execute(PROFILE_TABLE_DDL.format(table="student_profiles_columnar"))
+    conn.execute("""
+        INSERT INTO student_profiles_columnar (
+            student_id, file_name, total_questions, instrumental_count, executive_count, other_count,
+            last_interaction_timestamp, needs_guidance_flag, consecutive_executive_count,
+            last_question_classification, last_instrumental_example, last_executive_example
+        )
+        SELECT student_id, file_name,
+               COALESCE(json_extract(profile_data, '$.total_questions'), 0),
+               COALESCE(json_extract(profile_data, '$.instrumental_count'), 0),
+               COALESCE(json_extract(profile_data, '$.executive_count'), 0),
+               COALESCE(json_extract(profile_data, '$.other_count'), 0),
+               COALESCE(json_extract(profile_data, '$.last_interaction_timestamp'), 0),
+               COALESCE(json_extract(profile_data, '$.needs_guidance_flag'), 0),
+               COALESCE(json_extract(profile_data, '$.consecutive_executive_count'), 0),
+               json_extract(profile_data, '$.last_question_classification'),
+               json_extract(profile_data, '$.last_instrumental_example'),
+               json_extract(profile_data, '$.last_executive_example')
+        FROM student_profiles
+        WHERE json_valid(profile_data)
+    """)
+    skipped = conn.execute("SELECT COUNT(*) FROM student_profiles WHERE NOT json_valid(profile_data)").fetchone()[0]
+    conn.execute("DROP TABLE student_profiles")
+    conn.execute("ALTER TABLE student_profiles_columnar RENAME TO student_profiles")
+    migrated = conn.execute("SELECT COUNT(*) FROM student_profiles").fetchone()[0]
+    logging.info(f"Migrated {migrated} student profiles to columns ({skipped} rows with invalid JSON dropped).")
+
+
+def _create_base_tables(conn: sqlite3.Connection):
+    # Create chat history table (if not exists)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student_id TEXT NOT NULL,
+            timestamp REAL NOT NULL,
+            message_type TEXT NOT NULL, -- 'question' or 'response'
+            message_text TEXT NOT NULL,
+            message_classification TEXT, -- 'instrumental', 'executive', 'other', or NULL for responses
+            file_name TEXT,
+            classification_source TEXT -- Who produced message_classification, see CLASSIFICATION_SOURCES
+        )
+    """)
+    # Databases created before the column existed; their questions have no source
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(chat_history)")]
+    if "classification_source" not in columns:
+        conn.execute("ALTER TABLE chat_history ADD COLUMN classification_source TEXT")
+    # Create student profiles table (if not exists)
+    conn.execute(PROFILE_TABLE_DDL.format(table="student_profiles"))
+    # Create student experiment assignments table (if not exists)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS student_experiment_assignments (
+            student_id TEXT NOT NULL,
+            experiment_id TEXT NOT NULL,
+            group_id TEXT NOT NULL,
+            assigned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (student_id, experiment_id)
+        )
+    """)
+
+
+def _add_chat_history_indexes(conn: sqlite3.Connection):
+    # History reads, session stats and the report all filter on (student, file) and order by time
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_chat_history_student_file_time
+        ON chat_history (student_id, file_name, timestamp)
+    """)
+    # Analytics count questions vs. responses and group questions by classification
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_chat_history_type_classification
+        ON chat_history (message_type, message_classification)
+    """)
+
+
+def _create_conversation_summaries(conn: sqlite3.Connection):
+    # Rolling summary of each session; covers chat_history rows up to last_message_id (see conversation_summary.py)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            student_id TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (student_id, file_name)
+        )
+    """)
+
+
+def _create_report_jobs(conn: sqlite3.Connection):
+    # Background /report generation and its cached result (see report_jobs.py)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS report_jobs (
+            job_id TEXT PRIMARY KEY,
+            student_id TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            data_fingerprint TEXT NOT NULL, -- last chat_history id and activity logs the report is based on
+            status TEXT NOT NULL, -- queued, running, done, failed
+            stage TEXT,
+            report TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_report_jobs_session ON report_jobs (student_id, file_name, created_at)")
+
+
+def _create_lo_activity(conn: sqlite3.Connection):
+    # Running totals per (student, assignment, learning objective), one row per metric (see activity_aggregates.py)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS lo_activity (
+            student_id TEXT NOT NULL,
+            assignment_id TEXT NOT NULL,
+            learning_objective TEXT NOT NULL,
+            metric TEXT NOT NULL, -- e.g. executions, error:NameError, question:instrumental, active_seconds
+            value REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (student_id, assignment_id, learning_objective, metric)
+        )
+    """)
+    # Last log event counted per session, so log events sent again are not counted twice
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS activity_cursors (
+            student_id TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            last_event_time TEXT NOT NULL,
+            events_at_last_time INTEGER NOT NULL, -- events already counted with last_event_time
+            last_event_at REAL, -- last_event_time in epoch seconds, for time on task
+            learning_objective TEXT, -- objective of the latest question; later log events count towards it
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (student_id, file_name)
+        )
+    """)
+
+
+def _create_experiment_group_history(conn: sqlite3.Connection):
+    # Every group a student was ever computed into per experiment; student_experiment_assignments keeps the first
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS experiment_group_history (
+            student_id TEXT NOT NULL,
+            experiment_id TEXT NOT NULL,
+            group_id TEXT NOT NULL,
+            first_seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (student_id, experiment_id, group_id)
+        )
+    """)
+    conn.execute("""
+        INSERT OR IGNORE INTO experiment_group_history (student_id, experiment_id, group_id, first_seen_at)
+        SELECT student_id, experiment_id, group_id, assigned_at FROM student_experiment_assignments
+    """)
+
+
+def _create_session_summary(conn: sqlite3.Connection):
+    # First/last interaction and message counts per (student, file), so /qualtrics-finish is one primary-key lookup
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS session_summary (
+            student_id TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            first_interaction REAL NOT NULL,
+            last_interaction REAL NOT NULL,
+            question_count INTEGER NOT NULL,
+            response_count INTEGER NOT NULL,
+            PRIMARY KEY (student_id, file_name)
+        )
+    """)
+    # Kept current by a trigger, so every chat_history insert updates it in the same transaction
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_chat_history_session_summary
+        AFTER INSERT ON chat_history
+        WHEN NEW.file_name IS NOT NULL
+        BEGIN
+            INSERT INTO session_summary (student_id, file_name, first_interaction, last_interaction, question_count, response_count)
+            VALUES (NEW.student_id, NEW.file_name, NEW.timestamp, NEW.timestamp,
+                    NEW.message_type = 'question', NEW.message_type = 'response')
+            ON CONFLICT (student_id, file_name) DO UPDATE SET
+                first_interaction = MIN(first_interaction, excluded.first_interaction),
+                last_interaction = MAX(last_interaction, excluded.last_interaction),
+                question_count = question_count + excluded.question_count,
+                response_count = response_count + excluded.response_count;
+        END
+    """)
+    # Existing history; replaces rows so the step can run again
+    conn.execute("""
+        INSERT OR REPLACE INTO session_summary (student_id, file_name, first_interaction, last_interaction, question_count, response_count)
+        SELECT student_id, file_name, MIN(timestamp), MAX(timestamp),
+               COUNT(CASE WHEN message_type = 'question' THEN 1 END),
+               COUNT(CASE WHEN message_type = 'response' THEN 1 END)
+        FROM chat_history
+        WHERE file_name IS NOT NULL
+        GROUP BY student_id, file_name
+    """)
+
+
+# Ordered (version, description, step). The database's PRAGMA user_version records the last
+# step applied; append new steps at the end and never edit one that has shipped.
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "base tables", _create_base_tables),
+    (2, "columnar student profiles", migrate_json_profiles),
+    (3, "chat_history indexes", _add_chat_history_indexes),
+    (4, "conversation summaries", _create_conversation_summaries),
+    (5, "report jobs", _create_report_jobs),
+    (6, "learning objective activity", _create_lo_activity),
+    (7, "experiment group history", _create_experiment_group_history),
+    (8, "session summary", _create_session_summary),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def create_schema(conn: sqlite3.Connection, target_version: int = SCHEMA_VERSION):
+    """Brings the database up to `target_version` by applying any pending migrations.
+
+    Databases created before versioning report user_version 0. Every step is
+    idempotent (CREATE ... IF NOT EXISTS, layout checks), so they simply run
+    through all steps once.
+    """
+    # Take the write lock up front so schema changes are atomic and workers starting together run them one at a time
+    conn.execute("BEGIN IMMEDIATE")
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, description, step in MIGRATIONS:
+        if current < version <= target_version:
+            started = time.perf_counter()
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+            logging.info(f"Applied schema migration {version} ({description}) in {time.perf_counter() - started:.2f}s.")
+
+
+# --- Chat History ---
+def insert_message(conn: sqlite3.Connection, student_id: str, timestamp: float, message_type: str,
+                   message_text: str, message_classification: Optional[str], file_name: Optional[str]) -> int:
+    cursor = conn.execute("""
+        INSERT INTO chat_history (student_id, timestamp, message_type, message_text, message_classification, file_name)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (student_id, timestamp, message_type, message_text, message_classification, file_name))
+    return cursor.lastrowid
+
+
+def fetch_recent_messages(conn: sqlite3.Connection, student_id: str, file_name: str, limit: int,
+                          after_id: int = 0) -> List[sqlite3.Row]:
+    """Returns the last `limit` messages for a student and file with an id above `after_id`, newest first."""
+    return conn.execute("""
+        SELECT id, message_type, message_text
+        FROM chat_history
+        WHERE student_id = ? AND file_name = ? AND id > ?
+        ORDER BY timestamp DESC
+        LIMIT ?
+    """, (student_id, file_name, after_id, limit)).fetchall()
+
+
+# Values of chat_history.classification_source: the classification LLM, the fused response call,
+# the local kNN model, a classification cache hit, or the 'other' fallback after a failed or invalid answer
+CLASSIFICATION_SOURCES = ("llm", "fused", "local", "cache", "default")
+# Sources whose labels the local classifier may learn from
+LLM_CLASSIFICATION_SOURCES = ("llm", "fused")
+
+
+def update_message_classification(conn: sqlite3.Connection, message_id: int, classification: str, source: Optional[str] = None):
+    conn.execute("UPDATE chat_history SET message_classification = ?, classification_source = ? WHERE id = ?",
+                 (classification, source, message_id))
+
+
+def fetch_labeled_questions(conn: sqlite3.Connection, limit: int) -> List[sqlite3.Row]:
+    """Returns up to `limit` questions labeled by an LLM, newest first.
+
+    Labels from the local model, cache reuses and fallbacks are left out, so
+    retraining never learns from its own predictions or from error defaults.
+    """
+    return conn.execute(f"""
+        SELECT message_text, message_classification
+        FROM chat_history
+        WHERE message_type = 'question' AND message_classification IS NOT NULL
+              AND classification_source IN ({", ".join("?" for _ in LLM_CLASSIFICATION_SOURCES)})
+        ORDER BY timestamp DESC
+        LIMIT ?
+    """, (*LLM_CLASSIFICATION_SOURCES, limit)).fetchall()
+
+
+def fetch_session_summary(conn: sqlite3.Connection, student_id: str, file_name: str) -> Optional[sqlite3.Row]:
+    """Returns the first and last interaction timestamps and message counts for a student and file."""
+    return conn.execute("""
+        SELECT first_interaction, last_interaction, question_count, response_count
+        FROM session_summary
+        WHERE student_id = ? AND file_name = ?
+    """, (student_id, file_name)).fetchone()
+
+
+def fetch_last_message_id(conn: sqlite3.Connection, student_id: str, file_name: str) -> int:
+    row = conn.execute("SELECT MAX(id) FROM chat_history WHERE student_id = ? AND file_name = ?",
+                       (student_id, file_name)).fetchone()
+    return row[0] or 0
+
+
+# --- Conversation Summaries ---
+def fetch_conversation_summary(conn: sqlite3.Connection, student_id: str, file_name: str) -> Optional[sqlite3.Row]:
+    return conn.execute("""
+        SELECT summary, last_message_id FROM conversation_summaries
+        WHERE student_id = ? AND file_name = ?
+    """, (student_id, file_name)).fetchone()
+
+
+def upsert_conversation_summary(conn: sqlite3.Connection, student_id: str, file_name: str, summary: str,
+                                last_message_id: int, updated_at: float):
+    """Stores a summary unless another worker already stored one covering more messages."""
+    conn.execute("""
+        INSERT INTO conversation_summaries (student_id, file_name, summary, last_message_id, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (student_id, file_name) DO UPDATE SET
+            summary = excluded.summary,
+            last_message_id = excluded.last_message_id,
+            updated_at = excluded.updated_at
+        WHERE excluded.last_message_id > conversation_summaries.last_message_id
+    """, (student_id, file_name, summary, last_message_id, updated_at))
+
+
+# --- Report Jobs ---
+def claim_report_job(conn: sqlite3.Connection, job_id: str, student_id: str, file_name: str, fingerprint: str,
+                     now: float, stale_before: float, keep: int) -> sqlite3.Row:
+    """Returns the session's usable job for `fingerprint`, or creates `job_id` as queued and returns it.
+
+    A job is usable when it is done, or queued or running with an update
+    since `stale_before`. Only the `keep` newest jobs of the session are kept.
+    """
+    # Take the write lock first, so workers handling the same /report at once agree on one job
+    conn.execute("BEGIN IMMEDIATE")
+    row = conn.execute("""
+        SELECT * FROM report_jobs
+        WHERE student_id = ? AND file_name = ? AND data_fingerprint = ?
+          AND (status = 'done' OR (status IN ('queued', 'running') AND updated_at >= ?))
+        ORDER BY created_at DESC
+        LIMIT 1
+    """, (student_id, file_name, fingerprint, stale_before)).fetchone()
+    if row is not None:
+        return row
+    conn.execute("""
+        INSERT INTO report_jobs (job_id, student_id, file_name, data_fingerprint, status, stage, created_at, updated_at)
+        VALUES (?, ?, ?, ?, 'queued', 'queued', ?, ?)
+    """, (job_id, student_id, file_name, fingerprint, now, now))
+    conn.execute("""
+        DELETE FROM report_jobs
+        WHERE student_id = ? AND file_name = ? AND job_id NOT IN (
+            SELECT job_id FROM report_jobs WHERE student_id = ? AND file_name = ? ORDER BY created_at DESC LIMIT ?
+        )
+    """, (student_id, file_name, student_id, file_name, keep))
+    return conn.execute("SELECT * FROM report_jobs WHERE job_id = ?", (job_id,)).fetchone()
+
+
+def update_report_job(conn: sqlite3.Connection, job_id: str, status: str, stage: str, now: float,
+                      report: Optional[str] = None, error: Optional[str] = None):
+    conn.execute("""
+        UPDATE report_jobs SET status = ?, stage = ?, report = ?, error = ?, updated_at = ?
+        WHERE job_id = ?
+    """, (status, stage, report, error, now, job_id))
+
+
+def fetch_report_job(conn: sqlite3.Connection, job_id: str) -> Optional[sqlite3.Row]:
+    return conn.execute("SELECT * FROM report_jobs WHERE job_id = ?", (job_id,)).fetchone()
+
+
+# --- Learning Objective Activity ---
+def fetch_activity_cursor(conn: sqlite3.Connection, student_id: str, file_name: str) -> Optional[sqlite3.Row]:
+    return conn.execute("""
+        SELECT last_event_time, events_at_last_time, last_event_at, learning_objective FROM activity_cursors
+        WHERE student_id = ? AND file_name = ?
+    """, (student_id, file_name)).fetchone()
+
+
+def upsert_activity_cursor(conn: sqlite3.Connection, student_id: str, file_name: str, last_event_time: str,
+                           events_at_last_time: int, last_event_at: Optional[float], learning_objective: Optional[str],
+                           updated_at: float):
+    conn.execute("""
+        INSERT INTO activity_cursors (student_id, file_name, last_event_time, events_at_last_time, last_event_at,
+                                      learning_objective, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (student_id, file_name) DO UPDATE SET
+            last_event_time = excluded.last_event_time,
+            events_at_last_time = excluded.events_at_last_time,
+            last_event_at = excluded.last_event_at,
+            learning_objective = excluded.learning_objective,
+            updated_at = excluded.updated_at
+    """, (student_id, file_name, last_event_time, events_at_last_time, last_event_at, learning_objective, updated_at))
+
+
+def add_lo_activity(conn: sqlite3.Connection, rows: List[tuple]):
+    """Adds (student_id, assignment_id, learning_objective, metric, value, updated_at) rows to the running totals."""
+    conn.executemany("""
+        INSERT INTO lo_activity (student_id, assignment_id, learning_objective, metric, value, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (student_id, assignment_id, learning_objective, metric) DO UPDATE SET
+            value = value + excluded.value,
+            updated_at = excluded.updated_at
+    """, rows)
+
+
+def fetch_lo_activity(conn: sqlite3.Connection, student_id: str, assignment_id: str) -> List[sqlite3.Row]:
+    return conn.execute("""
+        SELECT learning_objective, metric, value FROM lo_activity
+        WHERE student_id = ? AND assignment_id = ?
+    """, (student_id, assignment_id)).fetchall()
+
+
+# --- Student Profiles ---
+def fetch_profile(conn: sqlite3.Connection, student_id: str, file_name: str) -> Optional[sqlite3.Row]:
+    return conn.execute(
+        "SELECT * FROM student_profiles WHERE student_id = ? AND file_name = ?",
+        (student_id, file_name)
+    ).fetchone()
+
+
+# Counters are incremented in place and the guidance flag is recomputed from the new counts in the
+# same statement, so no read is needed and concurrent writers cannot lose each other's updates.
+# In DO UPDATE, bare column names refer to the stored row.
+UPSERT_PROFILE_DELTA_SQL = """
+    INSERT INTO student_profiles (
+        student_id, file_name, total_questions, instrumental_count, executive_count, other_count,
+        last_interaction_timestamp, needs_guidance_flag, consecutive_executive_count,
+        last_question_classification, last_instrumental_example, last_executive_example
+    )
+    VALUES (
+        :student_id, :file_name, :total_questions, :instrumental_count, :executive_count, :other_count,
+        :last_interaction_timestamp,
+        (:instrumental_count + :executive_count) > :guidance_min_questions
+            AND :executive_count > :guidance_executive_ratio * (:instrumental_count + :executive_count),
+        COALESCE(:consecutive_executive_count, 0),
+        :last_question_classification, :last_instrumental_example, :last_executive_example
+    )
+    ON CONFLICT (student_id, file_name) DO UPDATE SET
+        total_questions = total_questions + :total_questions,
+        instrumental_count = instrumental_count + :instrumental_count,
+        executive_count = executive_count + :executive_count,
+        other_count = other_count + :other_count,
+        last_interaction_timestamp = MAX(last_interaction_timestamp, :last_interaction_timestamp),
+        needs_guidance_flag =
+            (instrumental_count + :instrumental_count + executive_count + :executive_count) > :guidance_min_questions
+            AND (executive_count + :executive_count) > :guidance_executive_ratio * (instrumental_count + :instrumental_count + executive_count + :executive_count),
+        consecutive_executive_count = COALESCE(:consecutive_executive_count, consecutive_executive_count),
+        last_question_classification = COALESCE(:last_question_classification, last_question_classification),
+        last_instrumental_example = COALESCE(:last_instrumental_example, last_instrumental_example),
+        last_executive_example = COALESCE(:last_executive_example, last_executive_example)
+"""
+
+
+def upsert_profile_deltas(conn: sqlite3.Connection, rows: List[dict]):
+    """Applies a batch of profile deltas; each dict carries the named parameters of UPSERT_PROFILE_DELTA_SQL."""
+    conn.executemany(UPSERT_PROFILE_DELTA_SQL, rows)
+
+
+# --- Experiment Assignments ---
+def record_experiment_assignments(conn: sqlite3.Connection, rows: List[Tuple[str, str, str]]) -> List[Tuple[str, str, str, str]]:
+    """Records (student_id, experiment_id, group_id) rows without overwriting a student's first assignment.
+
+    Every group a student is computed into is added to experiment_group_history.
+    Returns (student_id, experiment_id, first group_id, new group_id) for
+    students whose group differs from their first one for the first time.
+    """
+    changes = []
+    for student_id, experiment_id, group_id in rows:
+        conn.execute("""
+            INSERT INTO student_experiment_assignments (student_id, experiment_id, group_id)
+            VALUES (?, ?, ?)
+            ON CONFLICT (student_id, experiment_id) DO NOTHING
+        """, (student_id, experiment_id, group_id))
+        new_group = conn.execute("""
+            INSERT INTO experiment_group_history (student_id, experiment_id, group_id)
+            VALUES (?, ?, ?)
+            ON CONFLICT (student_id, experiment_id, group_id) DO NOTHING
+        """, (student_id, experiment_id, group_id)).rowcount
+        if not new_group:
+            continue
+        first_group = conn.execute(
+            "SELECT group_id FROM student_experiment_assignments WHERE student_id = ? AND experiment_id = ?",
+            (student_id, experiment_id)).fetchone()[0]
+        if first_group != group_id:
+            changes.append((student_id, experiment_id, first_group, group_id))
+    return changes
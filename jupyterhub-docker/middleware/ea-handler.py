@@ -6,11 +6,23 @@ import uvicorn
 import httpx
 import os
 import json
+import time
 from dotenv import load_dotenv
-from typing import Optional # Added Optional
+from typing import List, Optional # Added Optional
+from contextlib import asynccontextmanager
 
 # --- Configuration ---
 load_dotenv() # Load environment variables from .env file
+# Local modules read their settings at import time, so import them after .env is loaded
+from context_packer import ContextPacker, Section
+from ea_cache import EACache, ea_cache_fingerprint
+from http_pool import HttpPool
+from inputs_snapshot import InputsStore
+from llm_backends import LLM_BACKENDS_FILE, Backend, BackendPool, NoBackendAvailable, default_backend, load_backends
+from llm_scheduler import LLMScheduler, SchedulerRejected
+from metrics import FALLBACKS, REQUEST_SECONDS, metrics_response, time_stage
+from prompt_builder import build_messages, keep_alive_fields, static_prefix
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - EA - %(message)s')
 
 # LLM Configuration (similar to TA)
@@ -29,7 +41,32 @@ EA_SYSTEM_PROMPT_DEFAULT = """You are an Expert Agent (EA). Your primary role is
 logging.info(f"EA Using WebUI Base URL: {WEBUI_API_BASE}")
 logging.info(f"EA Using Model: {EA_MODEL_NAME}")
 
-app = FastAPI(title="Expert Agent (LLM-Powered)")
+# Shared keep-alive client for LLM calls, one per worker
+HTTP = HttpPool("ea")
+# Shares per-backend slot limits with the TA's workers (see llm_scheduler.py)
+LLM_SCHEDULER = LLMScheduler("ea")
+# Same backends file as the TA, or the single WebUI/Ollama backend from .env
+LLM_POOL = BackendPool("ea", load_backends(LLM_BACKENDS_FILE, default_backend(WEBUI_API_BASE, WEBUI_API_KEY, OLLAMA_API_BASE)))
+# inputs/ read once and hot-reloaded on change (see inputs_snapshot.py)
+INPUTS = InputsStore()
+# Keeps the EA prompt within the EA model's token budget (see context_packer.py)
+CONTEXT_PACKER = ContextPacker("ea")
+# Answers shared across students asking the same question (off unless ea_cache_enabled, see ea_cache.py)
+EA_CACHE = EACache()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await HTTP.start()
+    LLM_POOL.start(HTTP.client)
+    INPUTS.start()
+    await EA_CACHE.start()
+    yield
+    await INPUTS.stop()
+    await LLM_POOL.stop()
+    await HTTP.close()
+    EA_CACHE.close()
+
+app = FastAPI(title="Expert Agent (LLM-Powered)", lifespan=lifespan)
 
 # --- Updated Pydantic Model ---
 class ExpertQueryPayload(BaseModel): # Renamed and updated model
@@ -39,39 +76,49 @@ class ExpertQueryPayload(BaseModel): # Renamed and updated model
     history: str # Expecting the formatted string from TA
     logs: str
     session_id: str
+    # Optional, for the answer cache: the TA's embedding of the question and the model that computed it
+    assignment_id: Optional[str] = None
+    question_embedding: Optional[List[float]] = None
+    embedding_model: Optional[str] = None
+    # Seconds the TA waits for this answer; the EA stops waiting for an LLM slot after that
+    timeout_seconds: Optional[float] = None
 
 # --- LLM Calling Helper ---
-async def call_ea_llm(messages: list) -> str:
-    """Calls the configured LLM API (WebUI or Ollama) for the EA."""
-    if WEBUI_API_KEY == "":
-        logging.warning("EA: No WebUI API key provided. Defaulting to Ollama API.")
-        target_url = f"{OLLAMA_API_BASE}/v1/chat/completions"
-        headers={"Content-Type": "application/json", "Accept": "application/json"}
-        logging.debug(f"EA Calling Ollama ({EA_MODEL_NAME}) at {target_url}")
-    else:
-        logging.info(f"EA Using WebUI API for LLM calls.")
-        target_url = f"{WEBUI_API_BASE}/api/chat/completions"
-        headers={"Content-Type": "application/json", "Accept": "application/json", "Authorization": f"Bearer {WEBUI_API_KEY}"}
-        logging.debug(f"EA Calling WebUI ({EA_MODEL_NAME}) at {target_url}")
+async def call_ea_llm(messages: list, deadline: Optional[float] = None) -> str:
+    """Calls an LLM backend from the pool (WebUI or Ollama by default, see llm_backends.py) for the EA.
 
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                target_url,
-                headers=headers,
-                json={"model": EA_MODEL_NAME, "messages": messages, "stream": False},
+    `deadline` (time.monotonic()) is when the caller stops waiting. The call
+    does not wait for a slot past it, so a request the TA already gave up on
+    does not take a slot that students are queueing for.
+    """
+    async def send(backend: Backend) -> dict:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            raise SchedulerRejected("timeout", backend.name, "ea")
+        logging.debug(f"EA Calling {backend.name} ({EA_MODEL_NAME}) at {backend.chat_url}")
+        async with LLM_SCHEDULER.slot(backend.chat_url, "ea", timeout=remaining):
+            response = await HTTP.post(
+                backend.chat_url,
+                target="llm",
+                headers=backend.headers(),
+                json={"model": EA_MODEL_NAME, "messages": messages, "stream": False, **keep_alive_fields()},
                 timeout=60 # Slightly shorter timeout for EA might be okay
             )
-            response.raise_for_status()
-            result = response.json()
-            logging.debug(f"EA Raw LLM Response: {result}")
-            if "choices" in result and len(result["choices"]) > 0 and "message" in result["choices"][0] and "content" in result["choices"][0]["message"]:
-                 response_text = result["choices"][0]["message"]["content"].strip()
-                 logging.info(f"EA LLM call successful.")
-                 return response_text
-            else:
-                logging.error(f"EA Unexpected LLM response format: {result}")
-                raise HTTPException(status_code=500, detail="EA: Unexpected response format from LLM.")
+        response.raise_for_status()
+        return response.json()
+
+    try:
+        result = await LLM_POOL.call(EA_MODEL_NAME, send, "ea")
+        logging.debug(f"EA Raw LLM Response: {result}")
+        if "choices" in result and len(result["choices"]) > 0 and "message" in result["choices"][0] and "content" in result["choices"][0]["message"]:
+             response_text = result["choices"][0]["message"]["content"].strip()
+             logging.info(f"EA LLM call successful.")
+             return response_text
+        else:
+            logging.error(f"EA Unexpected LLM response format: {result}")
+            raise HTTPException(status_code=500, detail="EA: Unexpected response format from LLM.")
+    except (SchedulerRejected, NoBackendAvailable) as e:
+        raise HTTPException(status_code=503, detail=f"EA: LLM busy: {e}")
     except httpx.RequestError as e:
         logging.error(f"EA LLM request failed: {e}")
         raise HTTPException(status_code=503, detail=f"EA: Could not connect to LLM service: {e}")
@@ -92,49 +139,64 @@ async def expert_query(payload: ExpertQueryPayload): # Use the updated payload m
     Receives context from the TA, calls an LLM for a technical answer,
     and returns the concise response, handling vague questions appropriately.
     """
+    started = time.perf_counter()
+    deadline = time.monotonic() + payload.timeout_seconds if payload.timeout_seconds else None
     logging.info(f"Received query for session {payload.session_id}. Student Question: '{payload.student_question[:150]}...'")
 
-    # --- Load EA System Prompt ---
-    try:
-        with open(EA_SYSTEM_PROMPT_FILE, "r") as f:
-            ea_system_prompt = f.read().strip()
-        if not ea_system_prompt:
-            raise FileNotFoundError # Treat empty file as not found
-        logging.info(f"Loaded EA system prompt from {EA_SYSTEM_PROMPT_FILE}")
-    except FileNotFoundError:
+    # --- Load EA System Prompt (from the hot-reloaded inputs snapshot) ---
+    ea_system_prompt = (INPUTS.current.text(EA_SYSTEM_PROMPT_FILE) or "").strip()
+    if not ea_system_prompt:
         logging.warning(f"EA System prompt file not found at {EA_SYSTEM_PROMPT_FILE} or empty. Using default prompt.")
-        ea_system_prompt = EA_SYSTEM_PROMPT_DEFAULT
-    except Exception as e:
-        logging.error(f"Error loading EA system prompt from {EA_SYSTEM_PROMPT_FILE}: {e}. Using default.")
+        FALLBACKS.labels(service="ea", fallback="default_system_prompt").inc()
         ea_system_prompt = EA_SYSTEM_PROMPT_DEFAULT
 
+    # --- Reuse another student's answer to the same question, if cached ---
+    cache_fingerprint = ea_cache_fingerprint(ea_system_prompt, EA_MODEL_NAME, payload.embedding_model or "")
+    cache_key = (payload.assignment_id or payload.assignment_description, payload.learning_objective)
+    with time_stage("ea", "ea_cache"):
+        cached_response = await EA_CACHE.get(*cache_key, payload.question_embedding, cache_fingerprint)
+    if cached_response is not None:
+        REQUEST_SECONDS.labels(service="ea", endpoint="expert_query").observe(time.perf_counter() - started)
+        return {"response": cached_response}
+
     # --- Construct Prompt for EA's internal LLM using payload fields ---
+    # System prompt and assignment form a prefix shared by every question about the assignment (see prompt_builder.py)
+    ea_prefix = static_prefix(
+        "ea", ea_system_prompt,
+        ("Assignment", CONTEXT_PACKER.cap("expert", EA_MODEL_NAME, "assignment", payload.assignment_description, 0.4)),
+    )
+    packed = CONTEXT_PACKER.pack("expert", EA_MODEL_NAME, [
+        Section("system", ea_prefix, priority=0, fixed=True),
+        Section("question", payload.student_question, priority=1, min_share=0.2),
+        Section("logs", payload.logs, priority=2, min_share=0.1, keep="tail"),
+        Section("history", payload.history, priority=3, min_share=0.1, keep="tail"),
+    ], template_tokens=120)  # Instructions and labels around the sections
     prompt_context = f"""[INTERNAL CONTEXT]
-    Assignment: {payload.assignment_description}
     Task Objective: {payload.learning_objective}
     Recent Logs:
-    {payload.logs}
+    {packed["logs"]}
 
     Conversation History:
-    {payload.history}
+    {packed["history"]}
     [END INTERNAL CONTEXT]
 
-    Student Question: {payload.student_question}
+    Student Question: {packed["question"]}
 
     ---
     Based *only* on the 'Student Question' above and using the other information strictly as context, provide the concise technical information needed. If the question is not a specific technical query, follow the instructions in your system prompt precisely.
     """
 
-    ea_llm_messages = [
-        {"role": "system", "content": ea_system_prompt},
-        {"role": "user", "content": prompt_context}
-    ]
+    ea_llm_messages = build_messages("ea", "expert", ea_prefix, prompt_context)
     logging.debug(f"EA LLM Messages: {ea_llm_messages}")
 
     # --- Call EA's internal LLM ---
     try:
-        llm_response = await call_ea_llm(ea_llm_messages)
+        generation_started = time.perf_counter()
+        with time_stage("ea", "ea_llm"):
+            llm_response = await call_ea_llm(ea_llm_messages, deadline)
         logging.info(f"EA LLM generated response for session {payload.session_id}: '{llm_response[:100]}...'")
+        await EA_CACHE.put(*cache_key, payload.question_embedding, cache_fingerprint, payload.student_question,
+                           llm_response, time.perf_counter() - generation_started)
         return {"response": llm_response} # Return in the format TA expects
     except HTTPException as e:
         # Re-raise HTTPExceptions from the LLM call to inform the TA
@@ -144,6 +206,8 @@ async def expert_query(payload: ExpertQueryPayload): # Use the updated payload m
         logging.error(f"Error processing expert query after LLM call setup for session {payload.session_id}: {e}", exc_info=True)
         # Return a generic error response to the TA
         raise HTTPException(status_code=500, detail="Expert Agent encountered an internal error processing the request.")
+    finally:
+        REQUEST_SECONDS.labels(service="ea", endpoint="expert_query").observe(time.perf_counter() - started)
 
 
 @app.get("/verify_ea")
@@ -151,6 +215,10 @@ def verify():
     # You might want to add a check here to see if the LLM endpoint is reachable
     return {"message": "Expert Agent (LLM-Powered) is running"}
 
+@app.get("/metrics")
+def metrics():
+    return metrics_response()
+
 if __name__ == "__main__":
     # Runs on port 8003
     import uvicorn
@@ -0,0 +1,226 @@
+# ea_cache.py - Cross-student semantic cache of Expert Agent answers, persisted in SQLite
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from db import Database
+from metrics import EA_CACHE_ENTRIES, EA_CACHE_INVALIDATIONS, EA_CACHE_LOOKUPS, EA_CACHE_SAVED_SECONDS
+
+# Use .env variables or fall back to defaults
+EA_CACHE_ENABLED = os.getenv("ea_cache_enabled", "false").strip().lower() in ("1", "true", "yes")
+EA_CACHE_PATH = os.getenv("ea_cache_path", "/app/chat_histories/ea_cache.db")
+EA_CACHE_SIZE = int(os.getenv("ea_cache_size", "5000"))
+EA_CACHE_TTL_SECONDS = float(os.getenv("ea_cache_ttl_seconds", "604800"))
+# Cosine similarity above which another student's question counts as the same question
+EA_CACHE_SIMILARITY = float(os.getenv("ea_cache_similarity", "0.95"))
+
+EA_CACHE_DDL = """
+    CREATE TABLE IF NOT EXISTS ea_answer_cache (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        fingerprint TEXT NOT NULL,
+        assignment_id TEXT NOT NULL,
+        learning_objective TEXT NOT NULL,
+        question TEXT NOT NULL,
+        answer TEXT NOT NULL,
+        embedding BLOB NOT NULL, -- float32, unit length
+        generation_seconds REAL NOT NULL,
+        created_at REAL NOT NULL,
+        last_used_at REAL NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0
+    )
+"""
+
+
+def ea_cache_fingerprint(system_prompt: str, model_name: str, embedding_model: str) -> str:
+    """Hash of what an answer depends on besides the question; any change makes old answers unusable."""
+    return hashlib.sha256("\x00".join((system_prompt, model_name, embedding_model)).encode("utf-8")).hexdigest()
+
+
+# --- SQL units (run on the cache database's thread) ---
+def _create_table(conn: sqlite3.Connection):
+    conn.execute(EA_CACHE_DDL)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ea_answer_cache_fingerprint ON ea_answer_cache (fingerprint, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ea_answer_cache_last_used ON ea_answer_cache (last_used_at)")
+
+
+def _purge_other_fingerprints(conn: sqlite3.Connection, fingerprint: str) -> int:
+    return conn.execute("DELETE FROM ea_answer_cache WHERE fingerprint != ?", (fingerprint,)).rowcount
+
+
+def _fetch_since(conn: sqlite3.Connection, fingerprint: str, after_id: int) -> List[sqlite3.Row]:
+    return conn.execute("""
+        SELECT id, assignment_id, learning_objective, embedding FROM ea_answer_cache
+        WHERE fingerprint = ? AND id > ? ORDER BY id
+    """, (fingerprint, after_id)).fetchall()
+
+
+def _claim(conn: sqlite3.Connection, entry_id: int, fingerprint: str, created_after: float, now: float) -> Optional[sqlite3.Row]:
+    """Returns a live entry and marks it used, or None if it expired or was evicted by another worker."""
+    row = conn.execute("""
+        SELECT answer, generation_seconds FROM ea_answer_cache
+        WHERE id = ? AND fingerprint = ? AND created_at >= ?
+    """, (entry_id, fingerprint, created_after)).fetchone()
+    if row is not None:
+        conn.execute("UPDATE ea_answer_cache SET hits = hits + 1, last_used_at = ? WHERE id = ?", (now, entry_id))
+    return row
+
+
+def _insert(conn: sqlite3.Connection, entry: tuple, created_after: float, max_entries: int) -> int:
+    """Stores an answer, drops expired entries and the least recently used beyond `max_entries`; returns the entry count."""
+    conn.execute("""
+        INSERT INTO ea_answer_cache (fingerprint, assignment_id, learning_objective, question, answer, embedding,
+                                     generation_seconds, created_at, last_used_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, entry)
+    conn.execute("DELETE FROM ea_answer_cache WHERE created_at < ?", (created_after,))
+    conn.execute("""
+        DELETE FROM ea_answer_cache WHERE id IN (
+            SELECT id FROM ea_answer_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+        )
+    """, (max_entries,))
+    return conn.execute("SELECT COUNT(*) FROM ea_answer_cache").fetchone()[0]
+
+
+class _Bucket:
+    """Cached questions of one (assignment, learning objective) in this worker."""
+
+    def __init__(self):
+        self.ids: List[int] = []
+        self.vectors: List[np.ndarray] = []
+        self._matrix: Optional[np.ndarray] = None
+
+    def add(self, entry_id: int, vector: np.ndarray):
+        self.ids.append(entry_id)
+        self.vectors.append(vector)
+        self._matrix = None
+
+    def remove(self, entry_id: int):
+        i = self.ids.index(entry_id)
+        del self.ids[i], self.vectors[i]
+        self._matrix = None
+
+    def matrix(self) -> np.ndarray:
+        if self._matrix is None:
+            self._matrix = np.stack(self.vectors)
+        return self._matrix
+
+
+class EACache:
+    """Reuses EA answers across students who ask the same question about the same assignment and LO.
+
+    Entries live in their own SQLite file so every EA worker sees the others'
+    answers. Each worker keeps the question embeddings (computed by the TA,
+    which sends them with the query) in memory per (assignment, LO) and picks
+    up new rows incrementally before each lookup. A lookup returns the answer
+    of the most similar cached question at or above `ea_cache_similarity`.
+
+    Entries expire `ea_cache_ttl_seconds` after they were written, and beyond
+    `ea_cache_size` the least recently used are deleted. Every entry carries
+    the fingerprint of the EA system prompt and models that produced it; when
+    the fingerprint changes, older entries are ignored and deleted.
+
+    Only the question, assignment and LO are compared, not the student's
+    history or logs, so keep the threshold high.
+    """
+
+    def __init__(self, path: str = EA_CACHE_PATH, enabled: bool = EA_CACHE_ENABLED, max_entries: int = EA_CACHE_SIZE,
+                 ttl_seconds: float = EA_CACHE_TTL_SECONDS, similarity_threshold: float = EA_CACHE_SIMILARITY):
+        self.enabled = enabled
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.db = Database(path) if enabled else None
+        self._fingerprint: Optional[str] = None
+        self._buckets: Dict[Tuple[str, str], _Bucket] = {}
+        self._last_id = 0
+        self._loaded = 0
+
+    async def start(self):
+        if self.enabled:
+            await self.db.run(_create_table)
+            logging.info(f"EA answer cache enabled ({self.db.path}, similarity >= {self.similarity_threshold}).")
+
+    def close(self):
+        if self.enabled:
+            self.db.close()
+
+    def _reset(self):
+        self._buckets.clear()
+        self._last_id = 0
+        self._loaded = 0
+
+    async def _sync(self, fingerprint: str):
+        if fingerprint != self._fingerprint:
+            deleted = await self.db.run(_purge_other_fingerprints, fingerprint)
+            if self._fingerprint is not None or deleted:
+                logging.info(f"EA system prompt or models changed. Dropped {deleted} cached EA answers.")
+                EA_CACHE_INVALIDATIONS.inc()
+            self._fingerprint = fingerprint
+            self._reset()
+        elif self._loaded > 2 * self.max_entries:
+            # Most of what this worker holds was evicted by others; start over
+            self._reset()
+        for row in await self.db.run(_fetch_since, fingerprint, self._last_id):
+            vector = np.frombuffer(row["embedding"], dtype=np.float32)
+            self._buckets.setdefault((row["assignment_id"], row["learning_objective"]), _Bucket()).add(row["id"], vector)
+            self._last_id = row["id"]
+            self._loaded += 1
+
+    @staticmethod
+    def _unit(embedding: List[float]) -> Optional[np.ndarray]:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if vector.ndim == 1 and norm > 0 else None
+
+    async def get(self, assignment_id: str, learning_objective: str, embedding: Optional[List[float]],
+                  fingerprint: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        vector = self._unit(embedding) if embedding else None
+        if vector is None:
+            EA_CACHE_LOOKUPS.labels(result="skipped").inc()
+            return None
+        try:
+            await self._sync(fingerprint)
+            bucket = self._buckets.get((assignment_id, learning_objective))
+            while bucket is not None and bucket.ids and bucket.vectors[0].shape == vector.shape:
+                scores = bucket.matrix() @ vector
+                best = int(np.argmax(scores))
+                if scores[best] < self.similarity_threshold:
+                    break
+                entry_id = bucket.ids[best]
+                now = time.time()
+                row = await self.db.run(_claim, entry_id, fingerprint, now - self.ttl_seconds, now)
+                if row is None:
+                    bucket.remove(entry_id)  # Expired or evicted; try the next closest
+                    continue
+                EA_CACHE_LOOKUPS.labels(result="hit").inc()
+                EA_CACHE_SAVED_SECONDS.inc(row["generation_seconds"])
+                logging.info(f"EA cache hit (similarity {scores[best]:.3f}) for assignment '{assignment_id}'.")
+                return row["answer"]
+        except sqlite3.Error as e:
+            logging.warning(f"EA cache lookup failed: {e}")
+        EA_CACHE_LOOKUPS.labels(result="miss").inc()
+        return None
+
+    async def put(self, assignment_id: str, learning_objective: str, embedding: Optional[List[float]], fingerprint: str,
+                  question: str, answer: str, generation_seconds: float):
+        if not self.enabled:
+            return
+        vector = self._unit(embedding) if embedding else None
+        if vector is None:
+            return
+        now = time.time()
+        entry = (fingerprint, assignment_id, learning_objective, question, answer, vector.tobytes(),
+                 generation_seconds, now, now)
+        try:
+            # Other workers (and this one, on its next lookup) pick the row up from the table
+            count = await self.db.run(_insert, entry, now - self.ttl_seconds, self.max_entries)
+            EA_CACHE_ENTRIES.set(count)
+        except sqlite3.Error as e:
+            logging.warning(f"Could not store EA answer in the cache: {e}")
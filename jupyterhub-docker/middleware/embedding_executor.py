@@ -0,0 +1,116 @@
+# embedding_executor.py - Micro-batched sentence embeddings computed off the event loop
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from metrics import EMBEDDING_BATCH_SECONDS, EMBEDDING_BATCH_SIZE, EMBEDDING_QUEUE_WAIT_SECONDS
+
+# Use .env variables or fall back to defaults
+# Most texts encoded in one model call
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("embedding_batch_max_size", "32"))
+# How long the first request of a batch waits for others to join (milliseconds)
+EMBEDDING_BATCH_MAX_WAIT_MS = float(os.getenv("embedding_batch_max_wait_ms", "5"))
+
+
+class EmbeddingExecutor:
+    """Collects concurrent encode requests and runs them as one batched `model.encode`.
+
+    `encode()` queues the text and awaits a future. A background task takes
+    the first queued request and waits up to `embedding_batch_max_wait_ms` for
+    more, or until `embedding_batch_max_size` are queued. It then encodes the
+    whole batch on a dedicated thread, so the event loop keeps serving other
+    requests, and resolves each caller's future with its unit-length vector.
+    Requests that arrive while a batch is running form the next batch.
+
+    `encode()` returns None when no model is loaded or encoding fails, the
+    same as the model-unavailable fallback callers already handle.
+    """
+
+    def __init__(self, model=None, max_batch_size: int = EMBEDDING_BATCH_MAX_SIZE,
+                 max_wait_ms: float = EMBEDDING_BATCH_MAX_WAIT_MS):
+        self.model = model
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._batch_full: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(texts, batch_size=len(texts), convert_to_numpy=True, normalize_embeddings=True)
+
+    async def _run_batch(self, batch: List[Tuple[str, asyncio.Future, float]]):
+        started = time.perf_counter()
+        for _, _, queued_at in batch:
+            EMBEDDING_QUEUE_WAIT_SECONDS.observe(started - queued_at)
+        vectors = [None] * len(batch)
+        try:
+            vectors = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._encode_batch, [text for text, _, _ in batch])
+        except Exception as e:
+            logging.error(f"Error encoding batch of {len(batch)} texts: {e}")
+        finally:
+            # Also runs on cancellation at shutdown, so no caller is left waiting
+            for (_, future, _), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+        EMBEDDING_BATCH_SIZE.observe(len(batch))
+        EMBEDDING_BATCH_SECONDS.observe(time.perf_counter() - started)
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            if self.max_wait > 0 and self._queue.qsize() < self.max_batch_size - 1:
+                self._batch_full.clear()
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), timeout=self.max_wait)
+                except asyncio.TimeoutError:
+                    pass
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            await self._run_batch(batch)
+
+    async def encode(self, text: str) -> Optional[np.ndarray]:
+        """Returns the unit-length embedding of `text`, batched with concurrent callers."""
+        if self.model is None:
+            return None
+        future = asyncio.get_running_loop().create_future()
+        if self._task is None:
+            # Not started (e.g. scripts outside the app lifespan): encode this text on its own
+            self._executor = self._executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+            await self._run_batch([(text, future, time.perf_counter())])
+        else:
+            self._queue.put_nowait((text, future, time.perf_counter()))
+            if self._queue.qsize() >= self.max_batch_size - 1:
+                self._batch_full.set()
+        return await future
+
+    def start(self):
+        if self._task is None:
+            # Created here rather than in __init__ so each forked worker gets its own thread
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+            self._queue = asyncio.Queue()
+            self._batch_full = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stops batching; queued requests resolve to None."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            while not self._queue.empty():
+                _, future, _ = self._queue.get_nowait()
+                if not future.done():
+                    future.set_result(None)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
@@ -0,0 +1,135 @@
+# experiments.py - Deterministic A/B group assignment, cached per worker and recorded for auditing in the background
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+import db
+from db import Database
+from metrics import EXPERIMENT_AUDIT_QUEUE_DEPTH, EXPERIMENT_AUDIT_WRITES, EXPERIMENT_GROUP_CHANGES, EXPERIMENT_LOOKUPS
+
+# Use .env variables or fall back to defaults
+# Seconds between writes of new assignments to student_experiment_assignments
+EXPERIMENT_AUDIT_FLUSH_INTERVAL = float(os.getenv("experiment_audit_flush_interval", "5"))
+# Students whose groups are kept in memory per worker
+EXPERIMENT_CACHE_SIZE = 10000
+
+Assignment = Tuple[str, Mapping]  # (experiment_id, group)
+
+
+def assign_group(student_id: str, experiment: Mapping) -> Mapping:
+    """The student's group in `experiment`, derived from sha256(student_id + experiment_id) alone.
+
+    The hash picks a point in [0, total weight) and each group covers its
+    share of that range in the order listed. The point lies in slot
+    `hash % number of groups`, so with equal weights (or none) every student
+    keeps the group `hash % number of groups` gave them before weights existed.
+    """
+    groups = experiment["groups"]
+    hash_value = int(hashlib.sha256((student_id + experiment["id"]).encode("utf-8")).hexdigest(), 16)
+    weights = [group.get("weight", 1) for group in groups]
+    count = len(groups)
+    # Changing weights moves only the students whose point falls between the old and new boundaries,
+    # but those students do switch groups mid-experiment
+    point = ((hash_value % count) + (hash_value // count % 10**9) / 10**9) / count * sum(weights)
+    for group, weight in zip(groups, weights):
+        if point < weight:
+            return group
+        point -= weight
+    return groups[-1]
+
+
+def merged_params(assignments: Sequence[Assignment]) -> dict:
+    """Group params of all the student's experiments; for a param set by several, the first experiment listed wins."""
+    params = {}
+    for _, group in assignments:
+        for key, value in (group.get("params") or {}).items():
+            params.setdefault(key, value)
+    return params
+
+
+class ExperimentAssigner:
+    """Resolves a student's groups in every active experiment without touching the database.
+
+    The hash is the source of truth, so a group never has to be looked up:
+    `groups()` computes it once per worker and keeps it in an LRU cache,
+    which is dropped whenever `ab_experiments.json` changes. The first time a
+    worker assigns a student, the assignment is queued and written to
+    `student_experiment_assignments` by a background task every
+    `experiment_audit_flush_interval` seconds, for analysis only. That table
+    keeps each student's first group; every group a student was computed
+    into is listed in `experiment_group_history`.
+    """
+
+    def __init__(self, database: Database, flush_interval: float = EXPERIMENT_AUDIT_FLUSH_INTERVAL,
+                 cache_size: int = EXPERIMENT_CACHE_SIZE):
+        self.database = database
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self._experiments: Optional[Sequence[Mapping]] = None
+        self._cache: "OrderedDict[str, List[Assignment]]" = OrderedDict()
+        self._pending: Dict[Tuple[str, str], str] = {}  # (student_id, experiment_id) -> group_id
+        self._task: Optional[asyncio.Task] = None
+
+    def groups(self, student_id: str, experiments: Sequence[Mapping]) -> List[Assignment]:
+        """(experiment_id, group) for each active experiment, in the order of the config."""
+        if experiments is not self._experiments:
+            # A new inputs snapshot; groups or weights may have changed
+            self._experiments = experiments
+            self._cache.clear()
+        assignments = self._cache.get(student_id)
+        if assignments is not None:
+            self._cache.move_to_end(student_id)
+            EXPERIMENT_LOOKUPS.labels(result="cached").inc()
+            return assignments
+        EXPERIMENT_LOOKUPS.labels(result="computed").inc()
+        assignments = [(experiment["id"], assign_group(student_id, experiment)) for experiment in experiments]
+        self._cache[student_id] = assignments
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        for experiment_id, group in assignments:
+            self._pending[(student_id, experiment_id)] = group["group_id"]
+        EXPERIMENT_AUDIT_QUEUE_DEPTH.set(len(self._pending))
+        return assignments
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        EXPERIMENT_AUDIT_QUEUE_DEPTH.set(0)
+        rows = [(student_id, experiment_id, group_id) for (student_id, experiment_id), group_id in batch.items()]
+        try:
+            changes = await self.database.run(db.record_experiment_assignments, rows)
+        except Exception as e:
+            logging.error(f"Failed to record {len(rows)} experiment assignments: {e}. Re-queueing them.")
+            self._pending = {**batch, **self._pending}
+            EXPERIMENT_AUDIT_QUEUE_DEPTH.set(len(self._pending))
+            return
+        EXPERIMENT_AUDIT_WRITES.inc(len(rows))
+        for student_id, experiment_id, first_group, group_id in changes:
+            EXPERIMENT_GROUP_CHANGES.labels(experiment=experiment_id).inc()
+            logging.warning(f"A/B testing: {student_id} moved from group '{first_group}' to '{group_id}' in experiment "
+                            f"{experiment_id}. Keeping '{first_group}' in student_experiment_assignments.")
+        logging.info(f"Recorded {len(rows)} experiment assignments.")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stops the flush loop and records everything still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
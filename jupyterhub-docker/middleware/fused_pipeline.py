@@ -0,0 +1,134 @@
+# fused_pipeline.py - Prompt and output handling for the single-call (fused) response mode
+import json
+import logging
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+# "standard": classification and EA call, then the pedagogical LLM call.
+# "fused": one structured call writes the technical answer and the student-facing reply together.
+PIPELINE_MODES = ("standard", "fused")
+
+# OpenAI-compatible JSON mode (supported by Ollama's /v1 API and Open WebUI)
+FUSED_RESPONSE_FORMAT = {"type": "json_object"}
+
+DEFAULT_EA_GUIDELINES = "Give concise, factual, technical information that answers the student's specific question."
+
+
+@dataclass
+class FusedOutput:
+    technical_answer: str
+    response: str
+    classification: Optional[str] = None
+
+
+def build_fused_instructions(ea_guidelines: str, classification_options: Optional[List[str]] = None) -> str:
+    """System-prompt section asking for the technical answer and the reply in one JSON object.
+
+    With `classification_options`, the model also classifies the question;
+    the student's candidate profile hints then go in the per-turn message
+    (see build_conditional_hints), so this section stays the same for everyone.
+    """
+    keys = ['"technical_answer": brief expert notes answering the question (for internal use only, not shown to the student)']
+    if classification_options:
+        keys.append(f'"classification": exactly one of {", ".join(classification_options)}')
+    keys.append('"response": your reply to the student, following all instructions above')
+
+    sections = [
+        "\n**Output Format:** First work out the technical answer the way the expert below would, then write your reply to the student based on it.",
+        f"Expert guidelines for the technical answer:\n{ea_guidelines.strip()}",
+        "Respond with a single JSON object with these keys, in this order:\n" + "\n".join(f"- {key}" for key in keys),
+    ]
+    return "\n\n".join(sections) + "\n"
+
+
+def build_conditional_hints(conditional_hints: Dict[str, str]) -> str:
+    """Lists every candidate profile hint with the classification label it applies to."""
+    hints = "\n".join(f"- If you classify the question as '{label}':{hint or ' no additional hint.'}"
+                      for label, hint in conditional_hints.items())
+    return f"Apply the profile hint matching your classification:\n{hints}" if hints else ""
+
+
+def parse_fused_output(text: str, classification_options: Optional[List[str]] = None) -> Optional[FusedOutput]:
+    """Reads the fused JSON object, tolerating code fences or prose around it. Returns None if it cannot."""
+    candidates = [text]
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    if match:
+        candidates.append(match.group(0))
+    for candidate in candidates:
+        try:
+            data = json.loads(candidate)
+        except (json.JSONDecodeError, TypeError):
+            continue
+        if not isinstance(data, dict) or not str(data.get("response") or "").strip():
+            continue
+        classification = str(data.get("classification") or "").strip().lower() or None
+        if classification_options is not None and classification not in classification_options:
+            classification = None
+        return FusedOutput(
+            technical_answer=str(data.get("technical_answer") or "").strip(),
+            response=str(data["response"]).strip(),
+            classification=classification,
+        )
+    logging.warning(f"Could not parse fused LLM output as JSON: '{text[:200]}...'")
+    return None
+
+
+class FusedResponseExtractor:
+    """Pulls the "response" string out of a JSON object while it is being streamed.
+
+    `feed()` takes raw chunks from the LLM and returns the newly decoded
+    characters of the "response" value, so the student sees the reply while
+    the model writes it.
+    """
+
+    _KEY = re.compile(r'"response"\s*:\s*"')
+    _ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self):
+        self._buffer = ""
+        self._position: Optional[int] = None  # Index in the buffer of the next undecoded value character
+        self.done = False
+
+    def feed(self, chunk: str) -> str:
+        self._buffer += chunk
+        if self.done:
+            return ""
+        if self._position is None:
+            match = self._KEY.search(self._buffer)
+            if not match:
+                return ""
+            self._position = match.end()
+        decoded = []
+        i = self._position
+        while i < len(self._buffer):
+            char = self._buffer[i]
+            if char == '"':
+                self.done = True
+                i += 1
+                break
+            if char != "\\":
+                decoded.append(char)
+                i += 1
+                continue
+            if i + 1 >= len(self._buffer):
+                break  # Escape split across chunks; wait for the rest
+            code = self._buffer[i + 1]
+            if code == "u":
+                if i + 6 > len(self._buffer):
+                    break
+                try:
+                    decoded.append(chr(int(self._buffer[i + 2:i + 6], 16)))
+                except ValueError:
+                    pass
+                i += 6
+            else:
+                decoded.append(self._ESCAPES.get(code, code))
+                i += 2
+        self._position = i
+        return "".join(decoded)
+
+    @property
+    def text(self) -> str:
+        """Everything received so far."""
+        return self._buffer
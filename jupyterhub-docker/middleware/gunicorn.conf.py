@@ -0,0 +1,53 @@
+# gunicorn.conf.py - Load-once, fork-after-load settings for the TA handler
+#
+#   gunicorn ta-handler:app -c gunicorn.conf.py
+#
+# start.sh also runs the EA with this file, overriding bind and workers on the command line.
+#
+# With preload_app the parent imports ta-handler once (torch, the MiniLM model,
+# LO embeddings, inputs snapshot, schema migrations) and then forks the workers,
+# which share those pages copy-on-write instead of each loading their own copy.
+# Per-worker state (database connection, HTTP pool, background tasks) is
+# created after the fork, in the app's lifespan or lazily on first use.
+import gc
+import os
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Use .env variables or fall back to defaults
+bind = os.getenv("ta_bind", "0.0.0.0:8004")
+workers = int(os.getenv("ta_workers", "4"))
+# "false" makes every worker import and load the model itself, like `uvicorn --workers`
+preload_app = os.getenv("ta_preload_app", "true").strip().lower() == "true"
+# Threads torch may use per worker; defaults to an even share of the CPUs
+torch_num_threads = int(os.getenv("torch_num_threads", "0")) or max(1, (os.cpu_count() or 1) // workers)
+
+worker_class = "uvicorn.workers.UvicornWorker"
+# Model loading happens before the fork, so workers boot in well under the default timeout
+timeout = 60
+graceful_timeout = 30
+
+
+def when_ready(server):
+    # Move everything loaded so far out of the collector's reach; otherwise the first
+    # collection in each worker writes to every tracked object and un-shares its page
+    if preload_app:
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(torch_num_threads)
+    else:
+        # Without preload the worker imports torch itself, which reads this
+        os.environ.setdefault("OMP_NUM_THREADS", str(torch_num_threads))
+
+
+def child_exit(server, worker):
+    # Stop counting the exited worker's gauges in the /metrics aggregate
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid)
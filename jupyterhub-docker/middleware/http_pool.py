@@ -0,0 +1,102 @@
+# http_pool.py - Application-scoped, keep-alive HTTP client shared by a worker's outbound calls
+import importlib.util
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import httpx
+
+from metrics import (
+    HTTP_POOL_CONNECTIONS,
+    HTTP_POOL_IN_FLIGHT,
+    HTTP_POOL_MAX_CONNECTIONS,
+    HTTP_POOL_TIMEOUTS,
+    HTTP_REQUEST_SECONDS,
+)
+
+# Use .env variables or fall back to defaults
+HTTP_MAX_CONNECTIONS = int(os.getenv("http_max_connections", "50"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("http_max_keepalive_connections", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("http_keepalive_expiry", "30"))
+HTTP_POOL_TIMEOUT = float(os.getenv("http_pool_timeout", "10"))
+HTTP2_ENABLED = os.getenv("http2_enabled", "false").strip().lower() in ("1", "true", "yes")
+
+
+class HttpPool:
+    """One `httpx.AsyncClient` per worker, opened and closed by the FastAPI lifespan.
+
+    Reusing the client keeps TCP (and optionally HTTP/2) connections to
+    WebUI/Ollama and the EA alive between student messages instead of paying
+    a handshake on every call. `post()` wraps the client to record in-flight
+    requests, open connections and pool timeouts so the pool can be sized
+    against class-wide bursts.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        if self._client is not None:
+            return
+        http2 = HTTP2_ENABLED
+        if http2 and importlib.util.find_spec("h2") is None:
+            logging.warning("http2_enabled is set but the 'h2' package is not installed. Falling back to HTTP/1.1.")
+            http2 = False
+        limits = httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )
+        self._client = httpx.AsyncClient(limits=limits, http2=http2)
+        HTTP_POOL_MAX_CONNECTIONS.labels(pool=self.name).set(HTTP_MAX_CONNECTIONS)
+        logging.info(f"HTTP pool '{self.name}' started (max_connections={HTTP_MAX_CONNECTIONS}, keepalive={HTTP_MAX_KEEPALIVE_CONNECTIONS}, http2={http2}).")
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            logging.info(f"HTTP pool '{self.name}' closed.")
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError(f"HTTP pool '{self.name}' used before startup.")
+        return self._client
+
+    def timeout(self, seconds: float) -> httpx.Timeout:
+        """Per-request timeout that fails fast when no pooled connection frees up."""
+        return httpx.Timeout(seconds, pool=min(seconds, HTTP_POOL_TIMEOUT))
+
+    def _record_connections(self):
+        # httpx does not expose pool state publicly; read it defensively
+        pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+        connections = getattr(pool, "connections", None)
+        if connections is None:
+            return
+        idle = sum(1 for c in connections if c.is_idle())
+        HTTP_POOL_CONNECTIONS.labels(pool=self.name, state="idle").set(idle)
+        HTTP_POOL_CONNECTIONS.labels(pool=self.name, state="active").set(len(connections) - idle)
+
+    @asynccontextmanager
+    async def track(self, target: str):
+        """Records in-flight count and duration for one outbound request."""
+        in_flight = HTTP_POOL_IN_FLIGHT.labels(pool=self.name, target=target)
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            yield
+        except httpx.PoolTimeout:
+            HTTP_POOL_TIMEOUTS.labels(pool=self.name, target=target).inc()
+            logging.error(f"HTTP pool '{self.name}' saturated: no connection available for {target} within {HTTP_POOL_TIMEOUT}s")
+            raise
+        finally:
+            in_flight.dec()
+            HTTP_REQUEST_SECONDS.labels(pool=self.name, target=target).observe(time.perf_counter() - started)
+            self._record_connections()
+
+    async def post(self, url: str, target: str, timeout: float, **kwargs) -> httpx.Response:
+        async with self.track(target):
+            return await self.client.post(url, timeout=self.timeout(timeout), **kwargs)
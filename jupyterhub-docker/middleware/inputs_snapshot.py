@@ -0,0 +1,269 @@
+# inputs_snapshot.py - Immutable, hot-reloadable snapshot of the files under inputs/
+import asyncio
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Callable, List, Mapping, Optional, Tuple
+
+# Use .env variables or fall back to defaults
+INPUTS_DIR = os.getenv("inputs_dir", "./inputs")
+# Seconds between checks of inputs/ for changed files
+INPUTS_POLL_INTERVAL = float(os.getenv("inputs_poll_interval", "2"))
+
+INPUT_FILE_SUFFIXES = (".txt", ".json")
+EXPERIMENT_CONFIG_NAME = "ab_experiments.json"
+COMPLETION_RULES_NAME = "completion_rules.json"
+# /qualtrics-finish requirements and code when completion_rules.json does not override them
+DEFAULT_COMPLETION_RULE = MappingProxyType({
+    "min_session_minutes": 15,
+    "min_questions": 1,
+    "title": "Session 1 Complete!",
+    "completion_code": "BLUE-SHARK-24",
+})
+
+
+@dataclass(frozen=True)
+class InputsSnapshot:
+    """Everything the handlers read from inputs/, parsed once.
+
+    A snapshot is never modified. A change on disk produces a new snapshot
+    that replaces the old one in a single reference assignment, so a request
+    that grabbed `INPUTS.current` keeps a consistent view until it finishes.
+    """
+    version: int
+    files: Mapping[str, str] = field(default_factory=dict)  # absolute path -> file content
+    assignment_descriptions: Mapping[str, str] = field(default_factory=dict)
+    learning_objectives: Mapping[str, Tuple[str, ...]] = field(default_factory=dict)
+    next_steps: Mapping[str, Tuple[str, ...]] = field(default_factory=dict)
+    active_experiments: Tuple[Mapping, ...] = ()  # Configs of the active experiments, each including its "id"
+    default_completion_rule: Mapping = field(default_factory=lambda: DEFAULT_COMPLETION_RULE)
+    completion_rules: Mapping[str, Mapping] = field(default_factory=dict)  # assignment_id -> rule, defaults filled in
+
+    def text(self, path: str) -> Optional[str]:
+        """Content of an input file by the path the handlers use (e.g. './inputs/ta_system_prompt.txt')."""
+        return self.files.get(os.path.abspath(path))
+
+    def lines(self, path: str) -> Tuple[str, ...]:
+        """Non-empty, stripped, lowercased lines of an input file (e.g. classification options)."""
+        content = self.text(path) or ""
+        return tuple(line.strip().lower() for line in content.splitlines() if line.strip())
+
+    def completion_rule(self, assignment_id: str) -> Mapping:
+        """/qualtrics-finish requirements and completion code for an assignment."""
+        return self.completion_rules.get(assignment_id, self.default_completion_rule)
+
+
+def _scan(inputs_dir: str) -> Tuple[Tuple[str, int, int], ...]:
+    """(path, mtime_ns, size) of every input file; any edit, addition or removal changes it."""
+    entries = []
+    for root, _, names in os.walk(inputs_dir):
+        for name in names:
+            if not name.endswith(INPUT_FILE_SUFFIXES):
+                continue
+            path = os.path.abspath(os.path.join(root, name))
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(sorted(entries))
+
+
+def _per_assignment(files: Mapping[str, str], inputs_dir: str, subdir: str) -> dict:
+    directory = os.path.abspath(os.path.join(inputs_dir, subdir))
+    if not os.path.isdir(directory):
+        logging.error(f"Input directory '{directory}' does not exist.")
+    return {
+        os.path.splitext(os.path.basename(path))[0]: content
+        for path, content in files.items()
+        if os.path.dirname(path) == directory and path.endswith(".txt")
+    }
+
+
+def _valid_groups(experiment_id: str, groups) -> Optional[Tuple[Mapping, ...]]:
+    """The experiment's groups if every one has a group_id and a non-negative weight (default 1), summing to more than 0."""
+    if not isinstance(groups, list) or not groups:
+        logging.warning(f"A/B testing: No groups defined for experiment {experiment_id}. Skipping it.")
+        return None
+    for group in groups:
+        weight = group.get("weight", 1) if isinstance(group, dict) else None
+        if not isinstance(group, dict) or not group.get("group_id") or isinstance(weight, bool) \
+                or not isinstance(weight, (int, float)) or weight < 0:
+            logging.error(f"A/B testing: Invalid group {group!r} in experiment {experiment_id}. Skipping the experiment.")
+            return None
+    if sum(group.get("weight", 1) for group in groups) <= 0:
+        logging.error(f"A/B testing: All groups of experiment {experiment_id} have weight 0. Skipping it.")
+        return None
+    return tuple(MappingProxyType(group) for group in groups)
+
+
+def _parse_experiments(content: Optional[str], path: str) -> Tuple[Mapping, ...]:
+    if content is None:
+        logging.warning(f"A/B testing: Experiment config file {path} not found. A/B testing disabled.")
+        return ()
+    try:
+        config = json.loads(content)
+    except json.JSONDecodeError:
+        logging.error(f"A/B testing: Error decoding JSON from {path}. A/B testing disabled.")
+        return ()
+    if not isinstance(config, dict) or not isinstance(config.get("experiments", {}), dict):
+        logging.error(f"A/B testing: {path} must be a JSON object with an 'experiments' object. A/B testing disabled.")
+        return ()
+    # "active_experiment_ids" lists experiments that run at the same time; "active_experiment_id" names a single one
+    listed_ids = config.get("active_experiment_ids") or []
+    if not isinstance(listed_ids, list) or not all(isinstance(active_id, str) for active_id in listed_ids):
+        logging.error(f"A/B testing: 'active_experiment_ids' in {path} must be a list of strings. Ignoring it.")
+        listed_ids = []
+    single_id = config.get("active_experiment_id")
+    if single_id and not isinstance(single_id, str):
+        logging.error(f"A/B testing: 'active_experiment_id' in {path} must be a string. Ignoring it.")
+        single_id = None
+    active_ids = list(dict.fromkeys(([single_id] if single_id else []) + listed_ids))  # Drops duplicates, keeps order
+    experiments = []
+    for active_id in active_ids:
+        experiment = config.get("experiments", {}).get(active_id)
+        if not isinstance(experiment, dict):
+            logging.warning(f"A/B testing: active experiment '{active_id}' not found or invalid in {path}. Skipping it.")
+            continue
+        groups = _valid_groups(active_id, experiment.get("groups"))
+        if groups is not None:
+            experiments.append(MappingProxyType({**experiment, "groups": groups, "id": active_id}))
+    if experiments:
+        logging.info(f"Successfully loaded active A/B experiment configs: {', '.join(e['id'] for e in experiments)}")
+    else:
+        logging.warning(f"A/B testing: No valid active experiment in {path}. A/B testing disabled.")
+    return tuple(experiments)
+
+
+def _valid_rule(name: str, overrides, base: Mapping) -> Mapping:
+    """`base` updated with the known, well-typed fields of `overrides`; anything else is logged and ignored."""
+    if not isinstance(overrides, dict):
+        logging.error(f"Completion rules: '{name}' is not an object. Using the default rule.")
+        return base
+    rule = dict(base)
+    for key, value in overrides.items():
+        if key in ("min_session_minutes", "min_questions"):
+            valid = not isinstance(value, bool) and isinstance(value, (int, float)) and value >= 0
+        else:
+            valid = key in ("title", "completion_code") and isinstance(value, str) and value.strip() != ""
+        if valid:
+            rule[key] = value
+        else:
+            logging.error(f"Completion rules: Ignoring invalid field {key!r}={value!r} in '{name}'.")
+    return MappingProxyType(rule)
+
+
+def _parse_completion_rules(content: Optional[str], path: str) -> Tuple[Mapping, Mapping[str, Mapping]]:
+    """(default rule, assignment_id -> rule); assignment rules only need the fields that differ from the default."""
+    if content is None:
+        return DEFAULT_COMPLETION_RULE, MappingProxyType({})
+    try:
+        config = json.loads(content)
+    except json.JSONDecodeError:
+        logging.error(f"Completion rules: Error decoding JSON from {path}. Using the default rule.")
+        return DEFAULT_COMPLETION_RULE, MappingProxyType({})
+    if not isinstance(config, dict):
+        logging.error(f"Completion rules: {path} is not a JSON object. Using the default rule.")
+        return DEFAULT_COMPLETION_RULE, MappingProxyType({})
+    default = _valid_rule("default", config.get("default", {}), DEFAULT_COMPLETION_RULE)
+    assignments = config.get("assignments", {})
+    if not isinstance(assignments, dict):
+        logging.error(f"Completion rules: 'assignments' in {path} is not an object. Using the default rule.")
+        assignments = {}
+    rules = {assignment_id: _valid_rule(assignment_id, overrides, default) for assignment_id, overrides in assignments.items()}
+    logging.info(f"Loaded completion rules from {path} ({len(rules)} assignment overrides).")
+    return default, MappingProxyType(rules)
+
+
+def build_snapshot(inputs_dir: str, version: int) -> InputsSnapshot:
+    files = {}
+    for path, _, _ in _scan(inputs_dir):
+        try:
+            with open(path, 'r') as f:
+                files[path] = f.read()
+        except OSError as e:
+            logging.error(f"Failed to read input file {path}: {e}")
+
+    def as_lines(content: str) -> Tuple[str, ...]:
+        return tuple(line.strip() for line in content.splitlines() if line.strip())
+
+    experiment_path = os.path.abspath(os.path.join(inputs_dir, EXPERIMENT_CONFIG_NAME))
+    completion_rules_path = os.path.abspath(os.path.join(inputs_dir, COMPLETION_RULES_NAME))
+    default_completion_rule, completion_rules = _parse_completion_rules(files.get(completion_rules_path), completion_rules_path)
+    return InputsSnapshot(
+        version=version,
+        files=MappingProxyType(files),
+        assignment_descriptions=MappingProxyType({k: v.strip() for k, v in _per_assignment(files, inputs_dir, "assignment_descriptions").items()}),
+        learning_objectives=MappingProxyType({k: as_lines(v) for k, v in _per_assignment(files, inputs_dir, "learning_objectives").items()}),
+        next_steps=MappingProxyType({k: as_lines(v) for k, v in _per_assignment(files, inputs_dir, "next_steps").items()}),
+        active_experiments=_parse_experiments(files.get(experiment_path), experiment_path),
+        default_completion_rule=default_completion_rule,
+        completion_rules=completion_rules,
+    )
+
+
+class InputsStore:
+    """Holds the current snapshot and swaps in a new one when inputs/ changes.
+
+    The first snapshot is built synchronously at construction. After
+    `start()`, a background task polls file mtimes every
+    `inputs_poll_interval` seconds and rebuilds off the event loop when
+    anything changed. Listeners registered with `on_change` run against the
+    new snapshot before it is published (e.g. to embed new learning
+    objectives), so requests never see a snapshot whose derived state is not
+    ready yet.
+    """
+
+    def __init__(self, inputs_dir: str = INPUTS_DIR, poll_interval: float = INPUTS_POLL_INTERVAL):
+        self.inputs_dir = inputs_dir
+        self.poll_interval = poll_interval
+        self._listeners: List[Callable[[InputsSnapshot], None]] = []
+        self._reload_lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._signature = _scan(inputs_dir)
+        self.current = build_snapshot(inputs_dir, version=1)
+        logging.info(f"Loaded inputs snapshot from {os.path.abspath(inputs_dir)} ({len(self.current.files)} files).")
+
+    def on_change(self, listener: Callable[[InputsSnapshot], None]):
+        self._listeners.append(listener)
+
+    def reload_if_changed(self) -> bool:
+        """Rebuilds and publishes a new snapshot if any input file changed. Safe to call from any thread."""
+        with self._reload_lock:
+            signature = _scan(self.inputs_dir)
+            if signature == self._signature:
+                return False
+            snapshot = build_snapshot(self.inputs_dir, version=self.current.version + 1)
+            for listener in self._listeners:
+                try:
+                    listener(snapshot)
+                except Exception as e:
+                    logging.error(f"Inputs reload listener {getattr(listener, '__name__', listener)} failed: {e}", exc_info=True)
+            self._signature = signature
+            self.current = snapshot
+            logging.info(f"Inputs changed on disk. Published snapshot v{snapshot.version} ({len(snapshot.files)} files).")
+            return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await asyncio.to_thread(self.reload_if_changed)
+            except Exception as e:
+                logging.error(f"Failed to reload inputs from {self.inputs_dir}: {e}")
+
+    def start(self):
+        if self._task is None and self.poll_interval > 0:
+            self._task = asyncio.get_running_loop().create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
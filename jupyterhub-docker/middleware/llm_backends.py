@@ -0,0 +1,322 @@
+# llm_backends.py - Pool of OpenAI-compatible LLM backends: routing, health probes, circuit breaking, hedging
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+import httpx
+
+from llm_scheduler import SchedulerRejected
+from metrics import LLM_BACKEND_CIRCUIT_OPEN, LLM_BACKEND_OUTSTANDING, LLM_BACKEND_REQUESTS, LLM_HEDGES
+
+# Use .env variables or fall back to defaults
+# JSON file listing the backends; without it the pool holds the single backend from webui_url/ollama_url
+LLM_BACKENDS_FILE = os.getenv("llm_backends_file", "./llm_backends.json")
+# Seconds between health probes of each backend (0 disables probing)
+LLM_HEALTH_INTERVAL = float(os.getenv("llm_health_interval", "10"))
+LLM_HEALTH_TIMEOUT = float(os.getenv("llm_health_timeout", "3"))
+# Consecutive failures that open a backend's circuit, and seconds before it is tried again
+LLM_BREAKER_FAILURES = int(os.getenv("llm_breaker_failures", "3"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("llm_breaker_cooldown", "30"))
+# Backends tried for one call when the first fails
+LLM_MAX_ATTEMPTS = int(os.getenv("llm_max_attempts", "2"))
+# Call classes (see llm_scheduler.py) that send a duplicate to a second backend when the first is slow
+LLM_HEDGE_PRIORITIES = tuple(p.strip() for p in os.getenv("llm_hedge_priorities", "").split(",") if p.strip())
+# The duplicate goes out after the p95 latency of recent calls to the same model, but no sooner than this
+LLM_HEDGE_MIN_DELAY_MS = float(os.getenv("llm_hedge_min_delay_ms", "1000"))
+LLM_HEDGE_WINDOW = 200  # Recent latencies per model used for the p95
+
+
+class NoBackendAvailable(Exception):
+    """No backend serves the model with a closed (or cooling-down) circuit."""
+
+
+def is_backend_failure(error: BaseException) -> bool:
+    """Errors that say something about the backend's health, as opposed to the request."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, httpx.RequestError)
+
+
+@dataclass(eq=False)
+class Backend:
+    name: str
+    base_url: str
+    chat_path: str = "/v1/chat/completions"
+    health_path: str = "/v1/models"
+    api_key: str = ""
+    models: Tuple[str, ...] = ()  # Empty: serves every model
+    weight: float = 1.0
+    outstanding: int = 0
+    consecutive_failures: int = 0
+    opened_at: Optional[float] = None  # When the circuit opened; None while closed
+    trial_in_flight: bool = False  # Half-open: one request is testing the backend
+
+    @property
+    def chat_url(self) -> str:
+        return f"{self.base_url}{self.chat_path}"
+
+    def headers(self, stream: bool = False) -> dict:
+        headers = {"Content-Type": "application/json", "Accept": "text/event-stream" if stream else "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def serves(self, model_name: str) -> bool:
+        return not self.models or model_name in self.models
+
+    def available(self, now: float) -> bool:
+        if self.opened_at is None:
+            return True
+        # Half-open after the cooldown: let a single request through to test it
+        return now - self.opened_at >= LLM_BREAKER_COOLDOWN and not self.trial_in_flight
+
+
+@dataclass
+class Attempt:
+    backend: Backend
+    task: asyncio.Task
+    hedge: bool = False
+
+
+def default_backend(webui_url: str, webui_api_key: str, ollama_url: str) -> Backend:
+    """The single backend used without a backends file: WebUI when an API key is set, otherwise Ollama."""
+    if webui_api_key == "":
+        return Backend(name="ollama", base_url=ollama_url.rstrip("/"))
+    return Backend(name="webui", base_url=webui_url.rstrip("/"), chat_path="/api/chat/completions",
+                   health_path="/api/models", api_key=webui_api_key)
+
+
+def load_backends(path: str, default_backend: Backend) -> List[Backend]:
+    """Reads the backend list from `path`, or returns `default_backend` alone if there is no such file."""
+    if not os.path.exists(path):
+        return [default_backend]
+    with open(path) as f:
+        config = json.load(f)
+    backends = []
+    for i, entry in enumerate(config.get("backends", [])):
+        backends.append(Backend(
+            name=entry.get("name") or f"backend{i}",
+            base_url=entry["base_url"].rstrip("/"),
+            chat_path=entry.get("chat_path", "/v1/chat/completions"),
+            health_path=entry.get("health_path", "/v1/models"),
+            # Keys stay in .env; the file names the variable that holds each one
+            api_key=os.getenv(entry["api_key_env"], "") if entry.get("api_key_env") else "",
+            models=tuple(entry.get("models", ())),
+            weight=max(float(entry.get("weight", 1)), 0.01),
+        ))
+    if not backends:
+        raise ValueError(f"{path} lists no backends")
+    logging.info(f"Loaded {len(backends)} LLM backends from {path}: {', '.join(b.name for b in backends)}")
+    return backends
+
+
+class BackendPool:
+    """Routes each LLM call to one of several OpenAI-compatible backends.
+
+    A call goes to the backend serving its model with the fewest requests in
+    flight from this worker, relative to its weight. A backend that fails
+    `llm_breaker_failures` times in a row (connection errors, timeouts, 5xx,
+    429) or fails a health probe that many times has its circuit opened: it
+    gets no traffic for `llm_breaker_cooldown` seconds, then a single trial
+    request or a passing probe closes it again. A failed call is retried on
+    another backend, up to `llm_max_attempts` backends.
+
+    For call classes in `llm_hedge_priorities`, if the first backend has not
+    answered after the p95 latency of recent calls to the model, the same
+    request is also sent to a second backend and the first answer wins.
+    """
+
+    def __init__(self, service: str, backends: List[Backend], health_interval: float = LLM_HEALTH_INTERVAL,
+                 max_attempts: int = LLM_MAX_ATTEMPTS, hedge_priorities: Tuple[str, ...] = LLM_HEDGE_PRIORITIES,
+                 hedge_min_delay_ms: float = LLM_HEDGE_MIN_DELAY_MS):
+        self.service = service
+        self.backends = backends
+        self.health_interval = health_interval
+        self.max_attempts = max(1, max_attempts)
+        self.hedge_priorities = hedge_priorities
+        self.hedge_min_delay = hedge_min_delay_ms / 1000
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._probe_task: Optional[asyncio.Task] = None
+        self._client: Optional[httpx.AsyncClient] = None
+
+    # --- Routing ---
+    def choose(self, model_name: str, exclude: Tuple[Backend, ...] = ()) -> Backend:
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b not in exclude and b.serves(model_name) and b.available(now)]
+        if not candidates:
+            raise NoBackendAvailable(f"No available LLM backend for model '{model_name}'")
+        # Least outstanding requests per unit of weight; random among ties so idle backends share the load
+        best = min((b.outstanding + 1) / b.weight for b in candidates)
+        return random.choice([b for b in candidates if (b.outstanding + 1) / b.weight == best])
+
+    def _record_success(self, backend: Backend):
+        if backend.opened_at is not None:
+            logging.info(f"LLM backend {backend.name} recovered; closing its circuit.")
+            LLM_BACKEND_CIRCUIT_OPEN.labels(service=self.service, backend=backend.name).dec()
+        backend.consecutive_failures = 0
+        backend.opened_at = None
+
+    def _record_failure(self, backend: Backend, reason: str):
+        backend.consecutive_failures += 1
+        if backend.opened_at is not None:
+            # A failed trial keeps the circuit open for another cooldown
+            backend.opened_at = time.monotonic()
+        elif backend.consecutive_failures >= LLM_BREAKER_FAILURES:
+            backend.opened_at = time.monotonic()
+            LLM_BACKEND_CIRCUIT_OPEN.labels(service=self.service, backend=backend.name).inc()
+            logging.error(f"LLM backend {backend.name} failed {backend.consecutive_failures} times ({reason}); "
+                          f"opening its circuit for {LLM_BREAKER_COOLDOWN:.0f}s.")
+
+    @asynccontextmanager
+    async def use(self, backend: Backend):
+        """Counts a request to `backend` as outstanding and feeds its outcome to the circuit breaker."""
+        trial = backend.opened_at is not None
+        backend.trial_in_flight = backend.trial_in_flight or trial
+        backend.outstanding += 1
+        outstanding = LLM_BACKEND_OUTSTANDING.labels(service=self.service, backend=backend.name)
+        outstanding.inc()
+        try:
+            yield
+        except SchedulerRejected:
+            LLM_BACKEND_REQUESTS.labels(service=self.service, backend=backend.name, outcome="rejected").inc()
+            raise
+        except asyncio.CancelledError:
+            LLM_BACKEND_REQUESTS.labels(service=self.service, backend=backend.name, outcome="cancelled").inc()
+            raise
+        except Exception as e:
+            if is_backend_failure(e):
+                self._record_failure(backend, type(e).__name__)
+                LLM_BACKEND_REQUESTS.labels(service=self.service, backend=backend.name, outcome="failure").inc()
+            else:
+                LLM_BACKEND_REQUESTS.labels(service=self.service, backend=backend.name, outcome="error").inc()
+            raise
+        else:
+            self._record_success(backend)
+            LLM_BACKEND_REQUESTS.labels(service=self.service, backend=backend.name, outcome="success").inc()
+        finally:
+            if trial:
+                backend.trial_in_flight = False
+            backend.outstanding -= 1
+            outstanding.dec()
+
+    def _hedge_delay(self, model_name: str) -> Optional[float]:
+        latencies = self._latencies.get(model_name)
+        if not latencies or len(latencies) < 20:
+            return None  # Not enough history to know what "slow" means
+        ordered = sorted(latencies)
+        return max(self.hedge_min_delay, ordered[int(len(ordered) * 0.95) - 1])
+
+    def _observe_latency(self, model_name: str, seconds: float):
+        self._latencies.setdefault(model_name, deque(maxlen=LLM_HEDGE_WINDOW)).append(seconds)
+
+    # --- Calls ---
+    async def call(self, model_name: str, send: Callable[[Backend], Awaitable], priority: str = "interactive"):
+        """Returns `await send(backend)` from the first backend that answers, with failover and optional hedging."""
+        tried: List[Backend] = []
+        last_error: Optional[BaseException] = None
+        while len(tried) < self.max_attempts:
+            try:
+                backend = self.choose(model_name, tuple(tried))
+            except NoBackendAvailable:
+                if last_error is not None:
+                    raise last_error
+                raise
+            tried.append(backend)
+            try:
+                return await self._call_hedged(model_name, backend, send, priority, tried)
+            except Exception as e:
+                if not (is_backend_failure(e) or isinstance(e, SchedulerRejected)):
+                    raise
+                last_error = e
+                logging.warning(f"LLM backend {backend.name} failed for {model_name} ({type(e).__name__}: {e}).")
+        raise last_error
+
+    async def _timed(self, model_name: str, backend: Backend, send: Callable[[Backend], Awaitable]):
+        async with self.use(backend):
+            started = time.perf_counter()
+            result = await send(backend)
+        self._observe_latency(model_name, time.perf_counter() - started)
+        return result
+
+    async def _call_hedged(self, model_name: str, backend: Backend, send: Callable[[Backend], Awaitable],
+                           priority: str, tried: List[Backend]):
+        delay = self._hedge_delay(model_name) if priority in self.hedge_priorities else None
+        primary = asyncio.create_task(self._timed(model_name, backend, send))
+        if delay is None:
+            return await primary
+        attempts = [Attempt(backend, primary)]
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if not done:
+                try:
+                    second = self.choose(model_name, tuple(tried))
+                except NoBackendAvailable:
+                    return await primary
+                tried.append(second)
+                LLM_HEDGES.labels(service=self.service, outcome="sent").inc()
+                logging.info(f"No answer from {backend.name} after {delay:.2f}s; hedging {model_name} to {second.name}.")
+                attempts.append(Attempt(second, asyncio.create_task(self._timed(model_name, second, send)), hedge=True))
+            pending = {attempt.task for attempt in attempts}
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if any(a.hedge and a.task is task for a in attempts):
+                            LLM_HEDGES.labels(service=self.service, outcome="won").inc()
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for attempt in attempts:
+                if not attempt.task.done():
+                    attempt.task.cancel()
+
+    @asynccontextmanager
+    async def stream(self, model_name: str, exclude: Tuple[Backend, ...] = ()):
+        """Yields the backend for a streamed call, which is not hedged; callers fail over while nothing was sent yet."""
+        backend = self.choose(model_name, exclude)
+        async with self.use(backend):
+            yield backend
+
+    # --- Health probes ---
+    async def _probe(self, backend: Backend):
+        try:
+            response = await self._client.get(f"{backend.base_url}{backend.health_path}", headers=backend.headers(),
+                                              timeout=LLM_HEALTH_TIMEOUT)
+            response.raise_for_status()
+        except Exception as e:
+            # Other statuses (401, 404) mean the probe path or key is wrong, not that the backend is down
+            if is_backend_failure(e):
+                logging.warning(f"Health probe of LLM backend {backend.name} failed: {type(e).__name__}")
+                self._record_failure(backend, f"health probe {type(e).__name__}")
+            return
+        if backend.opened_at is not None or backend.consecutive_failures:
+            self._record_success(backend)
+
+    async def _probe_loop(self):
+        while True:
+            await asyncio.gather(*(self._probe(backend) for backend in self.backends))
+            await asyncio.sleep(self.health_interval)
+
+    def start(self, client: httpx.AsyncClient):
+        """Starts the health probes on the worker's shared HTTP client."""
+        self._client = client
+        if self._probe_task is None and self.health_interval > 0:
+            self._probe_task = asyncio.get_running_loop().create_task(self._probe_loop())
+
+    async def stop(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+            self._probe_task = None
@@ -0,0 +1,272 @@
+# llm_scheduler.py - Priority queue and cross-worker concurrency caps for outbound LLM calls
+import asyncio
+import bisect
+import fcntl
+import hashlib
+import itertools
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+from metrics import LLM_QUEUE_DEPTH, LLM_QUEUE_WAIT_SECONDS, LLM_REJECTIONS, LLM_SLOTS_IN_USE
+
+# Lower values are served first
+PRIORITIES = {"interactive": 0, "ea": 1, "report": 2, "background": 3}
+# Classes that may not take the reserved slots
+LOW_PRIORITY = PRIORITIES["report"]
+
+# Use .env variables or fall back to defaults
+# Concurrent LLM requests per backend, across all TA and EA workers (match OLLAMA_NUM_PARALLEL)
+LLM_MAX_CONCURRENCY = int(os.getenv("llm_max_concurrency", "2"))
+# Per-backend overrides, e.g. "http://ollama:11434=1,http://webui:3000=4"
+LLM_BACKEND_LIMITS = os.getenv("llm_backend_limits", "")
+# Slots of each backend that report and background calls leave free for students
+LLM_RESERVED_SLOTS = int(os.getenv("llm_reserved_slots", "1"))
+# Calls a worker queues per backend before turning new ones away
+LLM_QUEUE_MAX_SIZE = int(os.getenv("llm_queue_max_size", "100"))
+# Seconds a call may wait for a slot
+LLM_QUEUE_TIMEOUT = float(os.getenv("llm_queue_timeout", "120"))
+# Directory of the lock files that represent slots; shared by the TA and EA in the container
+LLM_SLOT_DIR = os.getenv("llm_slot_dir", "/tmp/jelai-llm-slots")
+# How often the first queued call checks for a slot freed by another worker (milliseconds)
+LLM_SLOT_POLL_MS = float(os.getenv("llm_slot_poll_ms", "25"))
+
+
+class SchedulerRejected(Exception):
+    """A call was turned away without reaching the LLM (`reason`: queue_full, displaced or timeout)."""
+
+    def __init__(self, reason: str, backend: str, priority: str):
+        super().__init__(f"LLM call ({priority}) to {backend} rejected: {reason}")
+        self.reason = reason
+
+
+def backend_key(url: str) -> str:
+    """scheme://host:port of a URL; calls to the same server share its slots."""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def parse_backend_limits(spec: str) -> Dict[str, int]:
+    limits = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        url, _, limit = item.rpartition("=")
+        try:
+            limits[backend_key(url.strip())] = max(1, int(limit))
+        except ValueError:
+            logging.error(f"Ignoring invalid llm_backend_limits entry '{item.strip()}'.")
+    return limits
+
+
+class _Waiter:
+    __slots__ = ("key", "priority", "queued_at", "wakeup", "rejected", "waiting_fd")
+
+    def __init__(self, priority: str, seq: int):
+        self.key = (PRIORITIES[priority], seq)
+        self.priority = priority
+        self.queued_at = time.perf_counter()
+        self.wakeup = asyncio.Event()
+        self.rejected: Optional[str] = None
+        self.waiting_fd: Optional[int] = None  # Shared lock telling other workers this class is waiting
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return self.key < other.key
+
+
+class _Backend:
+    """Slots and queued calls of one LLM server in this worker."""
+
+    def __init__(self, key: str, limit: int, slot_dir: str):
+        self.key = key
+        self.label = urlsplit(key).netloc or key
+        self.limit = limit
+        digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+        self.slot_paths = [os.path.join(slot_dir, f"{digest}-{i}.lock") for i in range(limit)]
+        self.waiting_paths = {priority: os.path.join(slot_dir, f"{digest}-waiting-{priority}.lock") for priority in PRIORITIES}
+        self.waiters: List[_Waiter] = []  # Sorted, best first
+
+    @property
+    def reserve_honoured(self) -> bool:
+        return self.limit > LLM_RESERVED_SLOTS
+
+    def try_lock(self, priority: str) -> Optional[int]:
+        """Takes a free slot without blocking and returns its locked file descriptor, or None."""
+        usable = self.limit
+        if PRIORITIES[priority] >= LOW_PRIORITY:
+            # Without a slot to spare, low classes still get the first one; they only wait for higher classes queued ahead
+            usable = max(1, self.limit - LLM_RESERVED_SLOTS)
+        for path in self.slot_paths[:usable]:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    def announce_waiting(self, priority: str) -> Optional[int]:
+        """Holds a shared lock while this worker's first queued call is of `priority`."""
+        fd = os.open(self.waiting_paths[priority], os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            # Another worker is checking this class right now; try again on the next poll
+            os.close(fd)
+            return None
+
+    def higher_priority_waiting(self, priority: str) -> bool:
+        """Whether any worker has a call of a higher class than `priority` queued for this backend."""
+        for other, rank in PRIORITIES.items():
+            if rank >= PRIORITIES[priority]:
+                continue
+            fd = os.open(self.waiting_paths[other], os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            finally:
+                os.close(fd)
+        return False
+
+    def wake_head(self):
+        if self.waiters:
+            self.waiters[0].wakeup.set()
+
+
+class LLMScheduler:
+    """Orders a worker's LLM calls by priority and caps concurrent calls per backend across workers.
+
+    A slot is an exclusive `flock` on one of `limit` lock files per backend
+    under `llm_slot_dir`. Every TA and EA worker locks the same files, so the
+    cap holds for the whole container, and the kernel releases a crashed
+    worker's slots. Locks are opened after the fork, never inherited.
+
+    Inside a worker, calls queue in priority order (interactive > ea > report
+    > background, then arrival) and only the first one tries for a slot. It
+    retries as soon as a local call finishes, and every `llm_slot_poll_ms` for
+    slots freed by other workers. While it waits it holds a shared lock on a
+    per-class file, and it does not take a slot while another worker holds
+    one for a higher class, so priorities also apply between workers. Report and background calls never take the
+    last `llm_reserved_slots` slots of a backend, so a long report cannot hold
+    up a student's answer. The exception is a backend with no more slots than
+    that (e.g. CPU Ollama with one slot): reports would never run, so they may
+    use its first slot and a running report does delay students; a warning is
+    logged when such a backend is first used. When the queue is full, a new
+    call displaces the lowest-priority queued call if it outranks it, and is
+    rejected otherwise. `slot(timeout=...)` shortens the wait for a call whose
+    caller gives up sooner than `llm_queue_timeout`.
+    """
+
+    def __init__(self, service: str, default_limit: int = LLM_MAX_CONCURRENCY, backend_limits: Optional[Dict[str, int]] = None,
+                 max_queue_size: int = LLM_QUEUE_MAX_SIZE, queue_timeout: float = LLM_QUEUE_TIMEOUT,
+                 slot_dir: str = LLM_SLOT_DIR, poll_interval_ms: float = LLM_SLOT_POLL_MS):
+        self.service = service
+        self.default_limit = max(1, default_limit)
+        self.backend_limits = parse_backend_limits(LLM_BACKEND_LIMITS) if backend_limits is None else backend_limits
+        self.max_queue_size = max(1, max_queue_size)
+        self.queue_timeout = queue_timeout
+        self.slot_dir = slot_dir
+        self.poll_interval = max(1.0, poll_interval_ms) / 1000
+        self._backends: Dict[str, _Backend] = {}
+        self._seq = itertools.count()
+
+    def _backend(self, url: str) -> _Backend:
+        key = backend_key(url)
+        backend = self._backends.get(key)
+        if backend is None:
+            os.makedirs(self.slot_dir, exist_ok=True)
+            backend = _Backend(key, self.backend_limits.get(key, self.default_limit), self.slot_dir)
+            self._backends[key] = backend
+            logging.info(f"LLM scheduler ({self.service}): {backend.limit} slot(s) for {key}")
+            if LLM_RESERVED_SLOTS > 0 and not backend.reserve_honoured:
+                logging.warning(f"LLM scheduler ({self.service}): {key} has {backend.limit} slot(s), not more than "
+                                f"llm_reserved_slots={LLM_RESERVED_SLOTS}, so no slot can be kept free for students. "
+                                f"Report and background calls will share it and can delay student answers; "
+                                f"raise llm_max_concurrency (and OLLAMA_NUM_PARALLEL) to keep a slot reserved.")
+        return backend
+
+    def _reject(self, backend: _Backend, priority: str, reason: str):
+        LLM_REJECTIONS.labels(service=self.service, priority=priority, reason=reason).inc()
+        logging.warning(f"LLM scheduler ({self.service}): {priority} call to {backend.label} rejected ({reason}).")
+
+    def _enqueue(self, backend: _Backend, priority: str) -> _Waiter:
+        waiter = _Waiter(priority, next(self._seq))
+        if len(backend.waiters) >= self.max_queue_size:
+            lowest = backend.waiters[-1]
+            if not waiter < lowest:
+                self._reject(backend, priority, "queue_full")
+                raise SchedulerRejected("queue_full", backend.label, priority)
+            # The displaced call sees `rejected` when it wakes up and removes itself
+            backend.waiters.pop()
+            lowest.rejected = "displaced"
+            lowest.wakeup.set()
+            self._reject(backend, lowest.priority, "displaced")
+        bisect.insort(backend.waiters, waiter)
+        LLM_QUEUE_DEPTH.labels(service=self.service, priority=priority).inc()
+        return waiter
+
+    def _dequeue(self, backend: _Backend, waiter: _Waiter):
+        LLM_QUEUE_DEPTH.labels(service=self.service, priority=waiter.priority).dec()
+        if waiter.waiting_fd is not None:
+            os.close(waiter.waiting_fd)
+            waiter.waiting_fd = None
+        if waiter in backend.waiters:
+            was_head = backend.waiters[0] is waiter
+            backend.waiters.remove(waiter)
+            if was_head:
+                backend.wake_head()
+
+    async def _acquire(self, backend: _Backend, priority: str, timeout: Optional[float] = None) -> int:
+        waiter = self._enqueue(backend, priority)
+        deadline = waiter.queued_at + (self.queue_timeout if timeout is None else min(self.queue_timeout, timeout))
+        try:
+            while True:
+                if waiter.rejected:
+                    raise SchedulerRejected(waiter.rejected, backend.label, priority)
+                is_head = backend.waiters[0] is waiter
+                if is_head:
+                    if waiter.waiting_fd is None:
+                        waiter.waiting_fd = backend.announce_waiting(priority)
+                    # A freed slot goes to the best class queued in any worker, not to whoever sees it first
+                    fd = None if backend.higher_priority_waiting(priority) else backend.try_lock(priority)
+                    if fd is not None:
+                        LLM_QUEUE_WAIT_SECONDS.labels(service=self.service, priority=priority).observe(
+                            time.perf_counter() - waiter.queued_at)
+                        return fd
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self._reject(backend, priority, "timeout")
+                    raise SchedulerRejected("timeout", backend.label, priority)
+                waiter.wakeup.clear()
+                # Only the head polls for slots freed by other workers; the rest wait their turn
+                try:
+                    await asyncio.wait_for(waiter.wakeup.wait(), min(remaining, self.poll_interval) if is_head else remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._dequeue(backend, waiter)
+
+    @asynccontextmanager
+    async def slot(self, url: str, priority: str = "interactive", timeout: Optional[float] = None):
+        """Holds one of the backend's slots for the duration of an LLM request to `url`.
+
+        `timeout` caps the wait for a slot below `llm_queue_timeout`.
+        """
+        if priority not in PRIORITIES:
+            logging.warning(f"Unknown LLM priority '{priority}'. Using 'background'.")
+            priority = "background"
+        backend = self._backend(url)
+        fd = await self._acquire(backend, priority, timeout)
+        in_use = LLM_SLOTS_IN_USE.labels(service=self.service, backend=backend.label)
+        in_use.inc()
+        try:
+            yield
+        finally:
+            os.close(fd)  # Releases the lock
+            in_use.dec()
+            backend.wake_head()
@@ -0,0 +1,106 @@
+# lo_index.py - Per-assignment learning-objective embeddings, persisted as memory-mapped .npy files
+import asyncio
+import hashlib
+import logging
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Use .env variables or fall back to defaults
+LO_INDEX_DIR = os.getenv("lo_index_dir", "/app/chat_histories/lo_index")
+
+
+def lo_content_hash(model_name: str, learning_objectives: List[str]) -> str:
+    """Identifies one list of LOs as encoded by one model."""
+    return hashlib.sha256((model_name + "\x00" + "\n".join(learning_objectives)).encode("utf-8")).hexdigest()[:16]
+
+
+class LOIndex:
+    """Unit-length embeddings for every assignment's learning objectives.
+
+    Each distinct LO list is stored as `<assignment>-<content hash>.npy` and
+    opened with `mmap_mode="r"`, so the workers share the pages through the OS
+    page cache and a restart only encodes lists whose text changed. Lookups are
+    keyed by the content hash of the list being matched, so an assignment
+    always gets its own vectors, including the default LOs used for
+    assignments without a file.
+    """
+
+    def __init__(self, model_name: str, cache_dir: str = LO_INDEX_DIR):
+        self.model_name = model_name
+        self.cache_dir = cache_dir
+        self._matrices: Dict[str, np.ndarray] = {}
+        self._model = None
+
+    def _path(self, assignment_id: str, content_hash: str) -> str:
+        return os.path.join(self.cache_dir, f"{assignment_id}-{content_hash}.npy")
+
+    def _remove_stale(self, assignment_id: str, keep: str):
+        prefix = f"{assignment_id}-"
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(prefix) and name.endswith(".npy") and name != os.path.basename(keep):
+                # Only drop files whose suffix is a content hash, not other assignments sharing the prefix
+                if len(name) == len(prefix) + 16 + len(".npy"):
+                    try:
+                        os.remove(os.path.join(self.cache_dir, name))
+                    except OSError:
+                        pass
+
+    def _load_or_encode(self, assignment_id: str, learning_objectives: List[str]) -> np.ndarray:
+        content_hash = lo_content_hash(self.model_name, learning_objectives)
+        if content_hash in self._matrices:
+            return self._matrices[content_hash]
+        path = self._path(assignment_id, content_hash)
+        try:
+            matrix = np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            matrix = None
+        if matrix is None or matrix.shape[0] != len(learning_objectives):
+            if self._model is None:
+                raise RuntimeError("LO index has no embedding model to encode new learning objectives.")
+            matrix = self._model.encode(learning_objectives, convert_to_numpy=True, normalize_embeddings=True).astype(np.float32)
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, matrix)
+                os.replace(tmp_path, path)  # Other workers see either no file or a complete one
+                self._remove_stale(assignment_id, path)
+                matrix = np.load(path, mmap_mode="r")
+                logging.info(f"Encoded {len(learning_objectives)} learning objectives for '{assignment_id}' into {path}")
+            except OSError as e:
+                logging.warning(f"Could not persist LO embeddings for '{assignment_id}' to {self.cache_dir}: {e}. Keeping them in memory.")
+        self._matrices[content_hash] = matrix
+        return matrix
+
+    def build(self, model, learning_objectives_map: Dict[str, List[str]], extra: Iterable[Tuple[str, List[str]]] = ()) -> int:
+        """Loads or encodes the matrix for every assignment; returns how many LO lists are indexed."""
+        self._model = model
+        for assignment_id, learning_objectives in list(learning_objectives_map.items()) + list(extra):
+            if not learning_objectives:
+                continue
+            try:
+                self._load_or_encode(assignment_id, learning_objectives)
+            except Exception as e:
+                logging.error(f"Failed to index learning objectives for '{assignment_id}': {e}")
+        return len(self._matrices)
+
+    async def best_match(self, question_embedding: np.ndarray, learning_objectives: List[str],
+                   assignment_id: str = "default") -> Optional[Tuple[int, float]]:
+        """Returns (index into `learning_objectives`, cosine similarity) of the closest LO.
+
+        A list that is not indexed yet is encoded on a worker thread, so the
+        event loop keeps serving other requests meanwhile.
+        """
+        if question_embedding is None or not learning_objectives:
+            return None
+        matrix = self._matrices.get(lo_content_hash(self.model_name, learning_objectives))
+        if matrix is None:
+            if self._model is None:
+                return None
+            # LO list not seen at startup (e.g. changed since); encode it once and keep it
+            matrix = await asyncio.to_thread(self._load_or_encode, assignment_id, learning_objectives)
+        scores = matrix @ question_embedding
+        best = int(np.argmax(scores))
+        return best, float(scores[best])
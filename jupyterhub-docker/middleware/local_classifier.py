@@ -0,0 +1,170 @@
+# local_classifier.py - kNN question classifier over sentence embeddings, trained from chat history
+import argparse
+import logging
+import os
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+import db
+from classification_cache import normalize_question
+
+# Use .env variables or fall back to defaults
+# "llm" classifies every question with the LLM; "local" tries the kNN model first
+CLASSIFICATION_MODE = os.getenv("classification_mode", "llm").strip().lower()
+LOCAL_CLASSIFIER_PATH = os.getenv("local_classifier_path", "/app/chat_histories/local_classifier.npz")
+# Share of the neighbours' similarity-weighted vote the winning label needs to skip the LLM
+LOCAL_CLASSIFIER_THRESHOLD = float(os.getenv("local_classifier_threshold", "0.8"))
+LOCAL_CLASSIFIER_K = int(os.getenv("local_classifier_k", "7"))
+# Neighbours less similar than this do not vote
+LOCAL_CLASSIFIER_MIN_SIMILARITY = float(os.getenv("local_classifier_min_similarity", "0.3"))
+LOCAL_CLASSIFIER_MAX_EXAMPLES = int(os.getenv("local_classifier_max_examples", "20000"))
+LOCAL_CLASSIFIER_MIN_EXAMPLES = int(os.getenv("local_classifier_min_examples", "50"))
+
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+DATABASE_FILE = "/app/chat_histories/chat_history.db"
+POSSIBLE_CLASSIFICATIONS_FILE = "./inputs/classification_options.txt"
+
+
+class LocalClassifier:
+    """Similarity-weighted k-nearest-neighbour classifier over question embeddings.
+
+    The model is a matrix of unit-length MiniLM embeddings of questions the LLM
+    already labeled, plus their labels. Prediction is one matrix-vector product
+    against the embedding the TA computes anyway, so it costs well under a
+    millisecond. The model file is reloaded when `train` rewrites it.
+    """
+
+    def __init__(self, path: str = LOCAL_CLASSIFIER_PATH, k: int = LOCAL_CLASSIFIER_K,
+                 min_similarity: float = LOCAL_CLASSIFIER_MIN_SIMILARITY):
+        self.path = path
+        self.k = k
+        self.min_similarity = min_similarity
+        self.embeddings: Optional[np.ndarray] = None
+        self.labels: Optional[np.ndarray] = None
+        self.options: List[str] = []
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+
+    @property
+    def ready(self) -> bool:
+        return self.embeddings is not None and len(self.embeddings) > 0
+
+    def fit(self, embeddings: np.ndarray, labels: List[str], options: List[str]):
+        self.embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.labels = np.asarray(labels)
+        self.options = list(options)
+        return self
+
+    def save(self, path: Optional[str] = None):
+        path = path or self.path
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, embeddings=self.embeddings, labels=self.labels, options=np.asarray(self.options),
+                 model_name=np.asarray(EMBEDDING_MODEL_NAME))
+        os.replace(tmp_path, path)  # Workers never see a half-written model
+
+    def maybe_reload(self, check_interval: float = 60.0):
+        """Loads the model file if it appeared or changed since the last check."""
+        now = time.monotonic()
+        if now - self._checked_at < check_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with np.load(self.path) as data:
+                self.fit(data["embeddings"], list(data["labels"]), [str(o) for o in data["options"]])
+            self._mtime = mtime
+            logging.info(f"Loaded local classifier from {self.path} ({len(self.labels)} examples, labels: {self.options}).")
+        except Exception as e:
+            logging.error(f"Failed to load local classifier from {self.path}: {e}")
+
+    def predict(self, embedding: np.ndarray) -> Tuple[Optional[str], float]:
+        """Returns (label, confidence), where confidence is the winner's share of the weighted vote."""
+        if not self.ready or embedding is None:
+            return None, 0.0
+        scores = self.embeddings @ embedding
+        k = min(self.k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        votes = {}
+        for idx in top:
+            if scores[idx] >= self.min_similarity:
+                label = str(self.labels[idx])
+                votes[label] = votes.get(label, 0.0) + float(scores[idx])
+        total = sum(votes.values())
+        if total <= 0:
+            return None, 0.0
+        label = max(votes, key=votes.get)
+        return label, votes[label] / total
+
+
+def load_training_examples(database: "db.Database", options: List[str], limit: int = LOCAL_CLASSIFIER_MAX_EXAMPLES) -> Tuple[List[str], List[str]]:
+    """Returns (questions, labels) the LLM assigned in chat history, one per normalized question, newest label wins."""
+    rows = database.run_sync(db.fetch_labeled_questions, limit)
+    seen = set()
+    questions, labels = [], []
+    for row in rows:
+        label = row["message_classification"].strip().lower()
+        key = normalize_question(row["message_text"])
+        if label not in options or not key or key in seen:
+            continue
+        seen.add(key)
+        questions.append(row["message_text"])
+        labels.append(label)
+    return questions, labels
+
+
+def load_options(path: str = POSSIBLE_CLASSIFICATIONS_FILE) -> List[str]:
+    with open(path, 'r') as f:
+        return [line.strip().lower() for line in f if line.strip()]
+
+
+def encode(model, questions: List[str]) -> np.ndarray:
+    return model.encode(questions, batch_size=64, convert_to_numpy=True, normalize_embeddings=True)
+
+
+def train(database_file: str = DATABASE_FILE, out_path: str = LOCAL_CLASSIFIER_PATH,
+          options_file: str = POSSIBLE_CLASSIFICATIONS_FILE) -> int:
+    """Builds the kNN model from labeled chat history and writes it where the TA picks it up."""
+    from sentence_transformers import SentenceTransformer
+
+    options = load_options(options_file)
+    database = db.Database(database_file)
+    try:
+        questions, labels = load_training_examples(database, options)
+    finally:
+        database.close()
+    if len(questions) < LOCAL_CLASSIFIER_MIN_EXAMPLES:
+        logging.error(f"Only {len(questions)} labeled questions found (need {LOCAL_CLASSIFIER_MIN_EXAMPLES}). Model not written.")
+        return 1
+
+    model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    started = time.perf_counter()
+    embeddings = encode(model, questions)
+    LocalClassifier(out_path).fit(embeddings, labels, options).save()
+    counts = {label: labels.count(label) for label in options}
+    logging.info(f"Wrote local classifier to {out_path}: {len(questions)} examples {counts}, encoded in {time.perf_counter() - started:.1f}s.")
+    return 0
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - local_classifier - %(message)s')
+    parser = argparse.ArgumentParser(description="Train the local question classifier from labeled chat history.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    train_parser = subparsers.add_parser("train", help="Build or refresh the model file from chat_history")
+    train_parser.add_argument("--db", default=DATABASE_FILE, help="Path to chat_history.db")
+    train_parser.add_argument("--out", default=LOCAL_CLASSIFIER_PATH, help="Where to write the model (.npz)")
+    train_parser.add_argument("--options", default=POSSIBLE_CLASSIFICATIONS_FILE, help="Classification options file")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        raise SystemExit(train(args.db, args.out, args.options))
+
+
+if __name__ == "__main__":
+    main()
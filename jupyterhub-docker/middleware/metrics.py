@@ -0,0 +1,232 @@
+# metrics.py - Prometheus metrics shared by the TA and EA handlers
+#
+# Each handler runs several worker processes. When PROMETHEUS_MULTIPROC_DIR is set (start.sh does),
+# prometheus_client keeps every worker's values in files there and /metrics aggregates all of them,
+# whichever worker answers the scrape. Gauges use "livesum": the sum over workers that are still running.
+import os
+import time
+from contextlib import contextmanager
+
+from fastapi import Response
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# --- Outbound HTTP pool ---
+HTTP_POOL_MAX_CONNECTIONS = Gauge(
+    "jelai_http_pool_max_connections", "Configured connection limit of the outbound HTTP pool", ["pool"],
+    multiprocess_mode="livesum",
+)
+HTTP_POOL_IN_FLIGHT = Gauge(
+    "jelai_http_pool_in_flight_requests", "Outbound requests currently waiting for or using a pooled connection", ["pool", "target"],
+    multiprocess_mode="livesum",
+)
+HTTP_POOL_CONNECTIONS = Gauge(
+    "jelai_http_pool_connections", "Open pooled connections by state", ["pool", "state"],
+    multiprocess_mode="livesum",
+)
+HTTP_POOL_TIMEOUTS = Counter(
+    "jelai_http_pool_timeouts_total", "Requests that gave up waiting for a free pooled connection", ["pool", "target"]
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "jelai_http_request_duration_seconds", "Duration of outbound HTTP requests, including pool wait", ["pool", "target"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120),
+)
+
+# --- Classification cache ---
+CLASSIFICATION_CACHE_LOOKUPS = Counter(
+    "jelai_classification_cache_lookups_total", "Classification cache lookups by result (exact_hit, semantic_hit, miss)", ["result"]
+)
+CLASSIFICATION_CACHE_ENTRIES = Gauge(
+    "jelai_classification_cache_entries", "Questions currently held in the classification cache",
+    multiprocess_mode="livesum",
+)
+CLASSIFICATION_CACHE_INVALIDATIONS = Counter(
+    "jelai_classification_cache_invalidations_total", "Cache clears caused by a changed classification prompt or options"
+)
+
+# --- Local classifier ---
+LOCAL_CLASSIFIER_DECISIONS = Counter(
+    "jelai_local_classifier_decisions_total", "Questions the local classifier labeled itself (local) or passed to the LLM (fallback)", ["outcome"]
+)
+
+# --- Profile write-behind queue ---
+PROFILE_QUEUE_DEPTH = Gauge(
+    "jelai_profile_queue_depth", "Student profiles with updates waiting to be flushed",
+    multiprocess_mode="livesum",
+)
+PROFILE_FLUSH_SECONDS = Histogram(
+    "jelai_profile_flush_duration_seconds", "Time to write one batch of profile updates",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+PROFILE_FLUSHED_UPDATES = Counter(
+    "jelai_profile_flushed_updates_total", "Per-message profile updates written to the database"
+)
+
+# --- Embedding executor ---
+EMBEDDING_BATCH_SIZE = Histogram(
+    "jelai_embedding_batch_size", "Texts encoded per batched model call",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+EMBEDDING_BATCH_SECONDS = Histogram(
+    "jelai_embedding_batch_duration_seconds", "Time to encode one batch of texts",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+EMBEDDING_QUEUE_WAIT_SECONDS = Histogram(
+    "jelai_embedding_queue_wait_seconds", "Time an encode request waited before its batch started",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+
+# --- LLM scheduler ---
+LLM_QUEUE_DEPTH = Gauge(
+    "jelai_llm_queue_depth", "LLM calls waiting for a backend slot", ["service", "priority"],
+    multiprocess_mode="livesum",
+)
+LLM_QUEUE_WAIT_SECONDS = Histogram(
+    "jelai_llm_queue_wait_seconds", "Time an LLM call waited for a backend slot", ["service", "priority"],
+    buckets=(0.001, 0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+)
+LLM_SLOTS_IN_USE = Gauge(
+    "jelai_llm_slots_in_use", "Backend slots held by running LLM calls", ["service", "backend"],
+    multiprocess_mode="livesum",
+)
+LLM_REJECTIONS = Counter(
+    "jelai_llm_rejections_total", "LLM calls turned away by the scheduler (queue_full, displaced, timeout)", ["service", "priority", "reason"]
+)
+
+# --- LLM backend pool ---
+LLM_BACKEND_REQUESTS = Counter(
+    "jelai_llm_backend_requests_total", "LLM requests per backend by outcome (success, failure, error, rejected, cancelled)",
+    ["service", "backend", "outcome"]
+)
+LLM_BACKEND_OUTSTANDING = Gauge(
+    "jelai_llm_backend_outstanding_requests", "LLM requests routed to a backend and not finished yet", ["service", "backend"],
+    multiprocess_mode="livesum",
+)
+LLM_BACKEND_CIRCUIT_OPEN = Gauge(
+    "jelai_llm_backend_circuit_open", "Workers whose circuit breaker for the backend is open", ["service", "backend"],
+    multiprocess_mode="livesum",
+)
+LLM_HEDGES = Counter(
+    "jelai_llm_hedges_total", "Duplicate requests sent to a second backend (sent) and how many answered first (won)", ["service", "outcome"]
+)
+
+# --- EA answer cache ---
+EA_CACHE_LOOKUPS = Counter(
+    "jelai_ea_cache_lookups_total", "EA answer cache lookups by result (hit, miss, skipped: no question embedding)", ["result"]
+)
+EA_CACHE_SAVED_SECONDS = Counter(
+    "jelai_ea_cache_saved_seconds_total", "EA generation time avoided by cache hits (the time the cached answer took)"
+)
+EA_CACHE_ENTRIES = Gauge(
+    "jelai_ea_cache_entries", "Answers in the EA cache, shared by all EA workers",
+    multiprocess_mode="livemostrecent",
+)
+EA_CACHE_INVALIDATIONS = Counter(
+    "jelai_ea_cache_invalidations_total", "Cache clears caused by a changed EA system prompt or model"
+)
+
+# --- Context packer ---
+CONTEXT_PROMPT_TOKENS = Histogram(
+    "jelai_context_prompt_tokens", "Estimated prompt tokens after packing, by prompt", ["service", "prompt"],
+    buckets=(250, 500, 1000, 2000, 3000, 4000, 6000, 8000, 12000, 16000, 32000),
+)
+CONTEXT_TOKENS_SAVED = Counter(
+    "jelai_context_tokens_saved_total", "Estimated prompt tokens cut to fit the token budget", ["service", "prompt", "section"]
+)
+
+# --- Conversation summaries ---
+SUMMARY_UPDATES = Counter(
+    "jelai_conversation_summary_updates_total", "Background conversation summary updates by outcome (updated, failed)", ["outcome"]
+)
+SUMMARY_UPDATE_SECONDS = Histogram(
+    "jelai_conversation_summary_update_duration_seconds", "Time to fold older messages into a conversation summary",
+    buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+)
+
+# --- Prompt layout ---
+PROMPT_PREFIXES = Counter(
+    "jelai_prompt_prefixes_compiled_total", "Static prompt prefixes built per worker (one per assignment, A/B group and prompt)", ["service"]
+)
+PROMPT_STATIC_SHARE = Histogram(
+    "jelai_prompt_static_share", "Share of a prompt's characters in its static, cacheable prefix", ["service", "prompt"],
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+)
+
+# --- Report jobs ---
+REPORT_JOBS = Counter(
+    "jelai_report_jobs_total", "/report requests by outcome (cached, joined, started) and finished jobs (completed, failed)", ["outcome"]
+)
+REPORT_JOB_SECONDS = Histogram(
+    "jelai_report_job_duration_seconds", "Time from queueing a report job to its result",
+    buckets=(1, 2.5, 5, 10, 20, 30, 60, 90, 120, 180, 300),
+)
+
+# --- Activity aggregates ---
+ACTIVITY_EVENTS = Counter(
+    "jelai_activity_events_total", "Notebook log events received, by outcome (counted, duplicate, invalid)", ["outcome"]
+)
+ACTIVITY_TABLE_CHARS = Histogram(
+    "jelai_activity_table_chars", "Size of the per-learning-objective activity table sent with a report prompt",
+    buckets=(100, 250, 500, 1000, 2000, 4000, 8000),
+)
+
+# --- A/B experiments ---
+EXPERIMENT_LOOKUPS = Counter(
+    "jelai_experiment_lookups_total", "A/B group lookups, by result (cached, computed)", ["result"]
+)
+EXPERIMENT_AUDIT_QUEUE_DEPTH = Gauge(
+    "jelai_experiment_audit_queue_depth", "Experiment assignments waiting to be recorded",
+    multiprocess_mode="livesum",
+)
+EXPERIMENT_AUDIT_WRITES = Counter(
+    "jelai_experiment_audit_writes_total", "Experiment assignments written to student_experiment_assignments"
+)
+EXPERIMENT_GROUP_CHANGES = Counter(
+    "jelai_experiment_group_changes_total", "Students computed into a group other than their first one (e.g. after weights were edited)", ["experiment"]
+)
+
+# --- Request pipeline ---
+PIPELINE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120)
+REQUEST_SECONDS = Histogram(
+    "jelai_request_duration_seconds", "End-to-end time to handle a request, by endpoint", ["service", "endpoint"],
+    buckets=PIPELINE_BUCKETS,
+)
+STAGE_SECONDS = Histogram(
+    "jelai_stage_duration_seconds", "Time spent in one stage of handling a student message", ["service", "stage"],
+    buckets=PIPELINE_BUCKETS,
+)
+STAGE_ERRORS = Counter(
+    "jelai_stage_errors_total", "Stages that failed, whether or not a fallback covered the failure", ["service", "stage"]
+)
+FALLBACKS = Counter(
+    "jelai_fallbacks_total", "Default values used in place of a failed or missing result", ["service", "fallback"]
+)
+
+
+@contextmanager
+def time_stage(service: str, stage: str):
+    """Observes the duration of a block in STAGE_SECONDS and counts exceptions that escape it."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(service=service, stage=stage).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(service=service, stage=stage).observe(time.perf_counter() - started)
+
+
+def mark_process_dead(pid: int):
+    """Drops a stopped worker's live gauges from the aggregate (called by the gunicorn master)."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
+
+
+def metrics_response() -> Response:
+    """Renders all metrics in the Prometheus text format, aggregated over workers in multiprocess mode."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,226 @@
+# parquet_export.py - Incremental export of the middleware database to partitioned Parquet for analysis
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+# Rows read from SQLite per record batch; bounds the memory an export needs
+EXPORT_CHUNK_ROWS = 50_000
+# Rows newer than this are left for the next run, so a question is exported after its classification was written
+EXPORT_SETTLE_SECONDS = 300
+# High-water marks of earlier runs, kept next to the exported tables (pyarrow skips files starting with '_')
+EXPORT_STATE_NAME = "_export_state.json"
+
+CHAT_HISTORY_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("student_id", pa.string()),
+    ("timestamp", pa.float64()),
+    ("message_type", pa.string()),
+    ("message_text", pa.string()),
+    ("message_classification", pa.string()),
+    ("file_name", pa.string()),
+    ("date", pa.string()),
+])
+STUDENT_PROFILES_SCHEMA = pa.schema([
+    ("student_id", pa.string()),
+    ("file_name", pa.string()),
+    ("total_questions", pa.int64()),
+    ("instrumental_count", pa.int64()),
+    ("executive_count", pa.int64()),
+    ("other_count", pa.int64()),
+    ("last_interaction_timestamp", pa.float64()),
+    ("needs_guidance_flag", pa.int64()),
+    ("consecutive_executive_count", pa.int64()),
+    ("last_question_classification", pa.string()),
+    ("last_instrumental_example", pa.string()),
+    ("last_executive_example", pa.string()),
+    ("date", pa.string()),
+])
+EXPERIMENT_ASSIGNMENTS_SCHEMA = pa.schema([
+    ("student_id", pa.string()),
+    ("experiment_id", pa.string()),
+    ("group_id", pa.string()),
+    ("assigned_at", pa.string()),
+    ("date", pa.string()),
+])
+EXPERIMENT_GROUP_HISTORY_SCHEMA = pa.schema([
+    ("student_id", pa.string()),
+    ("experiment_id", pa.string()),
+    ("group_id", pa.string()),
+    ("first_seen_at", pa.string()),
+    ("date", pa.string()),
+])
+
+
+def load_state(out_dir: str) -> dict:
+    try:
+        with open(os.path.join(out_dir, EXPORT_STATE_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(out_dir: str, state: dict):
+    """Replaces the state file in one rename, so an interrupted run leaves the previous marks."""
+    path = os.path.join(out_dir, EXPORT_STATE_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def _batches(cursor: sqlite3.Cursor, schema: pa.Schema, chunk_rows: int) -> Iterator[pa.RecordBatch]:
+    while True:
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        yield pa.RecordBatch.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                                         schema=schema)
+
+
+def _write(cursor: sqlite3.Cursor, schema: pa.Schema, out_dir: str, table: str, partition_by: list, run_key: str,
+           chunk_rows: int) -> int:
+    """Streams the cursor's rows into hive-partitioned Parquet under out_dir/table; returns the number of rows.
+
+    File names carry `run_key` (the high-water mark the run started from), so
+    rerunning after an interrupted export overwrites that run's files instead
+    of adding a second copy. The table directory exists even without rows, so
+    readers get an empty table rather than a missing path.
+    """
+    os.makedirs(os.path.join(out_dir, table), exist_ok=True)
+    rows = 0
+
+    def counted():
+        nonlocal rows
+        for batch in _batches(cursor, schema, chunk_rows):
+            rows += batch.num_rows
+            yield batch
+
+    ds.write_dataset(
+        pa.RecordBatchReader.from_batches(schema, counted()),
+        os.path.join(out_dir, table),
+        format="parquet",
+        partitioning=ds.partitioning(pa.schema([schema.field(name) for name in partition_by]), flavor="hive"),
+        basename_template=f"part-{re.sub(r'[^0-9A-Za-z]+', '_', run_key)}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        max_rows_per_group=chunk_rows,
+    )
+    return rows
+
+
+def export_chat_history(conn: sqlite3.Connection, out_dir: str, last_id: int, cutoff: float, chunk_rows: int) -> tuple:
+    """Messages after `last_id`, up to the first one newer than `cutoff`; returns (rows, new last_id).
+
+    chat_history is append-only and ids grow with time, so the newest
+    exported id is the high-water mark. Messages are read in id order.
+    """
+    # Stop before the first message still settling, even if later ones are older (ids and timestamps can interleave slightly)
+    bound = conn.execute("SELECT MIN(id) FROM chat_history WHERE id > ? AND timestamp >= ?", (last_id, cutoff)).fetchone()[0]
+    if bound is None:
+        bound = (conn.execute("SELECT MAX(id) FROM chat_history").fetchone()[0] or 0) + 1
+    if bound <= last_id + 1:
+        os.makedirs(os.path.join(out_dir, "chat_history"), exist_ok=True)
+        return 0, last_id
+    cursor = conn.execute("""
+        SELECT id, student_id, timestamp, message_type, message_text, message_classification, file_name,
+               date(timestamp, 'unixepoch') AS date
+        FROM chat_history
+        WHERE id > ? AND id < ?
+        ORDER BY id
+    """, (last_id, bound))
+    rows = _write(cursor, CHAT_HISTORY_SCHEMA, out_dir, "chat_history", ["date", "file_name"], f"after-{last_id}", chunk_rows)
+    return rows, bound - 1
+
+
+def export_student_profiles(conn: sqlite3.Connection, out_dir: str, since: float, cutoff: float, chunk_rows: int) -> int:
+    """Profiles last changed in [since, cutoff), one row per version.
+
+    Profiles are updated in place, so a profile is exported again each time it
+    changes. Keep the row with the newest `last_interaction_timestamp` per
+    (student_id, file_name) for its current state.
+    """
+    cursor = conn.execute("""
+        SELECT student_id, file_name, total_questions, instrumental_count, executive_count, other_count,
+               last_interaction_timestamp, needs_guidance_flag, consecutive_executive_count,
+               last_question_classification, last_instrumental_example, last_executive_example,
+               date(last_interaction_timestamp, 'unixepoch') AS date
+        FROM student_profiles
+        WHERE last_interaction_timestamp >= ? AND last_interaction_timestamp < ?
+        ORDER BY last_interaction_timestamp
+    """, (since, cutoff))
+    return _write(cursor, STUDENT_PROFILES_SCHEMA, out_dir, "student_profiles", ["date", "file_name"], f"from-{since}", chunk_rows)
+
+
+def export_experiment_assignments(conn: sqlite3.Connection, out_dir: str, since: str, cutoff: str, chunk_rows: int) -> int:
+    """Assignments made in [since, cutoff), compared as the UTC 'YYYY-MM-DD HH:MM:SS' text SQLite stores.
+
+    The table keeps each student's first group and is never updated, so
+    every assignment is exported once.
+    """
+    cursor = conn.execute("""
+        SELECT student_id, experiment_id, group_id, assigned_at, date(assigned_at) AS date
+        FROM student_experiment_assignments
+        WHERE assigned_at >= ? AND assigned_at < ?
+        ORDER BY assigned_at
+    """, (since, cutoff))
+    return _write(cursor, EXPERIMENT_ASSIGNMENTS_SCHEMA, out_dir, "student_experiment_assignments", ["date"], f"from-{since}", chunk_rows)
+
+
+def export_experiment_group_history(conn: sqlite3.Connection, out_dir: str, since: str, cutoff: str, chunk_rows: int) -> int:
+    """Groups first seen in [since, cutoff); more than one row per (student_id, experiment_id) means the student switched groups."""
+    cursor = conn.execute("""
+        SELECT student_id, experiment_id, group_id, first_seen_at, date(first_seen_at) AS date
+        FROM experiment_group_history
+        WHERE first_seen_at >= ? AND first_seen_at < ?
+        ORDER BY first_seen_at
+    """, (since, cutoff))
+    return _write(cursor, EXPERIMENT_GROUP_HISTORY_SCHEMA, out_dir, "experiment_group_history", ["date"], f"from-{since}", chunk_rows)
+
+
+def export(db_path: str, out_dir: str, chunk_rows: int = EXPORT_CHUNK_ROWS, settle_seconds: float = EXPORT_SETTLE_SECONDS,
+           now: Optional[float] = None) -> dict:
+    """Appends the rows added since the last run to out_dir/<table>/ and advances the high-water marks.
+
+    Reads one consistent snapshot of the live database (read-only, WAL
+    readers do not block the TA) and writes each table as Parquet
+    partitioned by date (UTC) and, where the table has one, file_name, e.g.
+    `pandas.read_parquet(out_dir + "/chat_history")`. Returns rows exported
+    per table.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    state = load_state(out_dir)
+    cutoff = (time.time() if now is None else now) - settle_seconds
+    cutoff_text = datetime.fromtimestamp(cutoff, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    exported = {}
+
+    # pyarrow pulls the record batches from its own thread, one at a time
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, isolation_level=None, check_same_thread=False)
+    try:
+        conn.execute("BEGIN")  # One read snapshot for all tables
+        started = time.perf_counter()
+        exported["chat_history"], state["chat_history_last_id"] = export_chat_history(
+            conn, out_dir, state.get("chat_history_last_id", 0), cutoff, chunk_rows)
+        exported["student_profiles"] = export_student_profiles(
+            conn, out_dir, state.get("student_profiles_since", 0.0), cutoff, chunk_rows)
+        state["student_profiles_since"] = max(cutoff, state.get("student_profiles_since", 0.0))
+        exported["student_experiment_assignments"] = export_experiment_assignments(
+            conn, out_dir, state.get("experiment_assignments_since", ""), cutoff_text, chunk_rows)
+        state["experiment_assignments_since"] = max(cutoff_text, state.get("experiment_assignments_since", ""))
+        exported["experiment_group_history"] = export_experiment_group_history(
+            conn, out_dir, state.get("experiment_group_history_since", ""), cutoff_text, chunk_rows)
+        state["experiment_group_history_since"] = max(cutoff_text, state.get("experiment_group_history_since", ""))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+    state["last_export_at"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    save_state(out_dir, state)
+    logging.info(f"Exported {exported} to {out_dir} in {time.perf_counter() - started:.1f}s.")
+    return exported
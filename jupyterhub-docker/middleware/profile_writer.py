@@ -0,0 +1,146 @@
+# profile_writer.py - Write-behind queue that batches student profile updates
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from db import Database
+from metrics import PROFILE_FLUSH_SECONDS, PROFILE_FLUSHED_UPDATES, PROFILE_QUEUE_DEPTH
+
+# Use .env variables or fall back to defaults
+PROFILE_FLUSH_INTERVAL = float(os.getenv("profile_flush_interval", "1.0"))
+# Flush early once this many (student, file) pairs are waiting
+PROFILE_FLUSH_MAX_PENDING = int(os.getenv("profile_flush_max_pending", "200"))
+
+ProfileKey = Tuple[str, str]  # (student_id, file_name)
+
+
+@dataclass
+class ProfileDelta:
+    """Changes to one student's profile accumulated since the last flush."""
+    total_questions: int = 0
+    instrumental_count: int = 0
+    executive_count: int = 0
+    other_count: int = 0
+    last_interaction_timestamp: float = 0.0
+    last_instrumental_example: Optional[str] = None
+    last_executive_example: Optional[str] = None
+    consecutive_executive_count: Optional[int] = None
+    last_question_classification: Optional[str] = None
+
+    def add_question(self, classification: str, timestamp: float, question_text: str,
+                     consecutive_executive: int, last_question_classification: str):
+        self.total_questions += 1
+        if classification == "instrumental":
+            self.instrumental_count += 1
+            self.last_instrumental_example = question_text
+        elif classification == "executive":
+            self.executive_count += 1
+            self.last_executive_example = question_text
+        else:
+            self.other_count += 1
+        self.last_interaction_timestamp = max(self.last_interaction_timestamp, timestamp)
+        self.consecutive_executive_count = consecutive_executive
+        self.last_question_classification = last_question_classification
+
+    def merge(self, newer: "ProfileDelta") -> "ProfileDelta":
+        """Combines this delta with one recorded after it."""
+        return ProfileDelta(
+            total_questions=self.total_questions + newer.total_questions,
+            instrumental_count=self.instrumental_count + newer.instrumental_count,
+            executive_count=self.executive_count + newer.executive_count,
+            other_count=self.other_count + newer.other_count,
+            last_interaction_timestamp=max(self.last_interaction_timestamp, newer.last_interaction_timestamp),
+            last_instrumental_example=newer.last_instrumental_example or self.last_instrumental_example,
+            last_executive_example=newer.last_executive_example or self.last_executive_example,
+            consecutive_executive_count=(newer.consecutive_executive_count
+                                         if newer.consecutive_executive_count is not None else self.consecutive_executive_count),
+            last_question_classification=newer.last_question_classification or self.last_question_classification,
+        )
+
+
+class ProfileWriter:
+    """Collects profile deltas in memory and writes them in batches.
+
+    `record()` only touches a dict on the event loop. A background task flushes
+    every `profile_flush_interval` seconds, or as soon as
+    `profile_flush_max_pending` profiles are waiting. It hands the whole batch
+    to `flush_fn(conn, items)`, which runs as a single transaction on the
+    database thread. Several messages from the same student between flushes
+    become one write. A failed flush puts its deltas back in the queue, and
+    `stop()` flushes whatever is left at shutdown.
+
+    `pending()` exposes unflushed deltas so readers in this worker can overlay
+    them on what they load from the database. Take it *before* submitting the
+    read: a flush is handed to the (FIFO) database thread in the same
+    event-loop step that removes it from the queue.
+    """
+
+    def __init__(self, database: Database, flush_fn: Callable[..., None],
+                 flush_interval: float = PROFILE_FLUSH_INTERVAL, max_pending: int = PROFILE_FLUSH_MAX_PENDING):
+        self.database = database
+        self.flush_fn = flush_fn
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: Dict[ProfileKey, ProfileDelta] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, student_id: str, file_name: str, classification: str, timestamp: float,
+               question_text: str, consecutive_executive: int, last_question_classification: str):
+        delta = self._pending.setdefault((student_id, file_name), ProfileDelta())
+        delta.add_question(classification, timestamp, question_text, consecutive_executive, last_question_classification)
+        PROFILE_QUEUE_DEPTH.set(len(self._pending))
+        if len(self._pending) >= self.max_pending and self._wakeup is not None:
+            self._wakeup.set()
+
+    def pending(self, student_id: str, file_name: str) -> Optional[ProfileDelta]:
+        delta = self._pending.get((student_id, file_name))
+        return ProfileDelta().merge(delta) if delta else None
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        PROFILE_QUEUE_DEPTH.set(0)
+        items: List[Tuple[ProfileKey, ProfileDelta]] = list(batch.items())
+        started = time.perf_counter()
+        try:
+            await self.database.run(self.flush_fn, items)
+        except Exception as e:
+            logging.error(f"Failed to flush {len(items)} profile updates: {e}. Re-queueing them.")
+            for key, delta in items:
+                newer = self._pending.get(key)
+                self._pending[key] = delta.merge(newer) if newer else delta
+            PROFILE_QUEUE_DEPTH.set(len(self._pending))
+            return
+        PROFILE_FLUSH_SECONDS.observe(time.perf_counter() - started)
+        PROFILE_FLUSHED_UPDATES.inc(sum(delta.total_questions for _, delta in items))
+        logging.info(f"Flushed {len(items)} profile updates in {time.perf_counter() - started:.3f}s.")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stops the flush loop and writes everything still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
@@ -0,0 +1,65 @@
+# prompt_builder.py - Prompt layout with a byte-identical static prefix per assignment and experiment group
+import hashlib
+import logging
+import os
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from context_packer import estimate_tokens
+from metrics import PROMPT_PREFIXES, PROMPT_STATIC_SHARE
+
+# Use .env variables or fall back to defaults
+# How long the backend keeps the model (and its prompt cache) loaded after a call, e.g. "30m" or "-1" for ever.
+# Empty leaves it to the backend (Ollama: OLLAMA_KEEP_ALIVE, 5 minutes by default).
+LLM_KEEP_ALIVE = os.getenv("llm_keep_alive", "").strip()
+
+COURSE_CONTEXT_START = "[COURSE CONTEXT: DO NOT REVEAL SOURCES]"
+COURSE_CONTEXT_END = "[END COURSE CONTEXT]"
+
+ContextBlock = Tuple[str, str]  # (heading, text)
+
+
+@lru_cache(maxsize=256)
+def _compile(service: str, system_prompt: str, blocks: Tuple[ContextBlock, ...]) -> str:
+    parts = [system_prompt.rstrip()]
+    rendered = [f"{heading}:\n{text.strip()}" for heading, text in blocks if text and text.strip()]
+    if rendered:
+        parts.append("\n\n".join([COURSE_CONTEXT_START] + rendered + [COURSE_CONTEXT_END]))
+    prefix = "\n\n".join(parts) + "\n"
+    PROMPT_PREFIXES.labels(service=service).inc()
+    logging.info(f"Compiled {service} prompt prefix {hashlib.sha256(prefix.encode('utf-8')).hexdigest()[:12]} "
+                 f"(~{estimate_tokens(prefix)} tokens).")
+    return prefix
+
+
+def static_prefix(service: str, system_prompt: str, *blocks: ContextBlock) -> str:
+    """System message made only of content that is the same for every student of an assignment and A/B group.
+
+    `blocks` are (heading, text) pairs such as the assignment description
+    and the learning objectives; empty ones are left out. Equal arguments
+    always give the same bytes, so a backend with prompt caching (llama.cpp,
+    Ollama) prefills the prefix once and reuses it for every later request
+    that starts with it. Anything that varies per student or turn (profile
+    hints, selected LO, logs, history, the question) belongs after it.
+    """
+    return _compile(service, system_prompt, tuple(blocks))
+
+
+def bullet_list(items) -> str:
+    return "\n".join(f"- {item}" for item in items)
+
+
+def build_messages(service: str, prompt: str, prefix: str, turn_content: str, history: Optional[List[dict]] = None) -> List[dict]:
+    """[static prefix, history..., per-turn user message], recording the share of the prompt the prefix covers."""
+    messages = [{"role": "system", "content": prefix}]
+    messages.extend(history or [])
+    messages.append({"role": "user", "content": turn_content})
+    total = sum(len(message.get("content") or "") for message in messages)
+    if total:
+        PROMPT_STATIC_SHARE.labels(service=service, prompt=prompt).observe(len(prefix) / total)
+    return messages
+
+
+def keep_alive_fields() -> dict:
+    """Request fields asking the backend to keep the model, and so its prompt cache, loaded."""
+    return {"keep_alive": LLM_KEEP_ALIVE} if LLM_KEEP_ALIVE else {}
@@ -0,0 +1,130 @@
+# report_jobs.py - /report generation as background jobs, with results cached until the session changes
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional
+
+import db
+from db import Database
+from metrics import REPORT_JOB_SECONDS, REPORT_JOBS
+
+# Use .env variables or fall back to defaults
+# A queued or running job without progress for this long is treated as lost (e.g. its worker was restarted)
+REPORT_JOB_TIMEOUT_SECONDS = float(os.getenv("report_job_timeout_seconds", "300"))
+# Jobs kept per (student, file); the newest finished one is the cached report
+REPORT_JOBS_KEPT = 3
+# Seconds between status checks while waiting for a job another worker runs
+REPORT_JOB_POLL_INTERVAL = 0.5
+
+# generate_fn(student_id, file_name, processed_logs, progress) -> report; progress(stage) records the current step
+ProgressFn = Callable[[str], Awaitable[None]]
+GenerateFn = Callable[[str, str, Optional[str], ProgressFn], Awaitable[str]]
+
+
+def report_fingerprint(last_message_id: int, processed_logs: Optional[str]) -> str:
+    """What a report depends on: the session's newest message and the activity logs sent with the request."""
+    return hashlib.sha256(f"{last_message_id}\x00{processed_logs or ''}".encode("utf-8")).hexdigest()
+
+
+class ReportJobs:
+    """Runs /report generation in the background and keeps the result until the session changes.
+
+    `submit()` answers at once with a job. If a finished report, or a job
+    still running, exists for the same (student, file) and fingerprint (last
+    chat message and activity logs), that job is returned; otherwise a new
+    one is queued and generated on this worker. Repeated /report requests
+    without new messages or log events are answered from the stored result.
+
+    Jobs live in the `report_jobs` table, so any worker can report their
+    status. A job that has not progressed for `report_job_timeout_seconds`
+    counts as lost and is started again by the next request.
+    """
+
+    def __init__(self, database: Database, generate_fn: GenerateFn, timeout_seconds: float = REPORT_JOB_TIMEOUT_SECONDS,
+                 keep: int = REPORT_JOBS_KEPT):
+        self.database = database
+        self.generate_fn = generate_fn
+        self.timeout_seconds = timeout_seconds
+        self.keep = max(1, keep)
+        self._tasks: Dict[str, asyncio.Task] = {}  # Jobs running on this worker, by id
+
+    def _view(self, row) -> dict:
+        job = dict(row)
+        if job["status"] in ("queued", "running") and job["updated_at"] < time.time() - self.timeout_seconds:
+            job.update(status="failed", error="The report job was interrupted.")
+        return job
+
+    async def submit(self, student_id: str, file_name: str, processed_logs: Optional[str]) -> dict:
+        """Returns the job answering this /report (with its report if done) and whether it was already there."""
+        last_message_id = await self.database.run(db.fetch_last_message_id, student_id, file_name)
+        fingerprint = report_fingerprint(last_message_id, processed_logs)
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        row = await self.database.run(db.claim_report_job, job_id, student_id, file_name, fingerprint,
+                                      now, now - self.timeout_seconds, self.keep)
+        job = dict(row)
+        if job["job_id"] != job_id:
+            outcome = "cached" if job["status"] == "done" else "joined"
+            REPORT_JOBS.labels(outcome=outcome).inc()
+            logging.info(f"/report for {student_id} ({file_name}): {outcome} job {job['job_id']} ({job['status']}).")
+            return {**job, "cached": True}
+        REPORT_JOBS.labels(outcome="started").inc()
+        logging.info(f"/report for {student_id} ({file_name}): started job {job_id}.")
+        task = asyncio.get_running_loop().create_task(self._run(job_id, student_id, file_name, processed_logs, now))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+        return {**job, "cached": False}
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        row = await self.database.run(db.fetch_report_job, job_id)
+        return self._view(row) if row is not None else None
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[dict]:
+        """Waits until the job is done or failed, or `timeout` passes; returns its latest state.
+
+        Jobs running on this worker are awaited directly, others are polled.
+        """
+        deadline = time.monotonic() + timeout
+        task = self._tasks.get(job_id)
+        if task is not None:
+            await asyncio.wait({task}, timeout=timeout)
+        while True:
+            job = await self.get(job_id)
+            if job is None or job["status"] in ("done", "failed") or time.monotonic() >= deadline:
+                return job
+            await asyncio.sleep(REPORT_JOB_POLL_INTERVAL)
+
+    async def _run(self, job_id: str, student_id: str, file_name: str, processed_logs: Optional[str], queued_at: float):
+        async def progress(stage: str):
+            await self.database.run(db.update_report_job, job_id, "running", stage, time.time())
+
+        try:
+            await progress("starting")
+            report = await self.generate_fn(student_id, file_name, processed_logs, progress)
+        except asyncio.CancelledError:
+            await self.database.run(db.update_report_job, job_id, "failed", "failed", time.time(), None,
+                                    "The report job was interrupted.")
+            raise
+        except Exception as e:
+            logging.error(f"Report job {job_id} for {student_id} ({file_name}) failed: {e}", exc_info=True)
+            REPORT_JOBS.labels(outcome="failed").inc()
+            await self.database.run(db.update_report_job, job_id, "failed", "failed", time.time(), None, str(e)[:500])
+            return
+        await self.database.run(db.update_report_job, job_id, "done", "done", time.time(), report)
+        REPORT_JOBS.labels(outcome="completed").inc()
+        REPORT_JOB_SECONDS.observe(time.time() - queued_at)
+        logging.info(f"Report job {job_id} for {student_id} ({file_name}) done in {time.time() - queued_at:.1f}s.")
+
+    async def stop(self):
+        """Cancels this worker's running jobs; they are marked failed and the next /report starts over."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
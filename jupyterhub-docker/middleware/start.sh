@@ -10,12 +10,19 @@ fluentd -c /fluent/etc/td-agent.conf -p /fluent/plugins > /var/log/llm-handler/f
 cd /app
 
 
+# Prometheus metrics of all workers are aggregated through files here (see metrics.py).
+# Start from an empty directory so values from a previous run are not counted again
+rm -rf /tmp/prometheus-multiproc
+mkdir -p /tmp/prometheus-multiproc/ea /tmp/prometheus-multiproc/ta
+
 # Start EA Handler in the background on port 8003
-uvicorn ea-handler:app --workers 4  --host 0.0.0.0 --port 8003 > /var/log/llm-handler/ea-logs.txt 2>&1 &
+PROMETHEUS_MULTIPROC_DIR=/tmp/prometheus-multiproc/ea \
+    gunicorn ea-handler:app -c gunicorn.conf.py --bind 0.0.0.0:8003 --workers 4 > /var/log/llm-handler/ea-logs.txt 2>&1 &
 
-# Start TA Handler in the foreground on port 8004
-# (or run in background and use 'wait' if you need both backgrounded)
-uvicorn ta-handler:app --workers 4 --host 0.0.0.0 --port 8004 > /var/log/llm-handler/ta-logs.txt 2>&1 &
+# Start TA Handler on port 8004. gunicorn loads the embedding model once and then
+# forks the uvicorn workers (see gunicorn.conf.py for workers and preload settings)
+PROMETHEUS_MULTIPROC_DIR=/tmp/prometheus-multiproc/ta \
+    gunicorn ta-handler:app -c gunicorn.conf.py > /var/log/llm-handler/ta-logs.txt 2>&1 &
 
 # Wait for any background process to exit
 wait -n
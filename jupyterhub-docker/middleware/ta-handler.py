@@ -1,5 +1,6 @@
 import sqlite3
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import time
 import re
@@ -7,25 +8,41 @@ import os
 import httpx
 import logging
 import json # Added
-import hashlib # Added
-from pathlib import Path # Added
 from dotenv import load_dotenv
 import uvicorn
-from typing import Optional, List 
-from thefuzz import process
-from sentence_transformers import SentenceTransformer, util
-import torch # May be needed depending on sentence-transformers version/setup
-import glob
+from typing import Optional, List, Set, Tuple
 import asyncio
-
+from contextlib import asynccontextmanager
 # --- Configuration ---
 load_dotenv()
+# Local modules read their settings at import time, so import them after .env is loaded
+import db
+from db import Database
+from activity_aggregates import ActivityAggregates
+from http_pool import HttpPool
+from classification_cache import ClassificationCache, classification_fingerprint
+from context_packer import ContextPacker, Section
+from conversation_summary import ConversationSummarizer
+from embedding_executor import EmbeddingExecutor
+from experiments import ExperimentAssigner, merged_params
+from fused_pipeline import (DEFAULT_EA_GUIDELINES, FUSED_RESPONSE_FORMAT, PIPELINE_MODES, FusedResponseExtractor,
+                            build_conditional_hints, build_fused_instructions, parse_fused_output)
+from llm_backends import LLM_BACKENDS_FILE, Backend, BackendPool, NoBackendAvailable, default_backend, is_backend_failure, load_backends
+from llm_scheduler import LLMScheduler, SchedulerRejected
+from lo_index import LOIndex
+from inputs_snapshot import InputsSnapshot, InputsStore
+from local_classifier import CLASSIFICATION_MODE, LOCAL_CLASSIFIER_THRESHOLD, LocalClassifier
+from metrics import FALLBACKS, LOCAL_CLASSIFIER_DECISIONS, REQUEST_SECONDS, metrics_response, time_stage
+from profile_writer import ProfileDelta, ProfileWriter
+from prompt_builder import bullet_list, build_messages, keep_alive_fields, static_prefix
+from report_jobs import ProgressFn, ReportJobs
 
 # DATABASE_FILE = "chat_history.db" # for local testing
 DATABASE_FILE = "/app/chat_histories/chat_history.db"  # for docker
-EXPERIMENT_CONFIG_FILE = Path(__file__).parent / "inputs" / "ab_experiments.json" # Added
 
 EA_URL = "http://localhost:8003/expert_query" 
+# Seconds the TA waits for the EA; sent along so the EA does not queue for an LLM slot after the TA gave up
+EA_TIMEOUT_SECONDS = 30
 
 # Use .env variables or fall back to defaults
 WEBUI_API_BASE = os.getenv("webui_url", "http://localhost:3000") 
@@ -34,16 +51,16 @@ OLLAMA_API_BASE = os.getenv("ollama_url", "http://localhost:11434")
 
 CLASSIFICATION_MODEL_NAME = os.getenv("ollama_classification_model", "gemma3:4b")
 RESPONSE_MODEL_NAME = os.getenv("ollama_response_model", "gemma3:4b")
-
-# General Inputs from Directories
-ASSIGNMENT_DESC_DIR = "./inputs/assignment_descriptions"
-LO_DIR = "./inputs/learning_objectives"
-NEXT_STEPS_DIR = "./inputs/next_steps"
+# Response pipeline for students whose A/B group does not set "pipeline_mode" (see fused_pipeline.py)
+PIPELINE_MODE = os.getenv("pipeline_mode", "standard").strip().lower()
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
 
 TA_SYSTEM_PROMPT_FILE = "./inputs/ta_system_prompt.txt"
 CLASSIFICATION_PROMPT_FILE = "./inputs/classification_prompt.txt"
 POSSIBLE_CLASSIFICATIONS_FILE = "./inputs/classification_options.txt"
 TA_SYSTEM_PROMPT_FILE = "./inputs/ta_system_prompt.txt"
+# The fused pipeline follows the EA's guidelines for the technical answer
+EA_SYSTEM_PROMPT_FILE = "./inputs/ea_system_prompt.txt"
 
 # --- Default Values (used if file loading fails) ---
 DEFAULT_LEARNING_OBJECTIVES = [
@@ -54,6 +71,11 @@ MIN_MATCH_SCORE = 70 # Minimum score (out of 100) to consider it a match
 DEFAULT_TA_SYSTEM_PROMPT = "You are a helpful tutor named Juno, embedded in a Jupyterlab Interface." 
 DEFAULT_CLASSIFICATION_PROMPT = "Classify the following question as good or bad"
 DEFAULT_POSSIBLE_CLASSIFICATIONS = ["good", "bad"]
+DEFAULT_FINAL_RESPONSE = "I'm sorry, I encountered an issue processing your request. Please try again."
+DEFAULT_ERROR_RESPONSE = "I'm sorry, an error occurred while processing your request."
+REPORT_PENDING_RESPONSE = "Your report is still being prepared. Send `/report` again in a minute to see it."
+# How long a blocking /report waits for its job (chat_interact gives up after 120 s)
+REPORT_WAIT_SECONDS = 110
 
 # --- Logging Setup ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - TA - %(message)s')
@@ -62,123 +84,63 @@ logging.info(f"Using Classification Model: {CLASSIFICATION_MODEL_NAME}")
 logging.info(f"Using Response Model: {RESPONSE_MODEL_NAME}")
 
 # --- Load Content from Files ---
-def load_assignment_resources():
-    descs = {}
-    los = {}
-    next = {}
-    # Load assignment descriptions, learning objectives, and next steps from files
-    if not os.path.exists(ASSIGNMENT_DESC_DIR):
-        logging.error(f"Assignment descriptions directory '{ASSIGNMENT_DESC_DIR}' does not exist.")
-        raise FileNotFoundError(f"Assignment descriptions directory '{ASSIGNMENT_DESC_DIR}' does not exist.")
-    if not os.path.exists(LO_DIR):
-        logging.error(f"Learning objectives directory '{LO_DIR}' does not exist.")
-        raise FileNotFoundError(f"Learning objectives directory '{LO_DIR}' does not exist.")
-    if not os.path.exists(NEXT_STEPS_DIR):
-        logging.error(f"Next steps directory '{NEXT_STEPS_DIR}' does not exist.")
-        raise FileNotFoundError(f"Next steps directory '{NEXT_STEPS_DIR}' does not exist.")
-    for path in glob.glob(os.path.join(ASSIGNMENT_DESC_DIR, "*.txt")):
-        key = os.path.splitext(os.path.basename(path))[0]
-        with open(path) as f:
-            descs[key] = f.read().strip()
-    for path in glob.glob(os.path.join(LO_DIR, "*.txt")):
-        key = os.path.splitext(os.path.basename(path))[0]
-        with open(path) as f:
-            los[key] = [l.strip() for l in f if l.strip()]
-    for path in glob.glob(os.path.join(NEXT_STEPS_DIR, "*.txt")):
-        key = os.path.splitext(os.path.basename(path))[0]
-        with open(path) as f:
-            next[key] = [l.strip() for l in f if l.strip()]
-    return descs, los, next
-
-
 def derive_assignment_id(file_name: str) -> str:
     # strip directory + extension
     return os.path.splitext(os.path.basename(file_name))[0]
 
 
-try:
-    ASSIGNMENT_DESCRIPTIONS, LEARNING_OBJECTIVES_MAP, NEXT_STEPS_MAP = load_assignment_resources()
-    logging.info(f"Loaded assignment descriptions and learning objectives from directories.")
-except Exception as e:
-    logging.error(f"Failed to load assignment resources: {e}. Using defaults.")
-    ASSIGNMENT_DESCRIPTIONS = {"default": DEFAULT_ASSIGNMENT_DESCRIPTION}
-    LEARNING_OBJECTIVES_MAP = {"default": DEFAULT_LEARNING_OBJECTIVES}
-    NEXT_STEPS_MAP = {"default": ["No next steps available."]}
-
-app = FastAPI(title="Multi-Agent Flow")
-
-# --- Global variable for experiment config ---
-ACTIVE_EXPERIMENT_CONFIG = None # Added
-
-# --- Function to load experiment configuration ---
-def load_experiment_config(): # Added
-    global ACTIVE_EXPERIMENT_CONFIG
-    try:
-        with open(EXPERIMENT_CONFIG_FILE, 'r') as f:
-            config = json.load(f)
-            active_id = config.get("active_experiment_id")
-            if active_id and active_id in config.get("experiments", {}):
-                ACTIVE_EXPERIMENT_CONFIG = config["experiments"][active_id]
-                ACTIVE_EXPERIMENT_CONFIG["id"] = active_id # Store the active experiment ID itself
-                logging.info(f"Successfully loaded active A/B experiment config: {active_id}")
-            else:
-                logging.warning(f"A/B testing: active_experiment_id '{active_id}' not found or invalid in {EXPERIMENT_CONFIG_FILE}. A/B testing disabled.")
-                ACTIVE_EXPERIMENT_CONFIG = None
-    except FileNotFoundError:
-        logging.warning(f"A/B testing: Experiment config file {EXPERIMENT_CONFIG_FILE} not found. A/B testing disabled.")
-        ACTIVE_EXPERIMENT_CONFIG = None
-    except json.JSONDecodeError:
-        logging.error(f"A/B testing: Error decoding JSON from {EXPERIMENT_CONFIG_FILE}. A/B testing disabled.")
-        ACTIVE_EXPERIMENT_CONFIG = None
-    except Exception as e:
-        logging.error(f"A/B testing: Unexpected error loading experiment config: {e}. A/B testing disabled.")
-        ACTIVE_EXPERIMENT_CONFIG = None
-
+# All inputs/ files are read once into an immutable snapshot and hot-reloaded on change (see inputs_snapshot.py)
+INPUTS = InputsStore()
+logging.info(f"Loaded {len(INPUTS.current.assignment_descriptions)} assignment descriptions and {len(INPUTS.current.learning_objectives)} learning objective lists.")
+
+# Shared keep-alive client for LLM and EA calls, one per worker
+HTTP = HttpPool("ta")
+# Keeps prompts within each model's token budget (see context_packer.py)
+CONTEXT_PACKER = ContextPacker("ta")
+# Priority order and per-backend slot limits for LLM calls, shared with the EA's workers (see llm_scheduler.py)
+LLM_SCHEDULER = LLMScheduler("ta")
+# Backends LLM calls are routed to; llm_backends.json, or the single WebUI/Ollama backend from .env (see llm_backends.py)
+LLM_POOL = BackendPool("ta", load_backends(LLM_BACKENDS_FILE, default_backend(WEBUI_API_BASE, WEBUI_API_KEY, OLLAMA_API_BASE)))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await HTTP.start()
+    LLM_POOL.start(HTTP.client)
+    INPUTS.start()
+    PROFILE_WRITER.start()
+    EXPERIMENTS.start()
+    EMBEDDINGS.start()
+    SUMMARIZER.start()
+    yield
+    await INPUTS.stop()
+    await EMBEDDINGS.stop()
+    await SUMMARIZER.stop()
+    await REPORT_JOBS.stop()
+    # Write out queued profile updates and experiment assignments before the database connection closes
+    await PROFILE_WRITER.stop()
+    await EXPERIMENTS.stop()
+    await LLM_POOL.stop()
+    await HTTP.close()
+    # Close this worker's database connection so the WAL is checkpointed cleanly
+    DB.close()
+
+app = FastAPI(title="Multi-Agent Flow", lifespan=lifespan)
 
 # --- Database Setup ---
+# One long-lived connection per worker, driven from a dedicated thread (see db.py)
+DB = Database(DATABASE_FILE)
+
 def init_db():
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-            # Create chat history table (if not exists)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS chat_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    student_id TEXT NOT NULL,
-                    timestamp REAL NOT NULL,
-                    message_type TEXT NOT NULL, -- 'question' or 'response'
-                    message_text TEXT NOT NULL,
-                    message_classification TEXT, -- 'instrumental', 'executive', 'other', or NULL for responses
-                    file_name TEXT
-                )
-            """)
-            # Create student profiles table (if not exists)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS student_profiles (
-                    student_id TEXT NOT NULL,
-                    file_name TEXT NOT NULL, -- Add file_name column
-                    profile_data TEXT NOT NULL, -- Store profile as JSON string
-                    PRIMARY KEY (student_id, file_name) -- Composite key
-                )
-            """)
-            # Create student experiment assignments table (if not exists) - Added
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS student_experiment_assignments (
-                    student_id TEXT NOT NULL,
-                    experiment_id TEXT NOT NULL,
-                    group_id TEXT NOT NULL,
-                    assigned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    PRIMARY KEY (student_id, experiment_id)
-                )
-            """)
-            conn.commit()
-            logging.info("Database initialized (chat_history, student_profiles & student_experiment_assignments tables checked/created).")
+        DB.run_sync(db.create_schema)
+        logging.info(f"Database initialized (schema version {db.SCHEMA_VERSION}).")
+        # Reopened on first use. Under a preloading server this keeps the parent from holding a connection across fork
+        DB.close()
     except sqlite3.Error as e:
         logging.error(f"Database initialization failed: {e}")
         raise
 
 init_db()
-load_experiment_config() # Added: Load experiment config on startup
 
 # --- Data Models ---
 class StudentMessage(BaseModel):
@@ -186,11 +148,38 @@ class StudentMessage(BaseModel):
     message_text: str
     processed_logs: Optional[str] = None
     file_name: str
+    # New notebook log events since the client's last message ({"time", "event", "error"}); see activity_aggregates.py
+    log_events: Optional[List[dict]] = None
     
 # This model defines the response TA sends back to chat_interact
 class TutorApiResponse(BaseModel):
     final_response: str
 
+# State of a background /report job (see report_jobs.py)
+class ReportJobResponse(BaseModel):
+    job_id: str
+    status: str  # queued, running, done, failed
+    stage: Optional[str] = None
+    report: Optional[str] = None
+    error: Optional[str] = None
+    cached: bool = False  # An existing job or stored report answered the request
+
+# State carried from prompt construction to storing the final response
+class PreparedTurn(BaseModel):
+    final_prompt_messages: List[dict]
+    classification_result: str
+    classification_source: str = "default"  # See db.CLASSIFICATION_SOURCES
+    consecutive_executive: int
+    timestamp: float
+    start_time: float
+    question_id: Optional[int] = None  # chat_history rowid of the stored question
+    pipeline_mode: str = "standard"
+    # Set when the fused call also classifies the question; the result is applied by apply_fused_output
+    fused_classification_options: Optional[List[str]] = None
+    student_profile: dict = {}
+    profile_hint_strategy: str = "standard"
+    learning_objective: Optional[str] = None
+
 # --- Profile Helper Functions ---
 # TODO - Allow customization of profile heuristics
 DEFAULT_PROFILE = {
@@ -203,14 +192,32 @@ DEFAULT_PROFILE = {
     "last_executive_example": None, 
     "last_instrumental_example": None 
 }
+# needs_guidance_flag is set once a student has asked more than this many instrumental/executive
+# questions and more than this share of them were executive (evaluated in SQL, see db.py)
+GUIDANCE_MIN_QUESTIONS = 5
+GUIDANCE_EXECUTIVE_RATIO = 0.6
+MAX_EXAMPLE_LENGTH = 500
 
 
-def get_student_profile(student_id: str, file_name: str) -> dict:
+def _merge_profile(student_id: str, file_name: str, row: Optional[sqlite3.Row]) -> dict:
+    """Builds a profile dict from the stored row, falling back to DEFAULT_PROFILE."""
+    profile = DEFAULT_PROFILE.copy()
+    profile["student_id"] = student_id
+    profile["file_name"] = file_name 
+    if row is not None:
+        profile.update({key: row[key] for key in row.keys()})
+        profile["needs_guidance_flag"] = bool(profile["needs_guidance_flag"])
+        logging.debug(f"Loaded profile for {student_id} (file: {file_name})")
+    else:
+        logging.debug(f"No profile found for {student_id} (file: {file_name}). Using default.")
+    return profile
+
+async def get_student_profile(student_id: str, file_name: str) -> dict:
     """Retrieves student profile for a specific file from DB or returns default.
 
-    Attempts to load the profile JSON string from the student_profiles table
-    based on the composite key (student_id, file_name). If no profile exists
-    or if the stored data is invalid JSON, it returns a default profile structure.
+    Loads the profile row from the student_profiles table based on the
+    composite key (student_id, file_name). If no profile exists, it returns a
+    default profile structure.
 
     Args:
         student_id: The unique identifier for the student.
@@ -218,172 +225,135 @@ def get_student_profile(student_id: str, file_name: str) -> dict:
 
     Returns:
         A dictionary representing the student's profile, updated with stored
-        data if found, otherwise the DEFAULT_PROFILE structure.
+        data if found, otherwise the DEFAULT_PROFILE structure. Updates from
+        this worker that are still waiting in the write-behind queue are
+        applied on top.
     """
-    profile = DEFAULT_PROFILE.copy()
-    profile["student_id"] = student_id
-    profile["file_name"] = file_name 
+    # Updates from this worker that are still queued; taken before the read is submitted (see ProfileWriter)
+    pending = PROFILE_WRITER.pending(student_id, file_name)
+    row = None
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-            # Query using both student_id and file_name
-            cursor.execute("SELECT profile_data FROM student_profiles WHERE student_id = ? AND file_name = ?", (student_id, file_name))
-            result = cursor.fetchone()
-            if result:
-                try:
-                    stored_profile = json.loads(result[0])
-                    profile.update(stored_profile)
-                    logging.debug(f"Loaded profile for {student_id} (file: {file_name})")
-                except json.JSONDecodeError:
-                    logging.error(f"Failed to decode profile JSON for {student_id} (file: {file_name}). Using default.")
-            else:
-                logging.debug(f"No profile found for {student_id} (file: {file_name}). Using default.")
+        with time_stage("ta", "profile_fetch"):
+            row = await DB.run(db.fetch_profile, student_id, file_name)
     except sqlite3.Error as e:
         logging.error(f"DB error getting profile for {student_id} (file: {file_name}): {e}. Using default.")
+    profile = _merge_profile(student_id, file_name, row)
+    return apply_profile_delta(profile, pending) if pending else profile
+
+def _truncate_example(text: Optional[str]) -> Optional[str]:
+    if text and len(text) > MAX_EXAMPLE_LENGTH:
+        return text[:MAX_EXAMPLE_LENGTH] + "..."
+    return text
+
+def apply_profile_delta(profile: dict, delta: ProfileDelta) -> dict:
+    """Applies a queued delta to an in-memory profile, mirroring db.UPSERT_PROFILE_DELTA_SQL."""
+    # Update counts
+    profile["total_questions"] = profile.get("total_questions", 0) + delta.total_questions
+    profile["instrumental_count"] = profile.get("instrumental_count", 0) + delta.instrumental_count
+    profile["executive_count"] = profile.get("executive_count", 0) + delta.executive_count
+    profile["other_count"] = profile.get("other_count", 0) + delta.other_count
+    if delta.last_instrumental_example:
+        profile["last_instrumental_example"] = _truncate_example(delta.last_instrumental_example)
+    if delta.last_executive_example:
+        profile["last_executive_example"] = _truncate_example(delta.last_executive_example)
+
+    # Update timestamp
+    profile["last_interaction_timestamp"] = max(profile.get("last_interaction_timestamp", 0.0), delta.last_interaction_timestamp)
+
+    # Update heuristic flag
+    non_other_total = profile["instrumental_count"] + profile["executive_count"]
+    profile["needs_guidance_flag"] = (non_other_total > GUIDANCE_MIN_QUESTIONS
+                                      and profile["executive_count"] > GUIDANCE_EXECUTIVE_RATIO * non_other_total)
+
+    # Store consecutive_executive_count and last_question_classification
+    if delta.consecutive_executive_count is not None:
+        profile["consecutive_executive_count"] = delta.consecutive_executive_count
+    if delta.last_question_classification is not None:
+        profile["last_question_classification"] = delta.last_question_classification
     return profile
 
-def update_student_profile_sync(student_id: str, file_name: str, classification: str, timestamp: float, question_text: str, consecutive_executive: int, last_question_classification: str):
-    """Updates profile counts, flags, and example questions for a specific file."""
-    logging.info(f"Background task: Updating profile for {student_id} (file: {file_name}) based on classification: {classification}")
+def flush_profile_updates(conn: sqlite3.Connection, items: list):
+    """Writes a batch of queued profile deltas as counter UPSERTs in one transaction (runs on the database thread)."""
+    db.upsert_profile_deltas(conn, [
+        {
+            "student_id": student_id,
+            "file_name": file_name,
+            "total_questions": delta.total_questions,
+            "instrumental_count": delta.instrumental_count,
+            "executive_count": delta.executive_count,
+            "other_count": delta.other_count,
+            "last_interaction_timestamp": delta.last_interaction_timestamp,
+            "consecutive_executive_count": delta.consecutive_executive_count,
+            "last_question_classification": delta.last_question_classification,
+            "last_instrumental_example": _truncate_example(delta.last_instrumental_example),
+            "last_executive_example": _truncate_example(delta.last_executive_example),
+            "guidance_min_questions": GUIDANCE_MIN_QUESTIONS,
+            "guidance_executive_ratio": GUIDANCE_EXECUTIVE_RATIO,
+        }
+        for (student_id, file_name), delta in items
+    ])
+
+# Profile updates are queued per (student, file) and written in batches (see profile_writer.py)
+PROFILE_WRITER = ProfileWriter(DB, flush_profile_updates)
+
+async def update_question_classification(question_id: Optional[int], classification: str, source: str):
+    """Sets the classification of a stored question, and who produced it, addressed by its chat_history rowid."""
+    if question_id is None:
+        logging.warning("Question was not stored; skipping classification update.")
+        return
     try:
-        profile = get_student_profile(student_id, file_name)
-
-        # Update counts
-        profile["total_questions"] = profile.get("total_questions", 0) + 1
-        if classification == "instrumental":
-            profile["instrumental_count"] = profile.get("instrumental_count", 0) + 1
-            profile["last_instrumental_example"] = question_text 
-        elif classification == "executive":
-            profile["executive_count"] = profile.get("executive_count", 0) + 1
-            profile["last_executive_example"] = question_text 
-        else:
-            profile["other_count"] = profile.get("other_count", 0) + 1
-
-        # Update timestamp
-        profile["last_interaction_timestamp"] = timestamp
+        with time_stage("ta", "db_write"):
+            await DB.run(db.update_message_classification, question_id, classification, source)
+    except sqlite3.Error as e:
+        logging.error(f"Failed to update classification of question {question_id}: {e}")
 
-        # Update heuristic flag
-        non_other_total = profile["instrumental_count"] + profile["executive_count"]
-        if non_other_total > 5 and profile["executive_count"] / non_other_total > 0.6:
-             if not profile.get("needs_guidance_flag", False): 
-                 logging.info(f"Profile update for {student_id}: Setting needs_guidance_flag to True.")
-             profile["needs_guidance_flag"] = True
-        else:
-             if profile.get("needs_guidance_flag", False): 
-                 logging.info(f"Profile update for {student_id}: Setting needs_guidance_flag to False.")
-             profile["needs_guidance_flag"] = False 
-
-        # Store consecutive_executive_count and last_question_classification
-        profile["consecutive_executive_count"] = consecutive_executive
-        profile["last_question_classification"] = last_question_classification
-
-        # Save updated profile back to DB
-        if profile.get("last_instrumental_example") and len(profile["last_instrumental_example"]) > 500:
-            profile["last_instrumental_example"] = profile["last_instrumental_example"][:500] + "..."
-        if profile.get("last_executive_example") and len(profile["last_executive_example"]) > 500:
-            profile["last_executive_example"] = profile["last_executive_example"][:500] + "..."
-
-        profile_json = json.dumps(profile)
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT OR REPLACE INTO student_profiles (student_id, file_name, profile_data)
-                VALUES (?, ?, ?)
-            """, (student_id, file_name, profile_json))
-            conn.commit()
-            logging.info(f"Successfully updated profile for {student_id} (file: {file_name})")
+# Activity totals per (student, assignment, learning objective) for reports and analytics (see activity_aggregates.py)
+ACTIVITY = ActivityAggregates(DB)
 
+async def record_activity(message: StudentMessage, learning_objective: Optional[str] = None, classification: Optional[str] = None):
+    """Adds the message's new log events, and the classified question if given, to the activity totals."""
+    try:
+        with time_stage("ta", "db_write"):
+            await ACTIVITY.record(message.student_id, message.file_name, derive_assignment_id(message.file_name),
+                                  message.log_events, learning_objective, classification)
     except sqlite3.Error as e:
-        logging.error(f"DB error updating profile for {student_id} (file: {file_name}): {e}")
-    except Exception as e:
-        logging.error(f"Unexpected error updating profile for {student_id} (file: {file_name}): {e}", exc_info=True)
-
-def update_question_classification(student_id, file_name, message_text, classification):
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            UPDATE chat_history
-            SET message_classification = ?
-            WHERE student_id = ? AND file_name = ? AND message_text = ? AND message_type = 'question'
-            ORDER BY timestamp DESC
-            LIMIT 1
-            """,
-            (classification, student_id, file_name, message_text)
-        )
-        conn.commit()
+        logging.error(f"Failed to record activity for {message.student_id} ({message.file_name}): {e}")
 
 # --- Helper Functions ---
-def get_or_assign_experiment_group(student_id: str) -> Optional[dict]:
-    if not ACTIVE_EXPERIMENT_CONFIG or not ACTIVE_EXPERIMENT_CONFIG.get("groups"):
-        return None # A/B testing disabled or no groups defined
+# Groups come from a hash of the student and experiment id, cached per worker; the database only gets an audit copy
+EXPERIMENTS = ExperimentAssigner(DB)
 
-    experiment_id = ACTIVE_EXPERIMENT_CONFIG["id"]
-    groups = ACTIVE_EXPERIMENT_CONFIG["groups"]
-    num_groups = len(groups)
+def get_experiment_groups(student_id: str) -> list:
+    """(experiment_id, group) for each active experiment in ab_experiments.json; empty if A/B testing is disabled."""
+    return EXPERIMENTS.groups(student_id, INPUTS.current.active_experiments)
 
-    if num_groups == 0:
-        logging.warning(f"A/B testing: No groups defined for experiment {experiment_id}.")
-        return None
 
-    try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-            # Check if student is already assigned
-            cursor.execute("""
-                SELECT group_id FROM student_experiment_assignments
-                WHERE student_id = ? AND experiment_id = ?
-            """, (student_id, experiment_id))
-            row = cursor.fetchone()
-
-            if row:
-                assigned_group_id = row[0]
-                for group in groups:
-                    if group["group_id"] == assigned_group_id:
-                        logging.info(f"Student {student_id} already in group '{assigned_group_id}' for experiment '{experiment_id}'.")
-                        return group # Return the full group object
-                logging.warning(f"Student {student_id} assigned to group '{assigned_group_id}' but group not found in current config for experiment '{experiment_id}'. Using default.")
-                return groups[0] # Fallback to first group if stored group_id is somehow invalid
-
-            # Assign to a group using hashing
-            hash_input = (student_id + experiment_id).encode('utf-8')
-            hash_value = hashlib.sha256(hash_input).hexdigest()
-            group_index = int(hash_value, 16) % num_groups
-            assigned_group = groups[group_index]
-            
-            # Store the new assignment
-            cursor.execute("""
-                INSERT INTO student_experiment_assignments (student_id, experiment_id, group_id)
-                VALUES (?, ?, ?)
-            """, (student_id, experiment_id, assigned_group["group_id"]))
-            conn.commit()
-            logging.info(f"Assigned student {student_id} to group '{assigned_group['group_id']}' for experiment '{experiment_id}'.")
-            return assigned_group
+# Batches concurrent questions into one encode call on its own thread; the model is attached once loaded
+EMBEDDINGS = EmbeddingExecutor()
 
-    except sqlite3.Error as e:
-        logging.error(f"Database error during experiment group assignment for {student_id}: {e}")
-        # Fallback to a default group (e.g., the first one) in case of DB error to ensure functionality
-        return groups[0] if groups else None
-    except Exception as e:
-        logging.error(f"Unexpected error during experiment group assignment for {student_id}: {e}")
-        return groups[0] if groups else None
 
+async def encode_question(question_text: str):
+    """Returns the unit-length sentence embedding of a question, or None if the model is unavailable."""
+    return await EMBEDDINGS.encode(question_text)
 
-def select_learning_objective_embeddings(question_text: str, learning_objectives: list) -> str:
-    """Selects the most relevant LO using sentence embeddings."""
-    if not embedding_model or LO_EMBEDDINGS is None:
-        logging.error("Sentence Transformer model or LO embeddings not available. Falling back to first LO.")
+
+async def select_learning_objective_embeddings(question_text: str, learning_objectives: list, question_embedding=None,
+                                        assignment_id: str = "default") -> str:
+    """Selects the most relevant LO of this assignment using sentence embeddings."""
+    if not embedding_model:
+        logging.error("Sentence Transformer model not available. Falling back to first LO.")
         return "No specific LO"
 
     try:
-        question_embedding = embedding_model.encode(question_text, convert_to_tensor=True)
-
-        # Compute cosine similarities
-        cosine_scores = util.cos_sim(question_embedding, LO_EMBEDDINGS)[0] 
+        if question_embedding is None:
+            question_embedding = await encode_question(question_text)
 
-        # Find the index of the highest score
-        best_match_idx = torch.argmax(cosine_scores).item()
-        best_score = cosine_scores[best_match_idx].item()
+        # One matrix-vector product against this assignment's LO matrix
+        match = await LO_INDEX.best_match(question_embedding, learning_objectives, assignment_id)
+        if match is None:
+            logging.error(f"No LO embeddings available for assignment '{assignment_id}'.")
+            return "No specific LO"
+        best_match_idx, best_score = match
 
         SIMILARITY_THRESHOLD = 0.4
 
@@ -407,116 +377,175 @@ def extract_session_id_from_filename(file_name: str, student_id: str) -> str:
     return session_id
 
 
-async def call_llm(messages: list, model_name: str, purpose: str = "LLM call") -> str: 
-    """Calls WebUI's OpenAI-compatible API with a specific model."""
-    # WebUI is preferred for LLM calls with API key, but Ollama is also supported
-    if WEBUI_API_KEY == "":
-        logging.warning("No WebUI API key provided. Defaulting to Ollama API.")
-        target_url = f"{OLLAMA_API_BASE}/v1/chat/completions"
-        headers={"Content-Type": "application/json",
-                 "Accept": "application/json"
-            }
-        logging.debug(f"Calling Ollama ({model_name}) for {purpose} at {target_url}: {messages}")
-    else:
-        # Use WebUI API
-        logging.info(f"Using WebUI API for LLM calls.")
-        target_url = f"{WEBUI_API_BASE}/api/chat/completions"
-        headers={"Content-Type": "application/json", 
-            "Accept": "application/json",
-            "Authorization": f"Bearer {WEBUI_API_KEY}"
-            }
-        logging.debug(f"Calling WebUI ({model_name}) for {purpose} at {target_url}: {messages}")
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                target_url,
-                headers=headers,
-                # Use the passed model_name in the payload
-                json={"model": model_name, "messages": messages, "stream": False},
+def llm_payload(model_name: str, messages: list, stream: bool, response_format: Optional[dict] = None) -> dict:
+    payload = {"model": model_name, "messages": messages, "stream": stream, **keep_alive_fields()}
+    if response_format:
+        payload["response_format"] = response_format
+    return payload
+
+
+async def call_llm(messages: list, model_name: str, purpose: str = "LLM call", response_format: Optional[dict] = None,
+                   priority: str = "interactive") -> str: 
+    """Calls an OpenAI-compatible backend from the pool (see llm_backends.py), queued by `priority` (see llm_scheduler.py)."""
+    logging.debug(f"Messages for {purpose}: {messages}")
+    # Use the passed model_name in the payload
+    payload = llm_payload(model_name, messages, False, response_format)
+
+    async def send(backend: Backend) -> dict:
+        logging.debug(f"Calling {backend.name} ({model_name}) for {purpose} at {backend.chat_url}")
+        async with LLM_SCHEDULER.slot(backend.chat_url, priority):
+            response = await HTTP.post(
+                backend.chat_url,
+                target="llm",
+                headers=backend.headers(),
+                json=payload,
                 timeout=90
             )
-            response.raise_for_status()
-            result = response.json()
-            logging.debug(f"WebUI Raw Response for {purpose} ({model_name}): {result}")
-            if "choices" in result and len(result["choices"]) > 0 and "message" in result["choices"][0] and "content" in result["choices"][0]["message"]:
-                 response_text = result["choices"][0]["message"]["content"].strip()
-                 logging.info(f"WebUI call successful for {purpose} ({model_name}).")
-                 return response_text
-            else:
-                logging.error(f"Unexpected WebUI response format for {purpose} ({model_name}): {result}")
-                raise HTTPException(status_code=500, detail=f"Unexpected response format from LLM for {purpose}.")
+        response.raise_for_status()
+        return response.json()
+
+    try:
+        result = await LLM_POOL.call(model_name, send, priority)
+        logging.debug(f"LLM Raw Response for {purpose} ({model_name}): {result}")
+        if "choices" in result and len(result["choices"]) > 0 and "message" in result["choices"][0] and "content" in result["choices"][0]["message"]:
+             response_text = result["choices"][0]["message"]["content"].strip()
+             logging.info(f"LLM call successful for {purpose} ({model_name}).")
+             return response_text
+        else:
+            logging.error(f"Unexpected LLM response format for {purpose} ({model_name}): {result}")
+            raise HTTPException(status_code=500, detail=f"Unexpected response format from LLM for {purpose}.")
+    except (SchedulerRejected, NoBackendAvailable) as e:
+        raise HTTPException(status_code=503, detail=f"LLM busy, {purpose} not sent: {e}")
     except httpx.RequestError as e:
-        logging.error(f"WebUI request failed for {purpose} ({model_name}): {e}")
-        raise HTTPException(status_code=503, detail=f"Could not connect to WebUI at {WEBUI_API_BASE}: {e}")
+        logging.error(f"LLM request failed for {purpose} ({model_name}): {e}")
+        raise HTTPException(status_code=503, detail=f"Could not connect to the LLM: {e}")
     except httpx.HTTPStatusError as e:
         # (Error handling for status codes remains the same)
         status_code = e.response.status_code
         try: response_detail = e.response.json().get("error", e.response.text[:200])
         except json.JSONDecodeError: response_detail = e.response.text[:200]
-        log_message = f"WebUI ({model_name}) returned error status {status_code} for {purpose}: {response_detail}"
-        error_detail = f"WebUI error {status_code}: {response_detail}"
+        log_message = f"LLM ({model_name}) returned error status {status_code} for {purpose}: {response_detail}"
+        error_detail = f"LLM error {status_code}: {response_detail}"
         if status_code == 301:
             redirect_location = e.response.headers.get('Location', 'N/A')
-            log_message += f" (Redirect detected to: {redirect_location}. Check WEBUI_API_BASE)"
+            log_message += f" (Redirect detected to: {redirect_location}. Check the backend URL)"
             error_detail += f" (Possible URL misconfiguration, redirect: {redirect_location})"
         logging.error(log_message)
         raise HTTPException(status_code=status_code, detail=error_detail)
     except Exception as e:
-        logging.error(f"An unexpected error occurred during WebUI call for {purpose} ({model_name}): {e}")
+        logging.error(f"An unexpected error occurred during LLM call for {purpose} ({model_name}): {e}")
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred during {purpose}: {e}")
 
 
+async def call_llm_stream(messages: list, model_name: str, purpose: str = "LLM call", response_format: Optional[dict] = None,
+                          priority: str = "interactive"):
+    """Streams a chat completion from the OpenAI-compatible API, yielding text deltas as they arrive."""
+    payload = llm_payload(model_name, messages, True, response_format)
+    tried = []
+    while True:
+        streamed = False
+        try:
+            async with LLM_POOL.stream(model_name, tuple(tried)) as backend:
+                tried.append(backend)
+                # The slot is held until the last chunk has arrived
+                async with LLM_SCHEDULER.slot(backend.chat_url, priority), HTTP.track("llm"):
+                    async with HTTP.client.stream(
+                        "POST",
+                        backend.chat_url,
+                        headers=backend.headers(stream=True),
+                        json=payload,
+                        timeout=HTTP.timeout(90)
+                    ) as response:
+                        if response.is_error:
+                            await response.aread()
+                        response.raise_for_status()
+                        async for line in response.aiter_lines():
+                            # OpenAI-compatible SSE: "data: {json}" per chunk, terminated by "data: [DONE]"
+                            line = line.strip()
+                            if not line.startswith("data:"):
+                                continue
+                            data = line[len("data:"):].strip()
+                            if data == "[DONE]":
+                                break
+                            try:
+                                chunk = json.loads(data)
+                            except json.JSONDecodeError:
+                                logging.warning(f"Skipping undecodable stream chunk for {purpose} ({model_name}): {data[:100]}")
+                                continue
+                            choices = chunk.get("choices") or []
+                            delta = choices[0].get("delta", {}).get("content") if choices else None
+                            if delta:
+                                streamed = True
+                                yield delta
+            logging.info(f"Streaming call successful for {purpose} ({model_name}) on {backend.name}.")
+            return
+        except (SchedulerRejected, httpx.RequestError, httpx.HTTPStatusError) as e:
+            # Another backend can take over as long as the student has not seen any of this answer
+            if not streamed and len(tried) < LLM_POOL.max_attempts and (isinstance(e, SchedulerRejected) or is_backend_failure(e)):
+                logging.warning(f"Streaming {purpose} failed on {tried[-1].name} ({type(e).__name__}). Trying another backend.")
+                continue
+            if isinstance(e, SchedulerRejected):
+                raise HTTPException(status_code=503, detail=f"LLM busy, {purpose} not sent: {e}")
+            if isinstance(e, httpx.RequestError):
+                logging.error(f"Streaming request failed for {purpose} ({model_name}): {e}")
+                raise HTTPException(status_code=503, detail=f"Could not connect to LLM at {tried[-1].chat_url}: {e}")
+            status_code = e.response.status_code
+            logging.error(f"LLM ({model_name}) returned error status {status_code} for streamed {purpose}: {e.response.text[:200]}")
+            raise HTTPException(status_code=status_code, detail=f"LLM error {status_code}: {e.response.text[:200]}")
+        except NoBackendAvailable as e:
+            raise HTTPException(status_code=503, detail=f"LLM busy, {purpose} not sent: {e}")
+
 # --- Database Functions ---
-def add_to_history(student_id: str, message_type: str, message_text: str, message_classification: Optional[str] = None, file_name: Optional[str] = None):
+async def add_to_history(student_id: str, message_type: str, message_text: str, message_classification: Optional[str] = None, file_name: Optional[str] = None) -> Optional[int]:
     """	
-    Adds a message to the chat history in the database.
+    Adds a message to the chat history in the database and returns its row id.
     """
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO chat_history (student_id, timestamp, message_type, message_text, message_classification, file_name)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (student_id, time.time(), message_type, message_text, message_classification, file_name))
-            conn.commit()
-            logging.info(f"Added to history: {student_id}, {message_type}, file: {file_name}")
+        with time_stage("ta", "db_write"):
+            row_id = await DB.run(db.insert_message, student_id, time.time(), message_type, message_text, message_classification, file_name)
+        logging.info(f"Added to history: {student_id}, {message_type}, file: {file_name}")
+        return row_id
     except sqlite3.Error as e:
         logging.error(f"Failed to add message to history: {e}")
+        return None
 
-def get_history(student_id: str, file_name: str, limit: int = 6) -> List[dict]: # Added file_name parameter
-    """Retrieves the last 'limit' messages for a specific student and file, ordered chronologically, formatted for LLM API."""
+async def get_history(student_id: str, file_name: str, limit: int = 6, after_id: int = 0) -> List[dict]: # Added file_name parameter
+    """Retrieves the last 'limit' messages (after message `after_id`) for a specific student and file, ordered chronologically, formatted for LLM API."""
     history_for_llm = []
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT message_type, message_text
-                FROM chat_history
-                WHERE student_id = ? AND file_name = ?
-                ORDER BY timestamp DESC
-                LIMIT ?
-            """, (student_id, file_name, limit)) 
-            history_rows = cursor.fetchall()
-            history_rows.reverse() # Chronological order
-
-            # Convert to the required {"role": ..., "content": ...} format
-            for row in history_rows:
-                 role = "user" if row["message_type"] == "question" else "assistant"
-                 content = row["message_text"]
-                 history_for_llm.append({"role": role, "content": content})
-
-            logging.info(f"Retrieved and formatted {len(history_for_llm)} history entries for {student_id} (file: {file_name}).") 
+        with time_stage("ta", "history_fetch"):
+            history_rows = await DB.run(db.fetch_recent_messages, student_id, file_name, limit, after_id)
+        history_rows.reverse() # Chronological order
+
+        # Convert to the required {"role": ..., "content": ...} format
+        for row in history_rows:
+             role = "user" if row["message_type"] == "question" else "assistant"
+             content = row["message_text"]
+             history_for_llm.append({"role": role, "content": content})
+
+        logging.info(f"Retrieved and formatted {len(history_for_llm)} history entries for {student_id} (file: {file_name}).") 
     except sqlite3.Error as e:
         logging.error(f"Failed to retrieve/format history for {student_id} (file: {file_name}): {e}") 
     return history_for_llm
 
-def format_history_for_prompt(history_messages: list) -> str:
+async def get_summarized_history(student_id: str, file_name: str, limit: int = 6) -> tuple:
+    """Returns (rolling summary or None, messages it does not cover yet); just the last `limit` messages when summaries are off."""
+    if not SUMMARIZER.enabled:
+        return None, await get_history(student_id, file_name, limit=limit)
+    try:
+        summary, last_message_id = await SUMMARIZER.get(student_id, file_name)
+    except sqlite3.Error as e:
+        logging.error(f"Failed to retrieve conversation summary for {student_id} (file: {file_name}): {e}")
+        summary, last_message_id = None, 0
+    return summary, await get_history(student_id, file_name, limit=SUMMARIZER.window, after_id=last_message_id)
+
+def format_history_for_prompt(history_messages: list, summary: Optional[str] = None) -> str:
     """Formats a list of message dicts (from get_history, which are {'role': ..., 'content': ...}) into a simple string."""
+    summary_text = f"Summary of the Earlier Conversation:\n{summary}\n\n" if summary else ""
     if not history_messages:
-        return "No recent conversation history."
+        return summary_text + "No recent conversation history."
 
-    formatted_string = "Recent Conversation History:\n"
+    formatted_string = summary_text + "Recent Conversation History:\n"
     for msg in history_messages:
         role = "Student" if msg.get("role") == "user" else "Juno"
         content = msg.get("content", "[message unavailable]")
@@ -524,209 +553,209 @@ def format_history_for_prompt(history_messages: list) -> str:
     return formatted_string.strip()
 
 
-# --- Background Task Function ---
-async def classify_and_update_profile(student_id: str, file_name: str, question_text: str, timestamp: float):
-    """Background task to classify a question and update the student profile."""
-    logging.info(f"Background task started: Classify and update profile for {student_id}")
-    classification_result = "other" # Default classification
+async def summarize_conversation(messages: list) -> str:
+    return await call_llm(messages, model_name=CLASSIFICATION_MODEL_NAME, purpose="conversation summary", priority="background")
+
+# Rolling summary per (student, file), updated in the background every few turns (see conversation_summary.py)
+SUMMARIZER = ConversationSummarizer(DB, summarize_conversation)
+
+
+# --- Question Classification ---
+CLASSIFICATION_CACHE = ClassificationCache()
+LOCAL_CLASSIFIER = LocalClassifier()
+
+
+def load_classification_config(snapshot: InputsSnapshot) -> tuple:
+    """Returns the classification prompt and options from the inputs snapshot, falling back to the defaults."""
+    classification_system_prompt = snapshot.text(CLASSIFICATION_PROMPT_FILE)
+    if classification_system_prompt is None:
+        logging.error(f"Classification prompt {CLASSIFICATION_PROMPT_FILE} not found. Using default.")
+        classification_system_prompt = DEFAULT_CLASSIFICATION_PROMPT
+
+    possible_classifications = list(snapshot.lines(POSSIBLE_CLASSIFICATIONS_FILE))
+    if not possible_classifications:
+        logging.error(f"Classification options {POSSIBLE_CLASSIFICATIONS_FILE} missing or empty. Using default.")
+        possible_classifications = DEFAULT_POSSIBLE_CLASSIFICATIONS
+    return classification_system_prompt, possible_classifications
+
+
+async def classify_question_text(question_text: str, purpose: str = "question classification", question_embedding=None,
+                                 snapshot: Optional[InputsSnapshot] = None, priority: str = "interactive") -> Tuple[str, str]:
+    """Classifies a question, answering repeated and near-duplicate questions from the cache.
+
+    Returns (label, source), the source being one of db.CLASSIFICATION_SOURCES
+    ('cache', 'local', 'llm' or 'default'); only LLM labels train the local
+    classifier.
+
+    With `classification_mode=local`, the kNN model from local_classifier.py
+    answers first and the LLM is only asked when it is not confident enough.
+
+    Only valid labels are cached; LLM failures fall back to 'other' without
+    poisoning the cache.
+    """
+    classification_system_prompt, possible_classifications = load_classification_config(snapshot or INPUTS.current)
+    fingerprint = classification_fingerprint(classification_system_prompt, possible_classifications)
+    if question_embedding is None:
+        question_embedding = await encode_question(question_text)
+
+    cached = CLASSIFICATION_CACHE.get(question_text, fingerprint, question_embedding)
+    if cached is not None:
+        logging.info(f"Classification cache hit for '{question_text[:50]}': {cached}")
+        return cached, "cache"
+
+    if CLASSIFICATION_MODE == "local" and question_embedding is not None:
+        LOCAL_CLASSIFIER.maybe_reload()
+        local_label, confidence = LOCAL_CLASSIFIER.predict(question_embedding)
+        if local_label in possible_classifications and confidence >= LOCAL_CLASSIFIER_THRESHOLD:
+            LOCAL_CLASSIFIER_DECISIONS.labels(outcome="local").inc()
+            logging.info(f"Local classifier labeled '{question_text[:50]}' as {local_label} (confidence {confidence:.2f})")
+            CLASSIFICATION_CACHE.put(question_text, fingerprint, local_label, question_embedding)
+            return local_label, "local"
+        LOCAL_CLASSIFIER_DECISIONS.labels(outcome="fallback").inc()
+        logging.info(f"Local classifier not confident ({local_label}, {confidence:.2f}). Falling back to the LLM.")
+
+    classification_prompt_messages = [
+        {"role": "system", "content": classification_system_prompt},
+        {"role": "user", "content": f"Classify: {question_text}"}
+    ]
+
     try:
-        # Load classification prompt from file
-        try:
-            with open(CLASSIFICATION_PROMPT_FILE, 'r') as f:
-                classification_system_prompt = f.read()
-        except Exception as e:
-            logging.error(f"Background task: Failed to load classification prompt: {e}. Using default.")
-            classification_system_prompt = DEFAULT_CLASSIFICATION_PROMPT
-
-        try:    
-            with open(POSSIBLE_CLASSIFICATIONS_FILE, 'r') as f:
-                POSSIBLE_CLASSIFICATIONS = [line.strip().lower() for line in f if line.strip()]
-            if not POSSIBLE_CLASSIFICATIONS: 
-                raise ValueError("Classification options file is empty or contains only whitespace.")
-            logging.info(f"Loaded {len(POSSIBLE_CLASSIFICATIONS)} classification options from {POSSIBLE_CLASSIFICATIONS_FILE}")
-        except Exception as e:
-            logging.error(f"Background task: Failed to load classification options: {e}. Using default.")
-            POSSIBLE_CLASSIFICATIONS = DEFAULT_POSSIBLE_CLASSIFICATIONS
-
-        classification_prompt_messages = [
-            {"role": "system", "content": classification_system_prompt},
-            {"role": "user", "content": f"Classify: {question_text}"}
-        ]
-        # Call LLM for classification
-        raw_classification = await call_llm(
-            classification_prompt_messages,
-            model_name=CLASSIFICATION_MODEL_NAME,
-            purpose="background classification"
-        )
+        with time_stage("ta", "classification_llm"):
+            raw_classification = await call_llm(
+                classification_prompt_messages,
+                model_name=CLASSIFICATION_MODEL_NAME,
+                purpose=purpose,
+                priority=priority
+            )
         clean_classification = raw_classification.strip().lower()
-        if clean_classification in POSSIBLE_CLASSIFICATIONS:
-            classification_result = clean_classification
+        if clean_classification in possible_classifications:
+            CLASSIFICATION_CACHE.put(question_text, fingerprint, clean_classification, question_embedding)
+            return clean_classification, "llm"
         else:
-            logging.warning(f"Background task: Unexpected classification '{raw_classification}'. Using default '{classification_result}'.")
-
+            logging.warning(f"Unexpected classification '{raw_classification}'. Using default 'other'.")
+            FALLBACKS.labels(service="ta", fallback="default_classification").inc()
+            return "other", "default"
     except Exception as e:
-        logging.error(f"Background task: Classification LLM call failed for {student_id}: {e}. Using default '{classification_result}'.")
+        logging.error(f"Classification failed ({purpose}): {e}. Using default 'other'.")
+        FALLBACKS.labels(service="ta", fallback="default_classification").inc()
+        return "other", "default"
 
-    # Update profile using the synchronous function
-    try:
-        update_student_profile_sync(student_id, file_name, classification_result, timestamp, question_text, 0, "other")
-    except Exception as e:
-        logging.error(f"Background task: Failed during update_student_profile_sync for {student_id}: {e}", exc_info=True)
 
-    logging.info(f"Background task finished for {student_id}")
+# --- Background Task Function ---
+async def classify_and_update_profile(student_id: str, file_name: str, question_text: str, timestamp: float):
+    """Background task to classify a question and update the student profile."""
+    logging.info(f"Background task started: Classify and update profile for {student_id}")
+    classification_result, _ = await classify_question_text(question_text, purpose="background classification", priority="background")
 
+    # Queue the profile update
+    PROFILE_WRITER.record(student_id, file_name, classification_result, timestamp, question_text, 0, "other")
 
-# --- API Endpoints ---
-@app.post("/receive_student_message", response_model=TutorApiResponse)
-async def receive_student_message(message: StudentMessage, background_tasks: BackgroundTasks):
-    """
-    Handles incoming student messages:
-    1. Classifies the question type (instrumental/executive/other)
-    2. Calls EA directly with context (history, logs, LO, assignment, question).
-    3. Formulates pedagogical response using LLM + context + EA answer + classification.
-    4. Schedules background task for profile update.
-    """
-    
-    # --- A/B Testing: Get student's group and parameters --- Added Block
-    student_experiment_group = get_or_assign_experiment_group(message.student_id)
-    
-    # Default parameters (if A/B test not active or group has no params)
-    current_ta_system_prompt_file = TA_SYSTEM_PROMPT_FILE
-    current_profile_hint_strategy = "standard" # Default strategy
+    logging.info(f"Background task finished for {student_id}")
 
-    if student_experiment_group and "params" in student_experiment_group:
-        group_params = student_experiment_group["params"]
-        current_ta_system_prompt_file = group_params.get("system_prompt_file", TA_SYSTEM_PROMPT_FILE)
-        current_profile_hint_strategy = group_params.get("profile_hint_strategy", "standard")
-        logging.info(f"A/B Test: Student {message.student_id} in group '{student_experiment_group['group_id']}'. Using prompt file '{current_ta_system_prompt_file}' and hint strategy '{current_profile_hint_strategy}'.")
-    else:
-        logging.info(f"A/B Test: No specific group or params for student {message.student_id}. Using default TA prompt and hint strategy.")
-    # --- End A/B Testing Block ---
 
-    if message.message_text.strip().lower() == "/report":
-        """
-        Generates a performance report for the student based on their recent activity logs and conversation history.
-        """
-        assignment_id = derive_assignment_id(message.file_name)
-        assignment_desc = ASSIGNMENT_DESCRIPTIONS.get(assignment_id, DEFAULT_ASSIGNMENT_DESCRIPTION)
-        learning_objs = LEARNING_OBJECTIVES_MAP.get(assignment_id, DEFAULT_LEARNING_OBJECTIVES)
-        next_steps = NEXT_STEPS_MAP.get(assignment_id, ["Proceed to next assignment.", "Ask Juno for exercises."])
-        
-        history_msgs = get_history(message.student_id, message.file_name, limit=50)
-        hist_str = format_history_for_prompt(history_msgs)
-        logs_ctx = message.processed_logs or "No activity logs."
-      
-        report_prompt = [
-            {"role":"system", "content":
-                """You are Juno, an automated coach.  
-                Using the student's recent notebook logs, conversation history and the assignment's learning objectives, produce a clear performance report for the student. 
-                For each learning objective, note strengths, weaknesses, and concrete next steps. 
-                Based on the report, suggest a personalized next step for the student.
-                Use an encouraging tone, and avoid technical jargon.
-                """},
-            {"role":"user", "content": f"""
-            [INTERNAL CONTEXT: DO NOT REVEAL SOURCES]
-            Assignment:
-            {assignment_desc}
-
-            Learning Objectives:
-            - {chr(10).join(learning_objs)}
-
-            Full Activity Logs:
-            {logs_ctx}
-
-            Conversation History:
-            {hist_str}
-
-            Next Steps (suggest one for the student based on performance):
-            {chr(10).join(next_steps)}
-            [END INTERNAL CONTEXT]
-            ---
-            Please generate a reflective performance report of the student, for the student.
-            """}
-        ]
-        report = await call_llm(
-            report_prompt,
-            model_name=RESPONSE_MODEL_NAME,
-            purpose="performance report generation"
-        )
-        return TutorApiResponse(final_response=report)
+# --- Pedagogical Response Pipeline ---
+def profile_hint(profile_hint_strategy: str, classification_result: str, student_profile: dict, student_id: str,
+                 log_decisions: bool = True) -> tuple:
+    """Returns (hint to append to the TA system prompt, updated consecutive executive count) for a question."""
+    log = logging.info if log_decisions else logging.debug
+    hint = ""
 
-        # --- NEW LOGIC FOR THE COMPLETION COMMAND ---
-    elif message.message_text.strip().lower() == "/qualtrics-finish":
-        # Check if student has spent minimum required time AND has sufficient activity
-        MIN_SESSION_DURATION_MINUTES = 15  # Adjust as needed
-        MIN_INTERACTIONS = 1  # Minimum number of questions/interactions
-        
-        # Get the student's session stats
-        try:
-            with sqlite3.connect(DATABASE_FILE) as conn:
-                cursor = conn.cursor()
-                # Get first interaction and count of questions
-                cursor.execute("""
-                    SELECT MIN(timestamp) as first_interaction,
-                           COUNT(CASE WHEN message_type = 'question' THEN 1 END) as question_count
-                    FROM chat_history
-                    WHERE student_id = ? AND file_name = ?
-                """, (message.student_id, message.file_name))
-                result = cursor.fetchone()
-                
-                if result and result[0]:
-                    first_interaction, question_count = result
-                    current_time = time.time()
-                    session_duration_minutes = (current_time - first_interaction) / 60
-                    
-                    # Check both time and activity requirements
-                    time_requirement_met = session_duration_minutes >= MIN_SESSION_DURATION_MINUTES
-                    activity_requirement_met = question_count >= MIN_INTERACTIONS
-                    
-                    if not time_requirement_met or not activity_requirement_met:
-                        feedback_parts = []
-                        
-                        if not time_requirement_met:
-                            remaining_minutes = MIN_SESSION_DURATION_MINUTES - session_duration_minutes
-                            feedback_parts.append(f"- Work for at least {remaining_minutes:.1f} more minutes (currently: {session_duration_minutes:.1f} minutes)")
-                        
-                        if not activity_requirement_met:
-                            remaining_questions = MIN_INTERACTIONS - question_count
-                            feedback_parts.append(f"- Ask at least {remaining_questions} more questions (currently: {question_count} questions)")
-                        
-                        early_finish_response = f"""### Almost There!
-To ensure a meaningful learning experience, please:
+    # Get current question classification and profile info
+    last_classification = student_profile.get("last_question_classification")
+    consecutive_executive = student_profile.get("consecutive_executive_count", 0)
 
-{chr(10).join(feedback_parts)}
+    # --- Update consecutive_executive_count for this request ---
+    if classification_result == "executive":
+        if last_classification == "executive":
+            consecutive_executive += 1
+        else:
+            consecutive_executive = 1
+    else:
+        consecutive_executive = 0
+    # --- End update ---
+
+    # Apply adaptive response logic based on A/B test group and question type
+    if profile_hint_strategy == "enhanced_guidance":
+        # Treatment group gets adaptive help-seeking logic
+        if classification_result == "instrumental":
+            # Reset consecutive_executive streak
+            consecutive_executive = 0
+            if last_classification == "executive":
+                # Shift from executive to instrumental - provide positive reinforcement
+                hint += """\n**Profile Hint (Positive Reinforcement):** The student has shifted from an executive to an instrumental question. Provide explicit positive reinforcement for this shift (e.g., "That's a very effective way to ask for help to understand the material.") along with standard JIT support."""
+                log(f"Adaptive Logic: Detected shift from executive to instrumental for {student_id}")
+            else:
+                # Ongoing instrumental questions - maintain standard support
+                hint += """\n**Profile Hint (Standard Support):** Continue providing JIT support with a positive and encouraging tone, but without explicit praise. The primary reinforcement is the answer itself."""
+                log(f"Adaptive Logic: Ongoing instrumental questions for {student_id}")
+
+        elif classification_result == "executive":
+            # Incremental hints based on consecutive executive questions
+            if consecutive_executive == 0:
+                # No executive streak, skip hint or use a default (no hint)
+                pass
+            elif consecutive_executive == 1:
+                hint += """\n**Profile Hint (First Executive):** 
+                This is the first executive question in sequence. Gently guide the student towards reflection, without requiring direct rephrasing. 
+                For example: "That question seems focused on getting the answer directly. For the following questions, can you think about how to rephrase them to better understand the underlying concepts?" """
+                log(f"Adaptive Logic: First executive question for {student_id}")
+            elif consecutive_executive == 2:
+                hint += """\n**Profile Hint (Second Executive):** 
+                This is the second consecutive executive question. Provide elements of good instrumental questions. 
+                For example: "Good questions often explore the 'why' or 'how' of a concept, or compare different approaches. How might you rephrase following questions with that in mind?" or "Good questions decompose complex concepts into smaller, more manageable parts. How might you rephrase following questions with that in mind?" """
+                log(f"Adaptive Logic: Second consecutive executive question for {student_id}")
+            elif consecutive_executive == 3:
+                last_exec_example = student_profile.get("last_executive_example", "your previous question")
+                hint += f"""\n**Profile Hint (Third Executive):** 
+                This is the third consecutive executive question. Take the student's question and rephrase it as a model instrumental question. For example: 
+                "Instead of asking 'make a bar plot', a better version might be 'what is the first step to make a bar plot?' Could you try rephrasing your next request similarly?"
+                Student's previous question: {last_exec_example} """
+                log(f"Adaptive Logic: Third consecutive executive question for {student_id}")
+            else:
+                last_instr_example = student_profile.get("last_instrumental_example", "your previous question")
+                hint += f"""\n**Profile Hint (Fourth+ Executive):** 
+                This is the fourth or subsequent consecutive executive question. Directly refer to the pedagogical rationale. 
+                For example: "Research in learning suggests that asking questions focused on understanding is more strongly linked to better learning outcomes than seeking direct solutions. It might be helpful to try and focus on understanding the process here." or "Focusing on direct solutions is not as effective as asking questions that help you understand the material. How might you rephrase your next request to focus on understanding the material?"
+                Use their previous good question as motivation: {last_instr_example} """
+                log(f"Adaptive Logic: Fourth+ consecutive executive question for {student_id}")
+    elif profile_hint_strategy == "none":
+        # Control group gets no adaptive hints
+        log(f"Control group: No adaptive hints for {student_id}")
+        pass
+    else:
+        logging.warning(f"Unknown profile hint strategy '{profile_hint_strategy}' for {student_id}")
+    return hint, consecutive_executive
 
-You can try `/qualtrics-finish` again once you meet these requirements."""
-                        return TutorApiResponse(final_response=early_finish_response)
-                else:
-                    # No interaction history found - this shouldn't happen normally
-                    logging.warning(f"No interaction history found for {message.student_id} in {message.file_name}")
-        except sqlite3.Error as e:
-            logging.error(f"Database error checking session requirements: {e}")
-        
-        # If requirements are met or there was an error, show completion code
-        completion_code = """### Session 1 Complete!
 
-Thank you for completing the tasks for this session.
+async def prepare_pedagogical_turn(message: StudentMessage, current_ta_system_prompt_file: str, current_profile_hint_strategy: str,
+                                   pipeline_mode: str = "standard", fused_classification: bool = False) -> PreparedTurn:
+    """Runs everything up to the final pedagogical LLM call for a student question.
 
-Please return to the Qualtrics survey tab and enter the following code to finalize your submission:
+    Gathers context, stores the question, classifies it and queries the EA in
+    parallel, and builds the final prompt. Shared by the blocking and the
+    streaming endpoints, which differ only in how they call the LLM.
 
-**`BLUE-SHARK-24`**"""
-        return TutorApiResponse(final_response=completion_code)
-    
+    In the fused pipeline the EA is not called. The final prompt asks for the
+    technical answer and the reply in one JSON object (see fused_pipeline.py).
+    With `fused_classification`, the same call also classifies the question,
+    so no separate classification call is made.
+    """
+    fused = pipeline_mode == "fused"
     start_time = time.time()
     current_timestamp = time.time()
+    # One snapshot for the whole turn, even if inputs/ is reloaded meanwhile
+    inputs = INPUTS.current
     logging.info(f"TA received message from {message.student_id} (file: {message.file_name}): '{message.message_text[:100]}...'")
 
     # --- 0. Get Context ---
-    student_profile = get_student_profile(message.student_id, message.file_name)
+    student_profile = await get_student_profile(message.student_id, message.file_name)
     needs_guidance = student_profile.get("needs_guidance_flag", False)
     last_exec_example = student_profile.get("last_executive_example")
     last_instr_example = student_profile.get("last_instrumental_example")
     logging.info(f"Retrieved profile for {message.student_id}: Guidance Flag = {needs_guidance}")
 
-    conversation_history_messages = get_history(message.student_id, message.file_name, limit=6)
-    formatted_history_for_ea = format_history_for_prompt(conversation_history_messages)
+    conversation_summary, conversation_history_messages = await get_summarized_history(message.student_id, message.file_name, limit=6)
+    formatted_history_for_ea = format_history_for_prompt(conversation_history_messages, conversation_summary)
 
     # --- Extract Processed Logs ---
     logs_context = "No recent activity logs available."
@@ -737,272 +766,582 @@ Please return to the Qualtrics survey tab and enter the following code to finali
         logging.info("No processed logs provided or logs were empty.")
 
     assignment_id = derive_assignment_id(message.file_name)
-    assignment_description = ASSIGNMENT_DESCRIPTIONS.get(
+    assignment_description = inputs.assignment_descriptions.get(
         assignment_id,
         DEFAULT_ASSIGNMENT_DESCRIPTION
     )
-    learning_objectives = LEARNING_OBJECTIVES_MAP.get(
+    learning_objectives = inputs.learning_objectives.get(
         assignment_id,
         DEFAULT_LEARNING_OBJECTIVES
     )
 
     # Default values
     ea_response = "The expert agent could not provide an answer."
-    final_response = "I'm sorry, I encountered an issue processing your request. Please try again."
     classification_result = "other"  # Default classification
 
-    try:
-        # --- 1. Select Learning Objective ---
-        learning_objective = select_learning_objective_embeddings(message.message_text, learning_objectives)
-        logging.info(f"Selected LO: {learning_objective}")
-
-        # --- 2. Store Current Question ---
-        add_to_history(
-            student_id=message.student_id, message_type="question",
-            message_text=message.message_text, message_classification=None,
-            file_name=message.file_name
-        )
-
-        # --- 3. Parallel Classification of Question and EA Call ---
-        async def classify_question():
-            try:
-                with open(CLASSIFICATION_PROMPT_FILE, 'r') as f:
-                    classification_system_prompt = f.read()
-            except Exception as e:
-                logging.error(f"Failed to load classification prompt: {e}. Using default.")
-                classification_system_prompt = DEFAULT_CLASSIFICATION_PROMPT
-
-            try:    
-                with open(POSSIBLE_CLASSIFICATIONS_FILE, 'r') as f:
-                    POSSIBLE_CLASSIFICATIONS = [line.strip().lower() for line in f if line.strip()]
-                if not POSSIBLE_CLASSIFICATIONS: 
-                    raise ValueError("Classification options file is empty or contains only whitespace.")
-                logging.info(f"Loaded {len(POSSIBLE_CLASSIFICATIONS)} classification options")
-            except Exception as e:
-                logging.error(f"Failed to load classification options: {e}. Using default.")
-                POSSIBLE_CLASSIFICATIONS = DEFAULT_POSSIBLE_CLASSIFICATIONS
-
-            classification_prompt_messages = [
-                {"role": "system", "content": classification_system_prompt},
-                {"role": "user", "content": f"Classify: {message.message_text}"}
-            ]
-            
-            try:
-                raw_classification = await call_llm(
-                    classification_prompt_messages,
-                    model_name=CLASSIFICATION_MODEL_NAME,
-                    purpose="question classification"
+    # --- 1. Select Learning Objective ---
+    # The embedding is shared with the classification cache's near-duplicate lookup
+    with time_stage("ta", "lo_selection"):
+        question_embedding = await encode_question(message.message_text)
+        learning_objective = await select_learning_objective_embeddings(message.message_text, learning_objectives, question_embedding, assignment_id)
+    if learning_objective == "No specific LO":
+        FALLBACKS.labels(service="ta", fallback="default_learning_objective").inc()
+    logging.info(f"Selected LO: {learning_objective}")
+    
+    # --- 2. Store Current Question ---
+    question_id = await add_to_history(
+        student_id=message.student_id, message_type="question",
+        message_text=message.message_text, message_classification=None,
+        file_name=message.file_name
+    )
+    
+    # --- 3. Parallel Classification of Question and EA Call ---
+    async def classify_question():
+        return await classify_question_text(message.message_text, question_embedding=question_embedding, snapshot=inputs)
+    
+    async def call_expert_agent():
+        try:
+            session_id = extract_session_id_from_filename(message.file_name, message.student_id)
+            ea_payload = {
+                "student_question": message.message_text,
+                "assignment_description": assignment_description,
+                "learning_objective": learning_objective,
+                "history": formatted_history_for_ea,
+                "logs": logs_context,
+                "session_id": session_id,
+                # Lets the EA reuse an answer to the same question from another student (see ea_cache.py)
+                "assignment_id": assignment_id,
+                "question_embedding": question_embedding.tolist() if question_embedding is not None else None,
+                "embedding_model": EMBEDDING_MODEL_NAME,
+                "timeout_seconds": EA_TIMEOUT_SECONDS,
+            }
+            logging.info(f"Calling EA at {EA_URL} with direct context for session {session_id}")
+            logging.debug(f"EA Payload: {ea_payload}")
+    
+            with time_stage("ta", "ea_call"):
+                ea_api_response = await HTTP.post(
+                    EA_URL,
+                    target="ea",
+                    json=ea_payload,
+                    timeout=EA_TIMEOUT_SECONDS
                 )
-                clean_classification = raw_classification.strip().lower()
-                if clean_classification in POSSIBLE_CLASSIFICATIONS:
-                    return clean_classification
-                else:
-                    logging.warning(f"Unexpected classification '{raw_classification}'. Using default 'other'.")
-                    return "other"
-            except Exception as e:
-                logging.error(f"Classification failed: {e}. Using default 'other'.")
-                return "other"
-
-        async def call_expert_agent():
-            try:
-                session_id = extract_session_id_from_filename(message.file_name, message.student_id)
-                ea_payload = {
-                    "student_question": message.message_text,
-                    "assignment_description": assignment_description,
-                    "learning_objective": learning_objective,
-                    "history": formatted_history_for_ea,
-                    "logs": logs_context,
-                    "session_id": session_id
-                }
-                logging.info(f"Calling EA at {EA_URL} with direct context for session {session_id}")
-                logging.debug(f"EA Payload: {ea_payload}")
-
-                async with httpx.AsyncClient() as client:
-                    ea_api_response = await client.post(
-                        EA_URL,
-                        json=ea_payload,
-                        timeout=30
-                    )
-                    ea_api_response.raise_for_status()
-                    return ea_api_response.json()["response"]
-            except Exception as e:
-                logging.error(f"EA call failed: {e}. Using default EA response.")
-                return "The expert agent could not provide an answer."
-
-        # Run classification and EA call in parallel
-        classification_task = asyncio.create_task(classify_question())
-        ea_task = asyncio.create_task(call_expert_agent())
-        
-        # Wait for both tasks to complete
-        classification_result = await classification_task
+                ea_api_response.raise_for_status()
+                return ea_api_response.json()["response"]
+        except Exception as e:
+            logging.error(f"EA call failed: {e}. Using default EA response.")
+            FALLBACKS.labels(service="ta", fallback="default_ea_response").inc()
+            return "The expert agent could not provide an answer."
+    
+    # Run classification and EA call in parallel (the fused pipeline skips the EA, and optionally the classifier)
+    classification_task = None if fused and fused_classification else asyncio.create_task(classify_question())
+    ea_task = None if fused else asyncio.create_task(call_expert_agent())
+    
+    # Wait for both tasks to complete
+    classification_result, classification_source = await classification_task if classification_task else (None, "default")
+    if ea_task:
         ea_response = await ea_task
-        
-        logging.info(f"Question classified as: {classification_result}")
         logging.info(f"EA response received: '{ea_response[:100]}...'")
+    
+    logging.info(f"Question classified as: {classification_result or '(by the fused call)'}")
+    
+    # --- 4. Build Prompt for Pedagogical Response ---
+    system_prompt_content = inputs.text(current_ta_system_prompt_file)
+    if system_prompt_content is None:
+        logging.error(f"TA system prompt '{current_ta_system_prompt_file}' is not in the inputs snapshot. Using default.")
+        system_prompt_content = DEFAULT_TA_SYSTEM_PROMPT
+
+    fused_classification_options = None
+    if classification_result is not None:
+        hint, consecutive_executive = profile_hint(current_profile_hint_strategy, classification_result, student_profile, message.student_id)
+    else:
+        # The hint depends on a label the fused call has not produced yet, so offer one per label
+        _, fused_classification_options = load_classification_config(inputs)
+        hint = build_conditional_hints({
+            label: profile_hint(current_profile_hint_strategy, label, student_profile, message.student_id, log_decisions=False)[0]
+            for label in fused_classification_options
+        })
+        classification_result, consecutive_executive = "other", 0  # Replaced by apply_fused_output
+    if fused:
+        ea_guidelines = (inputs.text(EA_SYSTEM_PROMPT_FILE) or "").strip() or DEFAULT_EA_GUIDELINES
+        system_prompt_content += build_fused_instructions(ea_guidelines, fused_classification_options)
+
+    # --- 4b. Static prefix (same bytes for every student of this assignment and group), then the varying context ---
+    system_prompt_content = static_prefix(
+        "ta", system_prompt_content,
+        ("Assignment", CONTEXT_PACKER.cap("response", RESPONSE_MODEL_NAME, "assignment", assignment_description, 0.4)),
+        ("Learning Objectives", CONTEXT_PACKER.cap("response", RESPONSE_MODEL_NAME, "learning_objectives", bullet_list(learning_objectives), 0.2)),
+    )
+    sections = [
+        Section("system", system_prompt_content, priority=0, fixed=True),
+        Section("profile_hint", hint, priority=0, fixed=True),
+        Section("question", message.message_text, priority=1, min_share=0.2),
+        Section("ea_answer", ea_response, priority=2, min_share=0.15),
+        Section("history", conversation_history_messages, priority=3, min_share=0.15, keep="tail"),
+        Section("summary", conversation_summary or "", priority=4, min_share=0.05),
+        Section("logs", logs_context, priority=5, min_share=0.05, keep="tail"),
+    ]
+    packed = CONTEXT_PACKER.pack("response", RESPONSE_MODEL_NAME, [section for section in sections if not (fused and section.name == "ea_answer")],
+                                 template_tokens=150)  # Instructions and labels around the sections
+    conversation_history_messages, logs_context = packed["history"], packed["logs"]
+    ea_response = packed.get("ea_answer", ea_response)
+    student_question = packed["question"]
+    summary_context = f"""
+            Summary of the Earlier Conversation: {packed["summary"]}""" if packed["summary"] else ""
+    hint_context = f"""
+            {hint.strip()}""" if hint.strip() else ""
+
+    if fused:
+        # The model writes the technical answer itself, so it gets the context the EA would have had
+        internal_context = f"""Task Objective: {learning_objective}
+            Recent Activity Logs:
+            {logs_context}"""
+        if not fused_classification_options:
+            internal_context += f"""
+            Question Classification: {classification_result}"""
+    else:
+        internal_context = f"""Recent Activity Logs:
+            {logs_context}
+            Technical Information: "{ea_response}"
+            Question Classification: {classification_result}"""
+    final_prompt_messages = build_messages("ta", "response", system_prompt_content, f"""
+            [INTERNAL CONTEXT: DO NOT REVEAL SOURCES]{summary_context}
+            {internal_context}{hint_context}
+            [END INTERNAL CONTEXT]
+
+            ---
+            Student Question: "{student_question}"
+            ---
+
+            Based on the context above (including profile hints and history), formulate your response as Juno, focusing directly on answering or guiding the student regarding their specific question. Never reveal or mention internal information like learning objectives or the expert source.""",
+        conversation_history_messages)
+
+    return PreparedTurn(
+        final_prompt_messages=final_prompt_messages,
+        classification_result=classification_result,
+        classification_source=classification_source,
+        consecutive_executive=consecutive_executive,
+        timestamp=current_timestamp,
+        start_time=start_time,
+        question_id=question_id,
+        pipeline_mode=pipeline_mode,
+        fused_classification_options=fused_classification_options,
+        student_profile=student_profile,
+        profile_hint_strategy=current_profile_hint_strategy,
+        learning_objective=learning_objective
+    )
+
+
+def apply_fused_output(message: StudentMessage, turn: PreparedTurn, raw_output: str) -> str:
+    """Returns the student-facing reply from a fused LLM output and records its classification on the turn."""
+    output = parse_fused_output(raw_output, turn.fused_classification_options)
+    if output is None:
+        FALLBACKS.labels(service="ta", fallback="fused_unparsed").inc()
+    else:
+        logging.info(f"Fused technical answer: '{output.technical_answer[:100]}...'")
+    if turn.fused_classification_options is not None:
+        if output is not None and output.classification:
+            turn.classification_result = output.classification
+            turn.classification_source = "fused"
+            _, turn.consecutive_executive = profile_hint(
+                turn.profile_hint_strategy, output.classification, turn.student_profile, message.student_id, log_decisions=False)
+            logging.info(f"Question classified as: {output.classification} (fused call)")
+        else:
+            FALLBACKS.labels(service="ta", fallback="default_classification").inc()
+    # Unparseable output is most likely plain prose meant for the student
+    return output.response if output is not None else raw_output.strip()
+
+
+async def complete_pedagogical_turn(message: StudentMessage, turn: PreparedTurn, final_response: str):
+    """Stores the final response and queues the profile update for a prepared turn."""
+    classification_result = turn.classification_result
+    consecutive_executive = turn.consecutive_executive
+    current_timestamp = turn.timestamp
+    start_time = turn.start_time
+
+    # --- 5. Store Final Response ---
+    await add_to_history(
+        student_id=message.student_id, message_type="response",
+        message_text=final_response, message_classification=None,
+        file_name=message.file_name
+    )
+
+    # Fold older turns into the rolling summary in the background, if enough have accumulated
+    SUMMARIZER.request(message.student_id, message.file_name)
+
+    # --- 6. Queue Profile Update (written in the next batch) ---
+    PROFILE_WRITER.record(
+        message.student_id,
+        message.file_name, 
+        classification_result,
+        current_timestamp,
+        message.message_text,
+        consecutive_executive,
+        classification_result
+    )
+    logging.info(f"Queued profile update for {message.student_id}")
+
+    # --- 7. Log Processing Time ---
+    processing_time = time.time() - start_time
+    logging.info(f"TA processing complete for {message.student_id} in {processing_time:.2f}s. Returning response.")
+
+    # --- 8. Update Question Classification ---
+    await update_question_classification(turn.question_id, classification_result, turn.classification_source)
+
+    # --- 9. Add the question and the log events sent with it to the activity totals ---
+    await record_activity(message, turn.learning_objective, classification_result)
+
+
+# --- API Endpoints ---
+async def generate_report(student_id: str, file_name: str, processed_logs: Optional[str], progress: ProgressFn) -> str:
+    """Generates a performance report for the student based on their recent activity logs and conversation history.
+
+    Runs as a background job (see report_jobs.py); `progress(stage)` records each step.
+    """
+    inputs = INPUTS.current
+    assignment_id = derive_assignment_id(file_name)
+    assignment_desc = inputs.assignment_descriptions.get(assignment_id, DEFAULT_ASSIGNMENT_DESCRIPTION)
+    learning_objs = inputs.learning_objectives.get(assignment_id, DEFAULT_LEARNING_OBJECTIVES)
+    next_steps = inputs.next_steps.get(assignment_id, ["Proceed to next assignment.", "Ask Juno for exercises."])
+    
+    await progress("collecting_context")
+    history_summary, history_msgs = await get_summarized_history(student_id, file_name, limit=50)
+    # Totals for the whole session per objective; the raw log only adds the latest events as examples
+    activity_ctx = await ACTIVITY.table(student_id, assignment_id, learning_objs)
+    logs_ctx = processed_logs or "No activity logs."
+    report_system_prompt = """You are Juno, an automated coach.  
+            Using the student's activity per learning objective, recent notebook logs, conversation history and the assignment's learning objectives, produce a clear performance report for the student. 
+            For each learning objective, note strengths, weaknesses, and concrete next steps. 
+            Based on the report, suggest a personalized next step for the student.
+            Use an encouraging tone, and avoid technical jargon.
+            """
+    # Assignment, objectives and next steps are the same for every student of the assignment: keep them in the cached prefix
+    report_prefix = static_prefix(
+        "ta", report_system_prompt,
+        ("Assignment", CONTEXT_PACKER.cap("report", RESPONSE_MODEL_NAME, "assignment", assignment_desc, 0.3)),
+        ("Learning Objectives", CONTEXT_PACKER.cap("report", RESPONSE_MODEL_NAME, "learning_objectives", bullet_list(learning_objs), 0.2)),
+        ("Next Steps (suggest one for the student based on performance)",
+         CONTEXT_PACKER.cap("report", RESPONSE_MODEL_NAME, "next_steps", bullet_list(next_steps), 0.15)),
+    )
+    # The activity table stays small (one line per objective); keep the most recent log events and messages
+    packed = CONTEXT_PACKER.pack("report", RESPONSE_MODEL_NAME, [
+        Section("system", report_prefix, priority=0, fixed=True),
+        Section("activity", activity_ctx, priority=1, min_share=0.1),
+        Section("history", history_msgs, priority=2, min_share=0.2, keep="tail"),
+        Section("summary", history_summary or "", priority=3, min_share=0.05),
+        Section("logs", logs_ctx, priority=4, min_share=0.05, keep="tail"),
+    ], template_tokens=120)
+    logs_ctx = packed["logs"]
+    hist_str = format_history_for_prompt(packed["history"], packed["summary"])
+
+    report_prompt = build_messages("ta", "report", report_prefix, f"""
+        [INTERNAL CONTEXT: DO NOT REVEAL SOURCES]
+        Activity per Learning Objective (whole session):
+        {packed["activity"]}
+
+        Most Recent Activity Logs:
+        {logs_ctx}
+
+        Conversation History:
+        {hist_str}
+        [END INTERNAL CONTEXT]
+        ---
+        Please generate a reflective performance report of the student, for the student.
+        """)
+    await progress("generating")
+    with time_stage("ta", "report_llm"):
+        report = await call_llm(
+            report_prompt,
+            model_name=RESPONSE_MODEL_NAME,
+            purpose="performance report generation",
+            priority="report"
+        )
+    return report
+
+
+# /report generation in the background, with the result kept until new messages or logs arrive
+REPORT_JOBS = ReportJobs(DB, generate_report)
+
+
+async def resolve_group_params(student_id: str) -> tuple:
+    """Returns the (TA system prompt file, profile hint strategy, pipeline mode, fused classification) for the student's A/B groups."""
+    # --- A/B Testing: Get student's groups and parameters --- Added Block
+    student_experiment_groups = get_experiment_groups(student_id)
+    group_params = merged_params(student_experiment_groups)
+    
+    # Default parameters (if A/B test not active or group has no params)
+    current_ta_system_prompt_file = TA_SYSTEM_PROMPT_FILE
+    current_profile_hint_strategy = "standard" # Default strategy
+    pipeline_mode = PIPELINE_MODE
+    fused_classification = False
+
+    if group_params:
+        current_ta_system_prompt_file = group_params.get("system_prompt_file", TA_SYSTEM_PROMPT_FILE)
+        current_profile_hint_strategy = group_params.get("profile_hint_strategy", "standard")
+        pipeline_mode = str(group_params.get("pipeline_mode", PIPELINE_MODE)).strip().lower()
+        fused_classification = bool(group_params.get("fused_classification", False))
+        groups = ", ".join(f"'{group['group_id']}' ({experiment_id})" for experiment_id, group in student_experiment_groups)
+        logging.info(f"A/B Test: Student {student_id} in group {groups}. Using prompt file '{current_ta_system_prompt_file}', hint strategy '{current_profile_hint_strategy}' and pipeline '{pipeline_mode}'.")
+    else:
+        logging.info(f"A/B Test: No specific group or params for student {student_id}. Using default TA prompt and hint strategy.")
+    # --- End A/B Testing Block ---
+    if pipeline_mode not in PIPELINE_MODES:
+        logging.warning(f"Unknown pipeline mode '{pipeline_mode}' for {student_id}. Using 'standard'.")
+        pipeline_mode = "standard"
+    return current_ta_system_prompt_file, current_profile_hint_strategy, pipeline_mode, fused_classification
+
+
+@app.post("/receive_student_message", response_model=TutorApiResponse)
+async def receive_student_message(message: StudentMessage):
+    """
+    Handles incoming student messages:
+    1. Classifies the question type (instrumental/executive/other)
+    2. Calls EA directly with context (history, logs, LO, assignment, question).
+    3. Formulates pedagogical response using LLM + context + EA answer + classification.
+    4. Queues the profile update for the next batched write.
+    """
+    started = time.perf_counter()
+    current_ta_system_prompt_file, current_profile_hint_strategy, pipeline_mode, fused_classification = await resolve_group_params(message.student_id)
+
+    if message.message_text.strip().lower() == "/report":
+        # Same background job as POST /report_jobs; a repeated /report without new activity is answered from its result
+        await record_activity(message)
+        job = await REPORT_JOBS.submit(message.student_id, message.file_name, message.processed_logs)
+        if job["status"] not in ("done", "failed"):
+            job = await REPORT_JOBS.wait(job["job_id"], REPORT_WAIT_SECONDS)
+        REQUEST_SECONDS.labels(service="ta", endpoint="report").observe(time.perf_counter() - started)
+        if job["status"] == "done":
+            return TutorApiResponse(final_response=job["report"])
+        if job["status"] == "failed":
+            FALLBACKS.labels(service="ta", fallback="report_failed").inc()
+            return TutorApiResponse(final_response=DEFAULT_ERROR_RESPONSE)
+        return TutorApiResponse(final_response=REPORT_PENDING_RESPONSE)
+
+    elif message.message_text.strip().lower() == "/qualtrics-finish":
+        # Check if student has spent minimum required time AND has sufficient activity (rules per assignment in inputs/completion_rules.json)
+        rule = INPUTS.current.completion_rule(derive_assignment_id(message.file_name))
+        min_session_minutes = rule["min_session_minutes"]
+        min_questions = rule["min_questions"]
 
-        # --- 4. LLM Call: Formulate Pedagogical Response ---
         try:
-            try:
-                with open(current_ta_system_prompt_file, 'r') as f:
-                    system_prompt_content = f.read()
-            except Exception as e:
-                logging.error(f"Failed to load TA system prompt from '{current_ta_system_prompt_file}': {e}. Using default.")
-                system_prompt_content = DEFAULT_TA_SYSTEM_PROMPT
-
-            # Get current question classification and profile info
-            last_classification = student_profile.get("last_question_classification")
-            consecutive_executive = student_profile.get("consecutive_executive_count", 0)
-
-            # --- Update consecutive_executive_count for this request ---
-            if classification_result == "executive":
-                if last_classification == "executive":
-                    consecutive_executive += 1
-                else:
-                    consecutive_executive = 1
-            else:
-                consecutive_executive = 0
-            # --- End update ---
-
-            # Apply adaptive response logic based on A/B test group and question type
-            if current_profile_hint_strategy == "enhanced_guidance":
-                # Treatment group gets adaptive help-seeking logic
-                if classification_result == "instrumental":
-                    # Reset consecutive_executive streak
-                    consecutive_executive = 0
-                    if last_classification == "executive":
-                        # Shift from executive to instrumental - provide positive reinforcement
-                        system_prompt_content += """\n**Profile Hint (Positive Reinforcement):** The student has shifted from an executive to an instrumental question. Provide explicit positive reinforcement for this shift (e.g., "That's a very effective way to ask for help to understand the material.") along with standard JIT support."""
-                        logging.info(f"Adaptive Logic: Detected shift from executive to instrumental for {message.student_id}")
-                    else:
-                        # Ongoing instrumental questions - maintain standard support
-                        system_prompt_content += """\n**Profile Hint (Standard Support):** Continue providing JIT support with a positive and encouraging tone, but without explicit praise. The primary reinforcement is the answer itself."""
-                        logging.info(f"Adaptive Logic: Ongoing instrumental questions for {message.student_id}")
-
-                elif classification_result == "executive":
-                    # Incremental hints based on consecutive executive questions
-                    if consecutive_executive == 0:
-                        # No executive streak, skip hint or use a default (no hint)
-                        pass
-                    elif consecutive_executive == 1:
-                        system_prompt_content += """\n**Profile Hint (First Executive):** 
-                        This is the first executive question in sequence. Gently guide the student towards reflection, without requiring direct rephrasing. 
-                        For example: "That question seems focused on getting the answer directly. For the following questions, can you think about how to rephrase them to better understand the underlying concepts?" """
-                        logging.info(f"Adaptive Logic: First executive question for {message.student_id}")
-                    elif consecutive_executive == 2:
-                        system_prompt_content += """\n**Profile Hint (Second Executive):** 
-                        This is the second consecutive executive question. Provide elements of good instrumental questions. 
-                        For example: "Good questions often explore the 'why' or 'how' of a concept, or compare different approaches. How might you rephrase following questions with that in mind?" or "Good questions decompose complex concepts into smaller, more manageable parts. How might you rephrase following questions with that in mind?" """
-                        logging.info(f"Adaptive Logic: Second consecutive executive question for {message.student_id}")
-                    elif consecutive_executive == 3:
-                        last_exec_example = student_profile.get("last_executive_example", "your previous question")
-                        system_prompt_content += f"""\n**Profile Hint (Third Executive):** 
-                        This is the third consecutive executive question. Take the student's question and rephrase it as a model instrumental question. For example: 
-                        "Instead of asking 'make a bar plot', a better version might be 'what is the first step to make a bar plot?' Could you try rephrasing your next request similarly?"
-                        Student's previous question: {last_exec_example} """
-                        logging.info(f"Adaptive Logic: Third consecutive executive question for {message.student_id}")
-                    else:
-                        last_instr_example = student_profile.get("last_instrumental_example", "your previous question")
-                        system_prompt_content += f"""\n**Profile Hint (Fourth+ Executive):** 
-                        This is the fourth or subsequent consecutive executive question. Directly refer to the pedagogical rationale. 
-                        For example: "Research in learning suggests that asking questions focused on understanding is more strongly linked to better learning outcomes than seeking direct solutions. It might be helpful to try and focus on understanding the process here." or "Focusing on direct solutions is not as effective as asking questions that help you understand the material. How might you rephrase your next request to focus on understanding the material?"
-                        Use their previous good question as motivation: {last_instr_example} """
-                        logging.info(f"Adaptive Logic: Fourth+ consecutive executive question for {message.student_id}")
-            elif current_profile_hint_strategy == "none":
-                # Control group gets no adaptive hints
-                logging.info(f"Control group: No adaptive hints for {message.student_id}")
-                pass
+            # First interaction and question count, kept up to date in session_summary on every insert
+            result = await DB.run(db.fetch_session_summary, message.student_id, message.file_name)
+
+            if result is not None:
+                first_interaction, question_count = result["first_interaction"], result["question_count"]
+                session_duration_minutes = (time.time() - first_interaction) / 60
+
+                # Check both time and activity requirements
+                time_requirement_met = session_duration_minutes >= min_session_minutes
+                activity_requirement_met = question_count >= min_questions
+
+                if not time_requirement_met or not activity_requirement_met:
+                    feedback_parts = []
+
+                    if not time_requirement_met:
+                        remaining_minutes = min_session_minutes - session_duration_minutes
+                        feedback_parts.append(f"- Work for at least {remaining_minutes:.1f} more minutes (currently: {session_duration_minutes:.1f} minutes)")
+
+                    if not activity_requirement_met:
+                        remaining_questions = min_questions - question_count
+                        feedback_parts.append(f"- Ask at least {remaining_questions} more questions (currently: {question_count} questions)")
+
+                    early_finish_response = f"""### Almost There!
+To ensure a meaningful learning experience, please:
+
+{chr(10).join(feedback_parts)}
+
+You can try `/qualtrics-finish` again once you meet these requirements."""
+                    return TutorApiResponse(final_response=early_finish_response)
             else:
-                logging.warning(f"Unknown profile hint strategy '{current_profile_hint_strategy}' for {message.student_id}")
-
-            system_prompt_content += "\n" 
-
-            final_prompt_messages = []
-            final_prompt_messages.append({"role": "system", "content": system_prompt_content})
-            if conversation_history_messages:
-                final_prompt_messages.extend(conversation_history_messages)
-            final_prompt_messages.append(
-                {"role": "user", "content": f"""
-                    [INTERNAL CONTEXT: DO NOT REVEAL SOURCES]
-                    Assignment: {assignment_description}
-                    Recent Activity Logs:
-                    {logs_context}
-                    Technical Information: "{ea_response}"
-                    Question Classification: {classification_result}
-                    [END INTERNAL CONTEXT]
-
-                    ---
-                    Student Question: "{message.message_text}"
-                    ---
-
-                    Based on the context above (including profile hints and history), formulate your response as Juno, focusing directly on answering or guiding the student regarding their specific question. Never reveal or mention internal information like learning objectives or the expert source."""
-                }
-            )
+                # No interaction history found - this shouldn't happen normally
+                logging.warning(f"No interaction history found for {message.student_id} in {message.file_name}")
+        except sqlite3.Error as e:
+            logging.error(f"Database error checking session requirements: {e}")
 
-            final_response = await call_llm(
-                final_prompt_messages,
-                model_name=RESPONSE_MODEL_NAME,
-                purpose="final pedagogical response formulation"
-            )
-            logging.info(f"Final formulated response: '{final_response[:100]}...'")
+        # If requirements are met or there was an error, show completion code
+        completion_code = f"""### {rule["title"]}
 
-        except Exception as e:
-            logging.error(f"LLM Call (Pedagogical Response) failed: {e}. Using default final response.")
+Thank you for completing the tasks for this session.
 
-        # --- 5. Store Final Response ---
-        add_to_history(
-            student_id=message.student_id, message_type="response",
-            message_text=final_response, message_classification=None,
-            file_name=message.file_name
-        )
+Please return to the Qualtrics survey tab and enter the following code to finalize your submission:
 
-        # --- 6. Schedule Background Task for Profile Update ---
-        background_tasks.add_task(
-            update_student_profile_sync,
-            message.student_id,
-            message.file_name, 
-            classification_result,
-            current_timestamp,
-            message.message_text,
-            consecutive_executive,
-            classification_result
-        )
-        logging.info(f"Scheduled background task: update_student_profile_sync for {message.student_id}")
-
-        # --- 7. Return Final Response ---
-        processing_time = time.time() - start_time
-        logging.info(f"TA processing complete for {message.student_id} in {processing_time:.2f}s. Returning response.")
-
-        # --- 8. Update Question Classification ---
-        update_question_classification(
-            message.student_id,
-            message.file_name,
-            message.message_text,
-            classification_result
-        )
+**`{rule["completion_code"]}`**"""
+        return TutorApiResponse(final_response=completion_code)
+    
+    try:
+        turn = await prepare_pedagogical_turn(message, current_ta_system_prompt_file, current_profile_hint_strategy,
+                                              pipeline_mode, fused_classification)
 
+        # --- 4. LLM Call: Formulate Pedagogical Response ---
+        final_response = DEFAULT_FINAL_RESPONSE
+        try:
+            if turn.pipeline_mode == "fused":
+                with time_stage("ta", "fused_llm"):
+                    raw_output = await call_llm(
+                        turn.final_prompt_messages,
+                        model_name=RESPONSE_MODEL_NAME,
+                        purpose="fused technical and pedagogical response",
+                        response_format=FUSED_RESPONSE_FORMAT
+                    )
+                final_response = apply_fused_output(message, turn, raw_output) or DEFAULT_FINAL_RESPONSE
+            else:
+                with time_stage("ta", "response_llm"):
+                    final_response = await call_llm(
+                        turn.final_prompt_messages,
+                        model_name=RESPONSE_MODEL_NAME,
+                        purpose="final pedagogical response formulation"
+                    )
+            logging.info(f"Final formulated response: '{final_response[:100]}...'")
+        except Exception as e:
+            logging.error(f"LLM Call (Pedagogical Response) failed: {e}. Using default final response.")
+            FALLBACKS.labels(service="ta", fallback="default_final_response").inc()
+
+        await complete_pedagogical_turn(message, turn, final_response)
         return TutorApiResponse(final_response=final_response)
 
     except Exception as e:
         logging.error(f"Unexpected error in TA handler for {message.student_id}: {e}", exc_info=True)
-        return TutorApiResponse(final_response="I'm sorry, an error occurred while processing your request.")
+        FALLBACKS.labels(service="ta", fallback="error_response").inc()
+        return TutorApiResponse(final_response=DEFAULT_ERROR_RESPONSE)
+    finally:
+        REQUEST_SECONDS.labels(service="ta", endpoint="message").observe(time.perf_counter() - started)
+
+
+# Turns of /receive_student_message_stream still being stored (kept here so they are not garbage collected)
+STREAM_COMPLETIONS: Set[asyncio.Task] = set()
+
+
+def sse_event(payload: dict) -> str:
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+@app.post("/receive_student_message_stream")
+async def receive_student_message_stream(message: StudentMessage):
+    """
+    Streaming variant of /receive_student_message, sent as Server-Sent Events.
+    Runs the same pipeline, but re-streams the final pedagogical response as the LLM
+    generates it: one `{"delta": ...}` event per chunk, then `{"done": true, "final_response": ...}`.
+    Commands (/report, /qualtrics-finish) are answered with a single `done` event.
+    """
+    if message.message_text.strip().lower() in ("/report", "/qualtrics-finish"):
+        command_response = await receive_student_message(message)
+
+        async def command_stream():
+            yield sse_event({"done": True, "final_response": command_response.final_response})
+        return StreamingResponse(command_stream(), media_type="text/event-stream")
+
+    started = time.perf_counter()
+    current_ta_system_prompt_file, current_profile_hint_strategy, pipeline_mode, fused_classification = await resolve_group_params(message.student_id)
+
+    async def event_stream():
+        try:
+            turn = await prepare_pedagogical_turn(message, current_ta_system_prompt_file, current_profile_hint_strategy,
+                                                  pipeline_mode, fused_classification)
+        except Exception as e:
+            logging.error(f"Unexpected error in TA stream handler for {message.student_id}: {e}", exc_info=True)
+            FALLBACKS.labels(service="ta", fallback="error_response").inc()
+            yield sse_event({"done": True, "final_response": DEFAULT_ERROR_RESPONSE})
+            return
+
+        fused = turn.pipeline_mode == "fused"
+        # In the fused pipeline only the "response" field of the JSON output is streamed to the student
+        extractor = FusedResponseExtractor() if fused else None
+        response_parts = []
+        unstreamed = None  # Reply the student has not seen yet, sent as one last delta
+        try:
+            with time_stage("ta", "fused_llm" if fused else "response_llm"):
+                async for delta in call_llm_stream(
+                    turn.final_prompt_messages,
+                    model_name=RESPONSE_MODEL_NAME,
+                    purpose="fused technical and pedagogical response" if fused else "final pedagogical response formulation",
+                    response_format=FUSED_RESPONSE_FORMAT if fused else None
+                ):
+                    if extractor is not None:
+                        delta = extractor.feed(delta)
+                        if not delta:
+                            continue
+                    response_parts.append(delta)
+                    yield sse_event({"delta": delta})
+        except Exception as e:
+            logging.error(f"Streaming LLM Call (Pedagogical Response) failed: {e}. Using partial or default final response.")
+        finally:
+            # Also runs when the client disconnects or the request is cancelled mid-stream:
+            # whatever the student has already seen is what gets stored
+            final_response = "".join(response_parts).strip()
+            if extractor is not None and extractor.text:
+                # Records the classification; if no "response" field was found, the whole output is the reply
+                fused_response = apply_fused_output(message, turn, extractor.text)
+                if not final_response and fused_response:
+                    final_response = unstreamed = fused_response
+            if not final_response:
+                FALLBACKS.labels(service="ta", fallback="default_final_response").inc()
+                final_response = DEFAULT_FINAL_RESPONSE
+            logging.info(f"Final streamed response: '{final_response[:100]}...'")
+            # A task of its own, so cancelling the stream does not cancel storing the turn
+            completion = asyncio.get_running_loop().create_task(complete_pedagogical_turn(message, turn, final_response))
+            STREAM_COMPLETIONS.add(completion)
+            completion.add_done_callback(STREAM_COMPLETIONS.discard)
+
+        if unstreamed:
+            yield sse_event({"delta": unstreamed})
+        await asyncio.shield(completion)
+        REQUEST_SECONDS.labels(service="ta", endpoint="message_stream").observe(time.perf_counter() - started)
+        yield sse_event({"done": True, "final_response": final_response})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+@app.post("/report_jobs", response_model=ReportJobResponse)
+async def submit_report_job(message: StudentMessage):
+    """Starts generating a /report in the background, or returns the job or stored report for unchanged activity.
+
+    Poll GET /report_jobs/{job_id} until the status is "done" or "failed".
+    """
+    await record_activity(message)
+    return ReportJobResponse(**await REPORT_JOBS.submit(message.student_id, message.file_name, message.processed_logs))
+
+
+@app.get("/report_jobs/{job_id}", response_model=ReportJobResponse)
+async def get_report_job(job_id: str):
+    job = await REPORT_JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown report job.")
+    return ReportJobResponse(**job)
 
 
 @app.get("/verify_ta")
 def verify():
     return {"message": "Tutor Agent (Sync Response) is working"}
 
-# Load model (do this once at startup, outside the request handler)
-# Use a lightweight model suitable for the task
-try:
+@app.get("/metrics")
+def metrics():
+    return metrics_response()
+
+def load_embedding_model():
+    """Imports torch/sentence-transformers (several seconds) and loads the model."""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    embedding_model = SentenceTransformer('all-MiniLM-L6-v2', device=device)
+    model = SentenceTransformer(EMBEDDING_MODEL_NAME, device=device)
     logging.info(f"Sentence Transformer model loaded successfully on {device}.")
-    LO_EMBEDDINGS = embedding_model.encode(LEARNING_OBJECTIVES_MAP.get("default", DEFAULT_LEARNING_OBJECTIVES), convert_to_tensor=True)
-    logging.info("Pre-computed embeddings for Learning Objectives.")
+    return model
+
+# Load model (do this once at startup, outside the request handler).
+# Under gunicorn with preload_app (see gunicorn.conf.py) this runs once in the parent and the
+# workers share the weights and LO matrices copy-on-write.
+LO_INDEX = LOIndex(EMBEDDING_MODEL_NAME)
+try:
+    embedding_model = load_embedding_model()
+    # Assignments without an LO file fall back to the defaults, so index those too
+    indexed = LO_INDEX.build(embedding_model, INPUTS.current.learning_objectives, extra=[("_fallback", DEFAULT_LEARNING_OBJECTIVES)])
+    logging.info(f"Loaded embeddings for {indexed} learning objective lists from {LO_INDEX.cache_dir}.")
+    # Embed changed LO files before a reloaded snapshot is published
+    INPUTS.on_change(lambda snapshot: LO_INDEX.build(embedding_model, snapshot.learning_objectives))
 except Exception as e:
     logging.error(f"Failed to load Sentence Transformer model or encode LOs: {e}")
     embedding_model = None
-    LO_EMBEDDINGS = None
+EMBEDDINGS.model = embedding_model
 
 if __name__ == "__main__":
     import uvicorn
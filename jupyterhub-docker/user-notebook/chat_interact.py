@@ -26,7 +26,23 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - CH
 
 TA_URL_BASE = os.getenv("TA_MIDDLEWARE_URL", "http://localhost:8004")
 TA_URL = f"{TA_URL_BASE}/receive_student_message"
+TA_STREAM_URL = f"{TA_URL_BASE}/receive_student_message_stream"
+TA_REPORT_JOBS_URL = f"{TA_URL_BASE}/report_jobs"
+# Stream the response token by token instead of waiting for the full answer
+TA_STREAMING = os.getenv("TA_STREAMING", "false").strip().lower() in ("1", "true", "yes")
+# Minimum seconds between rewrites of the chat file while a response is streaming
+TA_STREAM_FLUSH_INTERVAL = float(os.getenv("TA_STREAM_FLUSH_INTERVAL", "0.5"))
+# /report runs as a background job on the TA; seconds between status checks, and how long to wait for it
+TA_REPORT_POLL_INTERVAL = float(os.getenv("TA_REPORT_POLL_INTERVAL", "1"))
+TA_REPORT_TIMEOUT = float(os.getenv("TA_REPORT_TIMEOUT", "600"))
+REPORT_STAGE_MESSAGES = {
+    "queued": "Your report is queued...",
+    "starting": "Preparing your report...",
+    "collecting_context": "Reviewing your activity and our conversation...",
+    "generating": "Writing your report...",
+}
 LOG_ENTRY_LIMIT = 10
+IGNORED_LOG_EVENTS = ["Notebook became visible", "Closed notebook"]
 
 class ChatHandler(FileSystemEventHandler):
     def __init__(self, chat_directory, loop, processed_logs_dir):
@@ -37,6 +53,8 @@ class ChatHandler(FileSystemEventHandler):
         os.makedirs(self.processed_logs_dir, exist_ok=True)
         self.last_processed_messages: Dict[str, Dict[str, Any]] = {}
         self.working_message_ids: Dict[str, str] = {}
+        # Time of the newest log event the TA has received, per chat file
+        self.log_event_cursors: Dict[str, str] = {}
         self.loop = loop
         logging.info(f"Monitoring directory: {self.chat_directory}")
         logging.info(f"Looking for processed logs in: {self.processed_logs_dir}")
@@ -89,22 +107,22 @@ class ChatHandler(FileSystemEventHandler):
                     file_name = os.path.basename(file_path)
 
                     session_id_for_logs = self.extract_session_id_from_filename(file_path)
-                    processed_log_data = self.get_processed_log_data(session_id_for_logs)
+                    session_logs = self.read_session_logs(session_id_for_logs)
+                    processed_log_data = self.get_processed_log_data(session_id_for_logs, session_logs=session_logs)
 
                     # --- Schedule the interaction task ---
-                    asyncio.create_task(self.manage_interaction(content, file_path, student_id, message_text, processed_log_data, file_name))
+                    asyncio.create_task(self.manage_interaction(content, file_path, student_id, message_text, processed_log_data, file_name, session_logs))
 
         except FileNotFoundError: logging.warning(f"File not found: {file_path}.")
         except PermissionError: logging.error(f"Permission denied: {file_path}.")
         except Exception as e: logging.error(f"Error handling {file_path}: {e}", exc_info=True)
 
-    async def manage_interaction(self, content, file_path, student_id, message_text, processed_log_data, file_name):
+    async def manage_interaction(self, content, file_path, student_id, message_text, processed_log_data, file_name, session_logs=None):
         """Sends message to TA, waits for response, updates chat file."""
-        # decide whether to send full logs or limited slice
-        session_id_for_logs = self.extract_session_id_from_filename(file_path)
-        if message_text.strip().lower() == "/report":
-            # no limit ⇒ full history
-            processed_log_data = self.get_processed_log_data(session_id_for_logs, limit=None)
+        is_report = message_text.strip().lower() == "/report"
+        # The TA keeps per-objective activity totals for the whole session (also used by /report),
+        # so only the latest log entries go along as text and new events as compact records
+        log_events = self.new_log_events(session_logs, self.log_event_cursors.get(file_path, ""))
         # Start "working" messages
         working_task = asyncio.create_task(self.send_working_messages(content, file_path))
 
@@ -112,25 +130,36 @@ class ChatHandler(FileSystemEventHandler):
         error_occured = False
 
         try:
-            # Call TA and WAIT for the response
+            ta_payload = {
+                "student_id": student_id,
+                "message_text": message_text,
+                "processed_logs": processed_log_data,
+                "file_name": file_name,
+                "log_events": log_events
+            }
             async with httpx.AsyncClient() as client:
-                logging.info(f"Sending message to TA at {TA_URL} and waiting for response...")
-                ta_response = await client.post( # Use await here
-                    TA_URL,
-                    json={
-                        "student_id": student_id,
-                        "message_text": message_text,
-                        "processed_logs": processed_log_data,
-                        "file_name": file_name
-                    },
-                    timeout=120.0 # Increased timeout since TA does all work now
-                )
-                ta_response.raise_for_status() # Check if TA processing was successful (e.g., 200 OK)
-
-                # Extract final response from TA's JSON payload
-                response_data = ta_response.json()
-                final_text = response_data.get("final_response", "Error: TA response format incorrect.")
+                if is_report:
+                    logging.info(f"Requesting report job from TA at {TA_REPORT_JOBS_URL}...")
+                    final_text = await self.request_report(client, ta_payload, file_path, working_task)
+                elif TA_STREAMING:
+                    logging.info(f"Streaming response from TA at {TA_STREAM_URL}...")
+                    final_text = await self.stream_ta_response(client, ta_payload, file_path, working_task)
+                else:
+                    # Call TA and WAIT for the response
+                    logging.info(f"Sending message to TA at {TA_URL} and waiting for response...")
+                    ta_response = await client.post( # Use await here
+                        TA_URL,
+                        json=ta_payload,
+                        timeout=120.0 # Increased timeout since TA does all work now
+                    )
+                    ta_response.raise_for_status() # Check if TA processing was successful (e.g., 200 OK)
+
+                    # Extract final response from TA's JSON payload
+                    response_data = ta_response.json()
+                    final_text = response_data.get("final_response", "Error: TA response format incorrect.")
                 logging.info(f"Received final response from TA: '{final_text[:100]}...'")
+                if log_events:
+                    self.log_event_cursors[file_path] = max(event["time"] for event in log_events)
 
                 # Prepare the chat message structure
                 final_response_message = {
@@ -189,6 +218,102 @@ class ChatHandler(FileSystemEventHandler):
                 except Exception as write_err:
                      logging.error(f"Failed to write final/error message to {file_path}: {write_err}")
 
+    async def request_report(self, client: httpx.AsyncClient, ta_payload: Dict[str, Any], file_path: str, working_task: asyncio.Task) -> str:
+        """Starts a report job on the TA (or gets its stored report) and polls it until it finishes.
+
+        While the job runs, the working message shows its current stage and is only rewritten
+        when the stage changes.
+        """
+        ta_response = await client.post(TA_REPORT_JOBS_URL, json=ta_payload, timeout=30.0)
+        ta_response.raise_for_status()
+        job = ta_response.json()
+        deadline = time.monotonic() + TA_REPORT_TIMEOUT
+        shown_stage = None
+        while job["status"] not in ("done", "failed"):
+            if not working_task.done():
+                working_task.cancel()
+                try:
+                    await working_task
+                except asyncio.CancelledError:
+                    pass
+            if job.get("stage") != shown_stage and job.get("stage") in REPORT_STAGE_MESSAGES:
+                shown_stage = job["stage"]
+                self.write_partial_response(REPORT_STAGE_MESSAGES[shown_stage], file_path)
+            if time.monotonic() >= deadline:
+                logging.warning(f"Report job {job['job_id']} for {file_path} did not finish in {TA_REPORT_TIMEOUT:.0f}s.")
+                return "Your report is taking longer than expected. Send `/report` again in a minute to see it."
+            await asyncio.sleep(TA_REPORT_POLL_INTERVAL)
+            ta_response = await client.get(f"{TA_REPORT_JOBS_URL}/{job['job_id']}", timeout=30.0)
+            ta_response.raise_for_status()
+            job = ta_response.json()
+        if job["status"] == "failed":
+            logging.error(f"Report job {job['job_id']} failed: {job.get('error')}")
+            return "Sorry, I couldn't generate your report this time. Please try `/report` again."
+        logging.info(f"Report job {job['job_id']} done{' (stored report)' if job.get('cached') else ''}.")
+        return job["report"]
+
+    async def stream_ta_response(self, client: httpx.AsyncClient, ta_payload: Dict[str, Any], file_path: str, working_task: asyncio.Task) -> str:
+        """Reads the TA's SSE stream, showing partial text in the working message as it arrives.
+
+        The "working" placeholders keep running until the first chunk arrives. After that the
+        working message is rewritten in place with the text so far, at most once every
+        TA_STREAM_FLUSH_INTERVAL seconds, so a long answer doesn't thrash the chat file.
+        """
+        partial_text = ""
+        final_text = None
+        last_flush = 0.0
+        async with client.stream("POST", TA_STREAM_URL, json=ta_payload, timeout=120.0) as ta_response:
+            if ta_response.is_error:
+                await ta_response.aread() # Make the body available to the HTTPStatusError handler
+            ta_response.raise_for_status()
+            async for line in ta_response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                try:
+                    event = json.loads(line[len("data:"):].strip())
+                except json.JSONDecodeError:
+                    logging.warning(f"Skipping undecodable TA stream event: {line[:100]}")
+                    continue
+                if event.get("done"):
+                    final_text = event.get("final_response", partial_text)
+                    break
+                delta = event.get("delta")
+                if not delta:
+                    continue
+                if not working_task.done():
+                    # First text arrived: stop the placeholder phrases
+                    working_task.cancel()
+                    try:
+                        await working_task
+                    except asyncio.CancelledError:
+                        pass
+                partial_text += delta
+                now = time.monotonic()
+                if now - last_flush >= TA_STREAM_FLUSH_INTERVAL:
+                    self.write_partial_response(partial_text, file_path)
+                    last_flush = now
+        if final_text is None:
+            logging.warning(f"TA stream for {file_path} ended without a final event.")
+            final_text = partial_text or "Error: TA response stream ended unexpectedly."
+        return final_text
+
+    def write_partial_response(self, partial_text: str, file_path: str):
+        """Updates the working message in place with the response text received so far."""
+        message_id = self.working_message_ids.get(file_path)
+        if not message_id or not os.path.exists(file_path):
+            return
+        partial_message = {
+            "body": partial_text, "sender": "Juno", "type": "msg",
+            "id": message_id, "time": time.time(), "raw_time": False, "automated": True
+        }
+        try:
+            # Re-read so messages the student sent meanwhile are not overwritten
+            with open(file_path, 'r') as f: current_content = json.load(f)
+        except Exception as e:
+            logging.error(f"Error reading {file_path} before writing partial response: {e}")
+            return
+        self.update_working_message(partial_message, current_content, file_path)
+
     def extract_session_id_from_filename(self, file_path: str) -> str:
         # (Same as before)
         file_name = os.path.basename(file_path)
@@ -207,7 +332,8 @@ class ChatHandler(FileSystemEventHandler):
        if event_type in ["Edited cell", "Pasted content"]: details = f"Content: {log.get('content', '')[:200]}"
        return f"{timestamp} - {event_type} (Cell {cell_index}): {details}"
 
-    def get_processed_log_data(self, session_id: str, limit: Optional[int] = LOG_ENTRY_LIMIT) -> Optional[str]:
+    def read_session_logs(self, session_id: str) -> Optional[list]:
+        """Returns the processed log entries of the session's notebook from all JSON files, or None if there are none."""
         logging.debug(f"Looking for logs matching session_id: {session_id} in {self.processed_logs_dir}")
         try:
             matching_log_files = [ f for f in os.listdir(self.processed_logs_dir) if f.endswith('.json') ]
@@ -243,7 +369,15 @@ class ChatHandler(FileSystemEventHandler):
                     if sanitized_notebook_name == session_id: matching_logs.append(log)
 
             if not matching_logs: logging.info(f"No matching logs for '{session_id}' in any JSON file"); return None
+            return matching_logs
+        except FileNotFoundError: logging.warning(f"Log dir not found: {self.processed_logs_dir}"); return None
+        except Exception as e: logging.error(f"Error reading logs for {session_id}: {e}", exc_info=True); return None
 
+    def get_processed_log_data(self, session_id: str, limit: Optional[int] = LOG_ENTRY_LIMIT,
+                               session_logs: Optional[list] = None) -> Optional[str]:
+        matching_logs = session_logs if session_logs is not None else self.read_session_logs(session_id)
+        if not matching_logs: return None
+        try:
             # apply limit if given, otherwise use entire session
             if limit is not None and len(matching_logs) > limit:
                 selected = matching_logs[-limit:]
@@ -252,14 +386,28 @@ class ChatHandler(FileSystemEventHandler):
             formatted_logs = [
                 self.format_log_entry(log)
                 for log in selected
-                if log.get('event') not in ["Notebook became visible", "Closed notebook"]
+                if log.get('event') not in IGNORED_LOG_EVENTS
             ]
             log_context = "\n".join(formatted_logs)
             logging.info(f"Found {len(formatted_logs)} relevant log entries.")
             return log_context
-        except FileNotFoundError: logging.warning(f"Log dir not found: {self.processed_logs_dir}"); return None
         except Exception as e: logging.error(f"Error processing logs for {session_id}: {e}", exc_info=True); return None
 
+    def new_log_events(self, session_logs: Optional[list], since: str) -> list:
+        """Compact records of the session's log events from time `since` on, for the TA's activity totals.
+
+        Events at exactly `since` are sent again; the TA skips the ones it has already counted.
+        """
+        events = []
+        for log in session_logs or []:
+            if log.get('event') in IGNORED_LOG_EVENTS or not isinstance(log.get('time'), str) or log['time'] < since:
+                continue
+            event = {"time": log['time'], "event": log.get('event', '')}
+            if log.get('error'):
+                event["error"] = str(log['error'])[:200]
+            events.append(event)
+        return events
+
     async def send_working_messages(self, content: Dict[str, Any], file_path: str):
         # (Same as before)
         working_phrases = [ "Juno is working on it...", "Just a moment, processing...", "Thinking...", "Checking notes...", ]
@@ -331,7 +479,7 @@ def main(directory_path, processed_logs_dir):
     try:
         print(f"Monitoring directory: {chat_directory}")
         print(f"Using processed logs from: {processed_logs_path}")
-        print(f"TA URL: {TA_URL}")
+        print(f"TA URL: {TA_STREAM_URL if TA_STREAMING else TA_URL}")
         # REMOVED: print(f"Chat Interact receiver running...")
         print("Press Ctrl+C to exit.")
         # Run the asyncio loop forever to keep watchdog alive